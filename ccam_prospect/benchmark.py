@@ -0,0 +1,253 @@
+import contextlib
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from ccam_prospect.radianceCalibration import RadianceCalibration
+from ccam_prospect.relativeReflectanceCalibration import RelativeReflectanceCalibration
+from ccam_prospect.utils.SpectrumFile import HEADER_LENGTH, VNIR_LINES, VIS_LINES, UV_LINES, read_psv, make_rad
+from ccam_prospect.utils.Utilities import get_header_values, get_integration_time_from_headers, \
+    moving_median_smoothing, write_final, write_label
+import ccam_prospect.utils.CalibrationAssets as assets
+
+# IPBC and ICT divisors giving each supported exposure time (ms)
+exposure_divisors = {
+    7: (33, 3500),
+    34: (33, 30500),
+    404: (3300, 4005),
+    5004: (33000, 5000)
+}
+
+# allowed slowdown of each stage compared to the baseline, as a fraction
+default_threshold = 0.25
+
+# modules timed by the startup stages: importing them is the start of a command line run
+startup_modules = {
+    "python_startup": None,
+    "rad_startup": "ccam_prospect.radianceCalibration",
+    "ref_startup": "ccam_prospect.relativeReflectanceCalibration",
+    "cli_startup": "ccam_prospect.cli"
+}
+
+# dependencies a calibration should only import on the code path that needs them
+heavy_modules = ["jinja2", "pds4_tools", "matplotlib", "tkinter", "sqlite3", "concurrent.futures"]
+
+
+def make_psv(filename, exposure=404, distance=2.53, seed=0, label=True):
+    """make_psv
+    write a synthetic PSV file: a 29 line header, the ">>>>Begin" marker, and
+    the VNIR, VIS and UV spectra at the lines read_psv reads them from.
+    The spectra are a smooth continuum with noise, on top of a dark offset.
+
+    :param filename: the PSV file to write
+    :param exposure: the exposure time in ms, one of 7, 34, 404 or 5004
+    :param distance: the distance to the target, in m
+    :param seed: seed of the random noise
+    :param label: also write a PDS3 .lbl label next to the file
+    """
+    (ipbc, ict) = exposure_divisors[exposure]
+    rng = np.random.default_rng(seed)
+    header = ['"Spectrometer Serial:CCAM"', '"Target:Synthetic"', '"IPBCdivisor:{}"'.format(ipbc),
+              '"ICTdivisor:{}"'.format(ict), '"distToTarget:{}"'.format(distance)]
+    header += ['"Field{:02d}:{}"'.format(ii, ii) for ii in range(HEADER_LENGTH - len(header))]
+    lines = header + ['>>>>Begin Processed Data']
+    lines += ['0'] * (VNIR_LINES[0] - len(lines))
+    for (start, end) in [VNIR_LINES, VIS_LINES, UV_LINES]:
+        if start > len(lines):
+            lines += ['>>>>Begin Spectrometer'] + ['0'] * (start - len(lines) - 1)
+        channels = np.arange(end - start)
+        continuum = 3000 + 2000 * np.sin(np.pi * channels / (end - start))
+        dn = 500 + continuum * exposure / 404 + rng.normal(0, 20, end - start)
+        lines += ['{:.4f}'.format(value) for value in dn]
+    with open(filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    if label:
+        with open(os.path.splitext(filename)[0] + '.lbl', 'w') as f:
+            f.write('PDS_VERSION_ID = PDS3\nSTART_TIME = 2012-10-22T12:00:00.000\nEND\n')
+
+
+def time_stage(function, repeat, setup=None):
+    """time_stage
+    time function(*setup()) repeat times. setup is not timed.
+
+    :return: the minimum, median and mean time in seconds
+    """
+    times = []
+    for ii in range(repeat):
+        arguments = setup() if setup is not None else ()
+        start = time.perf_counter()
+        function(*arguments)
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": float(np.median(times)), "mean": float(np.mean(times)), "repeat": repeat}
+
+
+def run_python(code):
+    """run_python
+    run python code in a new interpreter, with this copy of ccam_prospect importable
+
+    :return: what the code printed
+    """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_dir, env.get("PYTHONPATH")]))
+    return subprocess.run([sys.executable, "-c", code], env=env, check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout
+
+
+def time_startup(repeat):
+    """time_startup
+    time a new interpreter importing each of startup_modules (python_startup imports nothing,
+    the time every run pays), and list the heavy modules each import pulls in
+
+    :param repeat: the number of interpreters started for each module
+    :return: the timing of each module as returned by time_stage, and the heavy modules it imported
+    """
+    stages = {}
+    imports = {}
+    for (stage, module) in startup_modules.items():
+        code = "pass" if module is None else "import " + module
+        stages[stage] = time_stage(lambda: run_python(code), repeat)
+        if module is not None:
+            imports[stage] = run_python(code + "\nimport sys\nprint(' '.join(name for name in {!r} "
+                                               "if name in sys.modules))".format(heavy_modules)).split()
+    return stages, imports
+
+
+def run_benchmarks(repeat=20, work_dir=None, startup=True):
+    """run_benchmarks
+    time each stage of the calibration of a synthetic 404 ms PSV file
+
+    :param repeat: the number of times each stage is run
+    :param work_dir: the directory for the synthetic files (a temporary directory if None)
+    :param startup: also time the start of a command line run (see time_startup)
+    :return: a dictionary of the results, as written to the JSON file
+    """
+    own_dir = work_dir is None
+    if own_dir:
+        work_dir = tempfile.mkdtemp(prefix="ccam_benchmark_")
+    try:
+        psv_file = os.path.join(work_dir, "CL5_404238503PSV_F0050104CCAM02076P1.TXT")
+        make_psv(psv_file)
+        logfile = os.path.join(work_dir, "benchmark.log")
+        out_dir = os.path.join(work_dir, "out")
+        os.makedirs(out_dir, exist_ok=True)
+
+        # the values each stage starts from
+        radiance_cal = RadianceCalibration(logfile)
+        radiance_cal.set_psv(read_psv(psv_file))
+        radiance_cal.remove_offsets()
+        dn = np.concatenate([radiance_cal.uv, radiance_cal.vis, radiance_cal.vnir])
+        t_int = get_integration_time_from_headers(radiance_cal.headers)
+        fov_tgt = radiance_cal.get_area_on_target()
+        sa_steradian = radiance_cal.get_solid_angle()
+        (wavelength, factors) = radiance_cal.get_radiance_factors(assets.gain_file)
+        radiance = radiance_cal.get_radiance_final(dn, factors, t_int, fov_tgt, sa_steradian)
+
+        rad_file = os.path.join(out_dir, "CL5_404238503RAD_F0050104CCAM02076P1.tab")
+        reflectance_cal = RelativeReflectanceCalibration(logfile)
+        reflectance_cal.rad_file = rad_file
+        reflectance_cal.rad = make_rad(rad_file, radiance_cal.header_string, wavelength, radiance)
+        reference = reflectance_cal.choose_values()
+        reflectance = reflectance_cal.do_division(reference)
+        label = os.path.splitext(psv_file)[0] + '.lbl'
+
+        def fresh_offsets():
+            radiance_cal.set_psv(read_psv(psv_file))
+            return ()
+
+        def quietly(function):
+            # the progress printed by the calibrations would hide the results
+            def call():
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    function()
+            return call
+
+        stages = {
+            "header_parse": time_stage(lambda: get_header_values(psv_file), repeat),
+            "spectra_parse": time_stage(lambda: read_psv(psv_file), repeat),
+            "remove_offsets": time_stage(radiance_cal.remove_offsets, repeat, fresh_offsets),
+            "get_radiance": time_stage(
+                lambda: radiance_cal.get_radiance_final(dn, radiance_cal.get_radiance_factors(assets.gain_file)[1],
+                                                        t_int, fov_tgt, sa_steradian), repeat),
+            "choose_values": time_stage(reflectance_cal.choose_values, repeat),
+            "do_division": time_stage(lambda: reflectance_cal.do_division(reference), repeat),
+            "moving_median_smoothing": time_stage(lambda: moving_median_smoothing(reflectance[0:4096], 50), repeat),
+            "write_final": time_stage(
+                lambda: write_final(rad_file, wavelength, radiance, header=radiance_cal.header_string), repeat),
+            "write_label": time_stage(
+                lambda: write_label(os.path.join(out_dir, "cl5_404238503rad_f0050104ccam02076p1.xml"), label, True),
+                repeat),
+            "rad_calibrate_file": time_stage(
+                quietly(lambda: RadianceCalibration(logfile).calibrate_file(psv_file, out_dir, True)), repeat),
+            "ref_calibrate_file": time_stage(
+                quietly(lambda: RelativeReflectanceCalibration(logfile).calibrate_file(psv_file, None, out_dir, True,
+                                                                                       True, True, True)), repeat),
+        }
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    startup_imports = {}
+    if startup:
+        (startup_stages, startup_imports) = time_startup(repeat)
+        stages.update(startup_stages)
+
+    return {
+        "stages": stages,
+        "startup_imports": startup_imports,
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "machine": platform.machine()
+        }
+    }
+
+
+def compare(results, baseline, threshold=default_threshold):
+    """compare
+    compare the median time of each stage with a baseline
+
+    :param results: the results of run_benchmarks
+    :param baseline: results loaded from a baseline JSON file. Its optional "thresholds"
+        dictionary sets the threshold of single stages.
+    :param threshold: the allowed slowdown, as a fraction (0.25 = 25% slower)
+    :return: (stage, baseline median, median, ratio, regressed) for each stage in both
+    """
+    thresholds = baseline.get("thresholds", {})
+    comparison = []
+    for (stage, timing) in results["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        base = baseline["stages"][stage]["median"]
+        ratio = timing["median"] / base if base > 0 else float('inf')
+        regressed = ratio > 1 + thresholds.get(stage, threshold)
+        comparison.append((stage, base, timing["median"], ratio, regressed))
+    return comparison
+
+
+def print_results(results, comparison=None):
+    """print_results
+    print the median time of each stage, and its change from the baseline
+    """
+    changes = {} if comparison is None else {row[0]: row for row in comparison}
+    for (stage, timing) in results["stages"].items():
+        line = "{:<26}{:>12.3f} ms".format(stage, timing["median"] * 1000)
+        if stage in changes:
+            (stage, base, median, ratio, regressed) = changes[stage]
+            line += "   baseline {:>10.3f} ms   {:+7.1%}{}".format(base * 1000, ratio - 1,
+                                                                   "   REGRESSION" if regressed else "")
+        print(line)
+    for (stage, modules) in results.get("startup_imports", {}).items():
+        if modules:
+            print("{} imports {}".format(stage, ", ".join(modules)))
+
+
+if __name__ == "__main__":
+    from ccam_prospect.cli import main
+    main(["bench"] + sys.argv[1:])
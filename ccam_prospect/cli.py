@@ -0,0 +1,317 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+from ccam_prospect.utils.InputType import InputType
+
+# Each subcommand imports what it needs when it runs, so that a command only pays for its own imports.
+
+
+class AddInput(argparse.Action):
+    """AddInput
+    an input option that can be given several times: each one adds (input type, name)
+    to the inputs of the run, in the order of the command line
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        inputs = list(getattr(namespace, self.dest) or [])
+        inputs.append((self.const, values))
+        setattr(namespace, self.dest, inputs)
+
+
+def input_options(description, catalog=True):
+    """input_options
+    the options giving the input files of a subcommand
+
+    :param description: the kind of file given with -f
+    :param catalog: accept a header catalog as input
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-f', action=AddInput, dest='inputs', const=InputType.FILE, metavar='CCAMFILE',
+                        help=description + " (may be repeated, as may -d and -l)")
+    parser.add_argument('-d', action=AddInput, dest='inputs', const=InputType.DIRECTORY, metavar='DIRECTORY',
+                        help="Directory containing .tab files")
+    parser.add_argument('-l', action=AddInput, dest='inputs', const=InputType.FILE_LIST, metavar='LIST',
+                        help="File with a list of .tab files")
+    if catalog:
+        parser.add_argument('--catalog', action=AddInput, dest='inputs', const=InputType.CATALOG,
+                            metavar='CATALOG', help="header catalog to select the files from")
+        parser.add_argument('--where', action="store", dest='where',
+                            help="condition selecting the files of the catalog, e.g. "
+                                 "\"exposure = 404 AND distance < 5\"")
+    parser.set_defaults(inputs=[], where=None)
+    return parser
+
+
+def jobs_options(help_text):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-j', '--jobs', action="store", dest='jobs', type=int, help=help_text)
+    parser.set_defaults(jobs=1)
+    return parser
+
+
+def calibration_options():
+    """calibration_options
+    the options shared by the rad and ref subcommands
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-o', action="store", dest='out_dir', help="directory to store the output files")
+    parser.add_argument('--atomic-write', action="store_true", dest='atomic_write',
+                        help="write each table to a temporary file and rename it when complete")
+    parser.add_argument('--format', action="store", dest='output_format', choices=["tab", "npz", "both"],
+                        help="write .tab tables, binary .npz files, or both (default tab)")
+    parser.add_argument('--incremental', action="store", dest='incremental', nargs='?', const="mtime",
+                        choices=["mtime", "hash"],
+                        help="only recalculate files whose input or calibration files changed, detecting changes "
+                             "to the input by modification time (default) or hash")
+    parser.add_argument('--metrics', action="store", dest='metrics',
+                        help="write the time spent in each stage and other counters to this JSON file")
+    parser.add_argument('--pipeline', action="store_true", dest='pipeline',
+                        help="read the next files and write the outputs on separate threads while calibrating")
+    parser.add_argument('-q', '--quiet', action="store_true", dest='quiet',
+                        help="print the number of files done periodically instead of a line for each file")
+    parser.add_argument('--cube', action="store", dest='cube',
+                        help="add each product to this spectra cube directory as it is written (created if needed)")
+    parser.set_defaults(atomic_write=False, output_format="tab", incremental=None, pipeline=False, quiet=False,
+                        cube=None)
+    return parser
+
+
+def make_parser():
+    """make_parser
+    the parser of the ccam-prospect command and its subcommands
+    """
+    parser = argparse.ArgumentParser(prog='ccam-prospect',
+                                     description='Calibrate ChemCam passive spectra from the command line')
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    calibration_jobs = jobs_options("number of files to calibrate in parallel (0 for one per CPU)")
+
+    rad = subparsers.add_parser('rad', help="calibrate PSV files to radiance",
+                                description='Calibrate CCAM to Radiance',
+                                parents=[input_options("CCAM psv *.tab file"), calibration_options(),
+                                         calibration_jobs])
+    rad.add_argument('--no-overwrite-rad', action="store_false", dest='overwrite',
+                     help="do not overwrite existing files")
+    rad.set_defaults(run=run_rad, command_parser=rad, overwrite=True)
+
+    ref = subparsers.add_parser('ref', help="calibrate PSV or RAD files to relative reflectance",
+                                description='Relative Reflectance Calibration',
+                                parents=[input_options("CCAM psv or rad *.tab file"), calibration_options(),
+                                         calibration_jobs])
+    ref.add_argument('-c', action="store", dest='customFile', help="custom calibration file")
+    ref.add_argument('--no-overwrite-rad', action="store_false", dest='overwrite_rad',
+                     help="do not overwrite existing RAD files")
+    ref.add_argument('--no-overwrite-ref', action="store_false", dest='overwrite_ref',
+                     help="do not overwrite existing REF files")
+    ref.add_argument('--smooth-vio', action="store_true", dest='smooth_vio',
+                     help="apply 51-channel filter to smooth VIO region")
+    ref.add_argument('--smooth-vis', action="store_true", dest='smooth_vis',
+                     help="apply 51-channel filter to smooth VIS region")
+    ref.add_argument('--emit-rad', action="store_true", dest='emit_rad',
+                     help="write the RAD files of PSV input (default)")
+    ref.add_argument('--no-emit-rad', action="store_false", dest='emit_rad',
+                     help="calibrate PSV input to REF without writing the RAD files")
+    ref.add_argument('--group-by-exposure', action="store_true", dest='group_exposure',
+                     help="read every header first, reject unsupported exposure times up front and calibrate "
+                          "the files of each exposure time together")
+    ref.set_defaults(run=run_ref, command_parser=ref, overwrite_rad=True, overwrite_ref=True, smooth_vis=False,
+                     smooth_vio=False, emit_rad=True, group_exposure=False)
+
+    index = subparsers.add_parser('index', help="index the headers of a PSV archive in a SQLite catalog",
+                                  description='Index the headers of a PSV archive in a SQLite catalog',
+                                  parents=[jobs_options("number of processes reading headers (0 for one per CPU)")])
+    index.add_argument('-c', '--catalog', action="store", dest='catalog', help="catalog file (created if needed)")
+    index.add_argument('-d', action="append", dest='directories', metavar='DIRECTORY',
+                       help="Directory containing PSV files to index (may be repeated)")
+    index.add_argument('-w', '--where', action="store", dest='where',
+                       help="print the files matching this condition, e.g. \"exposure = 404 AND distance < 5\"")
+    index.set_defaults(run=run_index, command_parser=index, directories=[])
+
+    bench = subparsers.add_parser('bench', help="time each stage of the calibration",
+                                  description='Time each stage of the calibration')
+    bench.add_argument('-n', action="store", dest='repeat', type=int, help="number of runs of each stage")
+    bench.add_argument('-o', action="store", dest='output', help="JSON file to write the results to")
+    bench.add_argument('-b', '--baseline', action="store", dest='baseline',
+                       help="JSON file of baseline results to compare with")
+    bench.add_argument('-t', '--threshold', action="store", dest='threshold', type=float,
+                       help="allowed slowdown compared to the baseline, as a fraction (default 0.25)")
+    bench.add_argument('--no-startup', action="store_false", dest='startup',
+                       help="do not time the start of a command line run")
+    bench.set_defaults(run=run_bench, command_parser=bench, repeat=20, threshold=None, startup=True)
+
+    plot = subparsers.add_parser('plot-export', help="plot REF files to an image file",
+                                 description='Plot relative reflectance spectra to an image file',
+                                 parents=[input_options("REF *.tab or *.npz file", catalog=False)])
+    plot.add_argument('-o', action="store", dest='output', help="image file to write")
+    plot.add_argument('--format', action="store", dest='image_format',
+                      help="image format, such as png, pdf or svg (default: from the name of the image file)")
+    plot.add_argument('--title', action="store", dest='title', help="title of the plot")
+    plot.add_argument('--no-legend', action="store_false", dest='legend', help="do not show the legend")
+    plot.set_defaults(run=run_plot_export, command_parser=plot, title="", legend=True)
+    return parser
+
+
+def main(argv=None):
+    """main
+    the ccam-prospect command
+
+    :param argv: the command line arguments (sys.argv[1:] if None)
+    """
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    args.run(args)
+
+
+def output_directory(out_dir):
+    """output_directory
+    the output directory of a calibration, ending with '/' (None for the directory of each input).
+    Exits if the directory does not exist.
+    """
+    if out_dir is None:
+        return None
+    if not out_dir.endswith('/'):
+        out_dir = out_dir + '/'
+    if not os.path.isdir(out_dir):
+        print('output directory: ' + out_dir + ' does not exist. Please enter an existing directory.')
+        sys.exit(1)
+    return out_dir
+
+
+def log_filename():
+    return "badInput_{}.log".format(datetime.now().strftime("%Y%m%d.%H%M%S"))
+
+
+def make_run_log(args, logfile, product):
+    """make_run_log
+    the run log of a calibration, which adds the products of the run to the cube given with --cube
+
+    :param args: the parsed arguments
+    :param logfile: the log file
+    :param product: the kind of product added to the cube, "rad" or "ref"
+    """
+    from ccam_prospect.utils.RunLog import RunLog
+    cube = None
+    if args.cube is not None:
+        from ccam_prospect.spectraCube import SpectraCube
+        cube = SpectraCube(args.cube)
+    return RunLog(logfile, quiet=args.quiet, cube=cube, cube_product=product)
+
+
+def calibrate_inputs(args, calibration, calibrate):
+    """calibrate_inputs
+    calibrate every input of the command line in this process with the same calibration
+    object, so the calibration values are loaded once for all of them.  With several jobs
+    they are loaded before the first worker process is started, and every worker starts
+    with them.  A summary is printed after each input, and the command exits with status 1
+    if an input could not be read at all (see RunLog.input_failed).
+
+    :param args: the parsed arguments
+    :param calibration: the RadianceCalibration or RelativeReflectanceCalibration
+    :param calibrate: a function of the input type and name calibrating one input
+    """
+    from ccam_prospect.utils.ProcessPool import get_job_count
+    if not args.inputs:
+        args.command_parser.print_help(sys.stderr)
+        sys.exit(1)
+    if args.where is not None and not any(file_type is InputType.CATALOG for (file_type, name) in args.inputs):
+        args.command_parser.error("--where selects the files of a catalog: give the catalog with --catalog")
+    if get_job_count(args.jobs) > 1:
+        calibration.load_assets()
+    for (file_type, name) in args.inputs:
+        calibrate(file_type, name)
+    if calibration.metrics.enabled:
+        calibration.metrics.write(args.metrics)
+    if calibration.run_log.failed_inputs:
+        # a missing directory, list or catalog, or an invalid catalog query
+        sys.exit(1)
+
+
+def run_rad(args):
+    from ccam_prospect.radianceCalibration import RadianceCalibration
+    from ccam_prospect.utils.Metrics import Metrics
+    out_directory = output_directory(args.out_dir)
+    logfile = log_filename()
+    calibration = RadianceCalibration(logfile, atomic_write=args.atomic_write, output_format=args.output_format,
+                                      incremental=args.incremental,
+                                      metrics=Metrics() if args.metrics is not None else None,
+                                      pipeline=args.pipeline, run_log=make_run_log(args, logfile, "rad"))
+    calibrate_inputs(args, calibration, lambda file_type, name: calibration.calibrate_to_radiance(
+        file_type, name, out_directory, args.overwrite, args.jobs, args.where))
+
+
+def run_ref(args):
+    from ccam_prospect.relativeReflectanceCalibration import RelativeReflectanceCalibration
+    from ccam_prospect.utils.Metrics import Metrics
+    out_directory = output_directory(args.out_dir)
+    logfile = log_filename()
+    calibration = RelativeReflectanceCalibration(logfile, emit_rad=args.emit_rad, atomic_write=args.atomic_write,
+                                                 output_format=args.output_format, incremental=args.incremental,
+                                                 metrics=Metrics() if args.metrics is not None else None,
+                                                 pipeline=args.pipeline,
+                                                 run_log=make_run_log(args, logfile, "ref"),
+                                                 group_exposure=args.group_exposure)
+    calibrate_inputs(args, calibration, lambda file_type, name: calibration.calibrate_relative_reflectance(
+        file_type, name, args.customFile, out_directory, args.overwrite_rad, args.overwrite_ref, args.smooth_vio,
+        args.smooth_vis, args.jobs, args.where))
+
+
+def run_index(args):
+    from ccam_prospect.headerCatalog import HeaderCatalog
+    if args.catalog is None or (not args.directories and args.where is None):
+        args.command_parser.print_help(sys.stderr)
+        sys.exit(1)
+    with HeaderCatalog(args.catalog) as catalog:
+        for directory in args.directories:
+            (read, removed) = catalog.index(directory, args.jobs)
+            print('{} files read, {} removed, {} in {}'.format(read, removed, len(catalog), args.catalog))
+        if args.where is not None:
+            for path in catalog.query(args.where):
+                print(path)
+
+
+def run_bench(args):
+    from ccam_prospect.benchmark import run_benchmarks, compare, print_results, default_threshold
+    benchmark_results = run_benchmarks(args.repeat, startup=args.startup)
+
+    stage_comparison = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as bf:
+            threshold = args.threshold if args.threshold is not None else default_threshold
+            stage_comparison = compare(benchmark_results, json.load(bf), threshold)
+        benchmark_results["comparison"] = {
+            stage: {"baseline": base, "median": median, "ratio": ratio, "regressed": regressed}
+            for (stage, base, median, ratio, regressed) in stage_comparison}
+    print_results(benchmark_results, stage_comparison)
+
+    if args.output is not None:
+        with open(args.output, 'w') as of:
+            json.dump(benchmark_results, of, indent=2)
+
+    if stage_comparison is not None and any(row[4] for row in stage_comparison):
+        sys.exit(1)
+
+
+def run_plot_export(args):
+    from ccam_prospect.plotpanel import export_plot, list_plot_files
+    if not args.inputs or args.output is None:
+        args.command_parser.print_help(sys.stderr)
+        sys.exit(1)
+    files = []
+    for (file_type, name) in args.inputs:
+        if file_type is InputType.DIRECTORY:
+            files.extend(list_plot_files(name))
+        elif file_type is InputType.FILE_LIST:
+            with open(name) as f:
+                files.extend(line.strip() for line in f if line.strip())
+        else:
+            files.append(name)
+    plotted = export_plot(files, args.output, args.title, args.legend, args.image_format)
+    print('{} spectra plotted to {}'.format(plotted, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import os
+import sqlite3
+import sys
+from ccam_prospect.utils.Utilities import get_header_values, integration_time, is_psv_file, walk_files
+from ccam_prospect.utils.ProcessPool import get_job_count
+from ccam_prospect.spectraCube import get_obs_id, get_sclk, get_sol
+
+# columns of the catalog, one row per PSV file
+catalog_columns = ["path", "obs_id", "sclk", "sol", "ipbc", "ict", "exposure", "distance", "valid", "mtime", "size"]
+
+# rows written to the catalog per transaction while indexing
+commit_rows = 500
+
+# files whose headers are read by a worker process at a time
+index_chunk_size = 64
+
+_schema = """
+CREATE TABLE IF NOT EXISTS headers (
+    path TEXT PRIMARY KEY,
+    obs_id TEXT,
+    sclk INTEGER,
+    sol INTEGER,
+    ipbc REAL,
+    ict REAL,
+    exposure INTEGER,
+    distance REAL,
+    valid INTEGER,
+    mtime REAL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS headers_exposure ON headers (exposure);
+CREATE INDEX IF NOT EXISTS headers_sclk ON headers (sclk);
+"""
+
+
+class HeaderCatalog:
+    """HeaderCatalog
+    the header values of every PSV file of an archive, stored in a SQLite database so
+    files can be selected without opening them again.  Each row holds the IPBC and ICT
+    divisors, the exposure time (ms, rounded), the distance to target (m), the sclk,
+    observation id and sol from the file name and path, and whether the header is
+    valid (has the divisors and distance used by the calibration).
+
+    A file is read again only when its size or modification time changed since it was indexed.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript(_schema)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM headers").fetchone()[0]
+
+    def index(self, directory, jobs=1):
+        """index
+        add the PSV files of the directory (and its subdirectories) to the catalog.
+        New and changed files are read, files that no longer exist are removed.
+
+        :param directory: the directory of PSV files
+        :param jobs: the number of worker processes reading headers (0 for one per CPU)
+        :return: the number of files read, and the number of files removed
+        """
+        directory = os.path.abspath(directory)
+        known = {path: (mtime, size) for (path, mtime, size)
+                 in self.connection.execute("SELECT path, mtime, size FROM headers")}
+        seen = set()
+        changed = []
+        for file in walk_files(directory, accept=is_psv_file):
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                # removed while the directory is walked
+                continue
+            seen.add(file)
+            if known.get(file) != (stat.st_mtime, stat.st_size):
+                changed.append(file)
+
+        jobs = get_job_count(jobs)
+        if jobs > 1 and len(changed) > index_chunk_size:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                self.add_rows(executor.map(read_entry, changed, chunksize=index_chunk_size))
+        else:
+            self.add_rows(map(read_entry, changed))
+
+        # files of this directory that were indexed before but are gone
+        prefix = os.path.join(directory, '')
+        removed = [(path,) for path in known if path.startswith(prefix) and path not in seen]
+        with self.connection:
+            self.connection.executemany("DELETE FROM headers WHERE path = ?", removed)
+        return len(changed), len(removed)
+
+    def add_rows(self, rows):
+        """add_rows
+        write catalog rows (as returned by read_entry), replacing the rows of the same files.
+        None rows (files removed before they were read) are left out.
+        """
+        statement = "INSERT OR REPLACE INTO headers ({}) VALUES ({})".format(
+            ", ".join(catalog_columns), ", ".join("?" * len(catalog_columns)))
+        batch = []
+        for row in rows:
+            if row is None:
+                continue
+            batch.append(row)
+            if len(batch) >= commit_rows:
+                with self.connection:
+                    self.connection.executemany(statement, batch)
+                batch = []
+        with self.connection:
+            self.connection.executemany(statement, batch)
+
+    def query(self, where=None, parameters=()):
+        """query
+        the files matching a condition on the columns of the catalog, for example
+        "exposure = 404 AND distance < 5"
+
+        :param where: an SQL condition, or None for every file
+        :param parameters: values of the ? placeholders of the condition
+        :return: the paths of the matching files, sorted
+        """
+        statement = "SELECT path FROM headers"
+        if where:
+            statement += " WHERE " + where
+        return [path for (path,) in self.connection.execute(statement + " ORDER BY path", parameters)]
+
+
+def read_entry(filename):
+    """read_entry
+    the catalog row of a PSV file: its header values, and its name, size and modification time.
+    A file that can not be read is indexed as invalid, without a modification time so that
+    it is read again by the next index.
+
+    :return: the row, or None if the file no longer exists
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    mtime = stat.st_mtime
+    try:
+        headers = get_header_values(filename)
+    except UnicodeDecodeError:
+        # not a text file, indexed as invalid
+        headers = {}
+    except FileNotFoundError:
+        return None
+    except OSError:
+        headers = {}
+        mtime = None
+    ipbc = to_float(headers.get('IPBCdivisor'))
+    ict = to_float(headers.get('ICTdivisor'))
+    distance = to_float(headers.get('distToTarget'))
+    exposure = None
+    if ipbc is not None and ict is not None:
+        exposure = round(integration_time(ipbc, ict) * 1000)
+    valid = exposure is not None and distance is not None
+    sclk = get_sclk(filename)
+    sol = get_sol(filename)
+    return (filename, get_obs_id(filename), int(sclk) if sclk else None, int(sol) if sol else None, ipbc, ict,
+            exposure, distance, int(valid), mtime, stat.st_size)
+
+
+def to_float(value):
+    """to_float
+    the header value as a number, or None if it is missing or not a number
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    from ccam_prospect.cli import main
+    main(["index"] + sys.argv[1:])
@@ -5,8 +5,11 @@ from datetime import datetime
 from ccam_prospect.utils.InputType import InputType, input_type_switcher
 from ccam_prospect.relativeReflectanceCalibration import RelativeReflectanceCalibration
 from ccam_prospect.radianceCalibration import RadianceCalibration
-from ccam_prospect.plotpanel import PlotPanel
 from ccam_prospect.utils.CustomExceptions import CancelExecutionException, InputFileNotFoundException
+from ccam_prospect.utils.BackgroundTask import BackgroundTask, progress_text
+
+# how often the GUI checks the progress of a running calibration (ms)
+poll_interval = 100
 
 class MainApplication:
 
@@ -25,6 +28,7 @@ class MainApplication:
         # set up the calibration environments and the progress monitor
         self.radiance_cal = RadianceCalibration(self.logfile, self)
         self.relative_cal = RelativeReflectanceCalibration(self.logfile, self)
+        self.task = None  # the calibration running in the background, if any
         self.window = root_window
         self.progress_var = tk.IntVar()
         self.overwrite_rad = tk.IntVar()
@@ -91,10 +95,12 @@ class MainApplication:
                                               command=self.start_rad)
         self.calibrate_button = tk.Button(root_window, text="Calibrate to REF", width=20,
                                           command=self.start_calibration)
+        self.cancel_button = tk.Button(root_window, text="Cancel", state="disabled", command=self.cancel_clicked)
 
-        # progress bar
+        # progress bar, and the throughput and time left of a running calibration
         self.progress = ttk.Progressbar(root_window, orient=tk.HORIZONTAL, length=100, mode='determinate',
                                         var=self.progress_var, maximum=100)
+        self.status_label = tk.Label(root_window, text="")
 
         # plotting
         self.separator4 = ttk.Separator(root_window, orient="horizontal")
@@ -135,10 +141,12 @@ class MainApplication:
         self.smooth_vis_button.grid(column=3, row=17, columnspan=1, sticky="w", pady=(5, 0), padx=(5, 10))
         self.calibrate_rad_button.grid(column=0, row=18, columnspan=2, sticky="w", pady=(5, 0), padx=(20, 5))
         self.calibrate_button.grid(column=2, row=18, columnspan=2, sticky="w", pady=(5, 0), padx=(5, 10))
-        self.progress.grid(column=0, row=19, columnspan=5, sticky="ew", pady=(10, 10), padx=(5, 5))
+        self.cancel_button.grid(column=4, row=18, sticky="w", pady=(5, 0), padx=(1, 10))
+        self.progress.grid(column=0, row=19, columnspan=5, sticky="ew", pady=(10, 0), padx=(5, 5))
+        self.status_label.grid(column=0, row=20, columnspan=5, sticky="w", pady=(0, 10), padx=(5, 5))
 
-        self.separator4.grid(column=0, row=20, columnspan=5, sticky="ew", pady=(10,10))
-        self.plot_button.grid(column=0, row=21, columnspan=5, sticky="ew", pady=(10,10))
+        self.separator4.grid(column=0, row=21, columnspan=5, sticky="ew", pady=(10,10))
+        self.plot_button.grid(column=0, row=22, columnspan=5, sticky="ew", pady=(10,10))
 
     def browse_clicked(self):
         """browse_clicked
@@ -211,6 +219,68 @@ class MainApplication:
         self.progress.update()
         self.window.update_idletasks()
 
+    def run_in_background(self, calibration, function, *args):
+        """run_in_background
+        run a calibration on a worker thread.  The GUI stays responsive: progress and
+        warnings are read from the task every poll_interval ms (see poll_task).
+
+        :param: calibration the calibration object that is run
+        :param: function the method of the calibration to call
+        :param: args the arguments of function
+        """
+        self.task = BackgroundTask(calibration, function, *args)
+        calibration.main_app = self.task
+        self.calibrate_rad_button.config(state="disabled")
+        self.calibrate_button.config(state="disabled")
+        self.cancel_button.config(state="normal")
+        self.progress_var.set(0)
+        self.status_label.config(text="")
+        self.task.start()
+        self.window.after(poll_interval, self.poll_task)
+
+    def poll_task(self):
+        """poll_task
+        handle the messages of the running calibration, on the GUI thread
+        """
+        task = self.task
+        for message in task.messages():
+            if message[0] == "progress":
+                (kind, value, files_done, total_files, seconds) = message
+                self.progress_var.set(value)
+                self.status_label.config(text=progress_text(files_done, total_files, seconds))
+            elif message[0] == "warning":
+                task.answer(self.show_warning_dialog(message[1]))
+            elif message[0] == "done":
+                self.finish_task(message[1])
+                return
+        self.window.after(poll_interval, self.poll_task)
+
+    def finish_task(self, error):
+        """finish_task
+        report how the calibration ended and enable the calibration buttons again
+        """
+        self.task.calibration.main_app = self
+        self.task = None
+        self.calibrate_rad_button.config(state="normal")
+        self.calibrate_button.config(state="normal")
+        self.cancel_button.config(state="disabled")
+        if isinstance(error, InputFileNotFoundException):
+            messagebox.showinfo('Error', 'The input file ({}) does not exist'.format(error.file))
+        elif isinstance(error, CancelExecutionException):
+            messagebox.showinfo('Cancel', 'You have chosen to cancel. The calibration will not continue.')
+        elif error is not None:
+            messagebox.showinfo('Error', 'The calibration stopped: {}'.format(error))
+        print('******** finished calibration ********')
+
+    def cancel_clicked(self):
+        """cancel_clicked
+        the action handler for the cancel button: stop the running calibration after the current file
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.cancel_button.config(state="disabled")
+            self.status_label.config(text="cancelling...")
+
     def start_calibration(self):
         """start_calibration
         gather variables and start the relative reflectance calibration
@@ -231,16 +301,10 @@ class MainApplication:
                     messagebox.showinfo('Error', 'The output directory file ({}) does not exist. '
                                                  'Please choose a different output directory'.format(out_dir))
                     return
-        try:
-            # the call to calibrate to relative reflectance
-            self.relative_cal.calibrate_relative_reflectance(file_type, file, custom_directory, out_dir,
-                                                             self.overwrite_rad.get(), self.overwrite_ref.get(),
-                                                             self.smooth_vio.get(), self.smooth_vis.get())
-        except InputFileNotFoundException as ife:
-            messagebox.showinfo('Error', 'The input file ({}) does not exist'.format(ife.file))
-        except CancelExecutionException:
-            messagebox.showinfo('Cancel', 'You have chosen to cancel. The calibration will not continue.')
-        print('******** finished calibration ********')
+        # the call to calibrate to relative reflectance
+        self.run_in_background(self.relative_cal, self.relative_cal.calibrate_relative_reflectance, file_type, file,
+                               custom_directory, out_dir, self.overwrite_rad.get(), self.overwrite_ref.get(),
+                               self.smooth_vio.get(), self.smooth_vis.get())
 
     def start_rad(self):
         """start_rad
@@ -260,11 +324,8 @@ class MainApplication:
                     messagebox.showinfo('Error', 'The output directory file ({}) does not exist. '
                                                  'Please choose a different output directory'.format(out_dir))
                     return
-        try:
-            self.radiance_cal.calibrate_to_radiance(file_type, file, out_dir, self.overwrite_rad.get())
-        except InputFileNotFoundException as ife:
-            messagebox.showinfo('Error', 'The input file ({}) does not exist'.format(ife.file))
-        print('******** finished calibration ********')
+        self.run_in_background(self.radiance_cal, self.radiance_cal.calibrate_to_radiance, file_type, file, out_dir,
+                               self.overwrite_rad.get())
 
     def open_plots(self):
         """open_plots
@@ -274,6 +335,8 @@ class MainApplication:
         new_win = tk.Toplevel(self.window)
         def handler(): self.on_close_other_frame(new_win)
         btn = tk.Button(new_win, text="<< Back to Calibration", command=handler)
+        # matplotlib is only imported once the plots are opened
+        from ccam_prospect.plotpanel import PlotPanel
         PlotPanel(new_win, btn)
 
     def on_close_other_frame(self, other_frame):
@@ -1,12 +1,138 @@
 import tkinter as tk
+from tkinter import messagebox, simpledialog
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 # Implement the default Matplotlib key bindings.
 from matplotlib.figure import Figure, GridSpec
 from matplotlib import pyplot
+import itertools
 import os
+import queue
+import threading
+from collections import OrderedDict
 from ccam_prospect.utils.InputType import InputType, input_type_switcher
 import numpy as np
 import ccam_prospect.utils.Utilities as utils
+from ccam_prospect.utils.SpectrumFile import read_npz, parse_columns
+
+# channels of a REF spectrum that are plotted: 400 to 467 nm (VIO) and 477 to 840 nm (VIS)
+plot_channels = (2429, 5810)
+vio_channels = (2429, 4039)
+vis_channels = (4121, 5810)
+
+# number of files whose plotted values are kept in memory
+plot_cache_size = 512
+
+# how often the plot checks for files read in the background (ms)
+poll_interval = 50
+
+# plotted values of the most recently read files, least recently used first.
+# path -> (modification times of the file and its .smooth file, (x, y, vis_smoothed))
+_plot_cache = OrderedDict()
+_plot_cache_lock = threading.Lock()
+
+
+def get_mtime(path):
+    """get_mtime
+    the modification time of a file, or None if it does not exist
+    """
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def decimate(x, y, width):
+    """decimate
+    reduce a spectrum to what can be seen on a plot width pixels wide: the channels are
+    split into about width groups, and only the lowest and highest value of each group
+    are kept, so peaks and dips still show.  Gaps (NaN values) are kept.
+
+    :param x: the x values, in increasing order
+    :param y: the y values
+    :param width: the width of the plot in pixels
+    :return: the x and y values to draw
+    """
+    n = len(y)
+    size = int(np.ceil(n / max(int(width), 1)))
+    if size <= 2:
+        return x, y
+    groups = -(-n // size)
+    padded = np.full(groups * size, np.nan)
+    padded[:n] = y
+    blocks = padded.reshape(groups, size)
+    finite = ~np.isnan(blocks)
+    starts = np.arange(groups) * size
+    lowest = starts + np.where(finite, blocks, np.inf).argmin(axis=1)
+    highest = starts + np.where(finite, blocks, -np.inf).argmax(axis=1)
+    # the first NaN of each group breaks the line where the spectrum has a gap
+    first_gap = starts + finite.argmin(axis=1)
+    gaps = first_gap[~finite.all(axis=1)]
+    indices = np.unique(np.concatenate([lowest, highest, gaps[gaps < n]]))
+    return x[indices], y[indices]
+
+
+def list_plot_files(directory):
+    """list_plot_files
+    the spectra files of a directory (not its subdirectories) that can be plotted, sorted by name.
+    .npz files are only listed when there is no .tab file of the same spectrum.
+    """
+    with os.scandir(directory) as entries:
+        names = sorted(entry.name for entry in entries)
+    files = []
+    for file_name in names:
+        if file_name.lower().endswith(".tab") or \
+                (file_name.lower().endswith(".npz") and file_name[:-4] + ".tab" not in names and
+                 file_name[:-4] + ".TAB" not in names):
+            files.append(os.path.join(directory, file_name))
+    return files
+
+
+def export_plot(files, out_file, title="", legend=True, image_format=None):
+    """export_plot
+    plot REF files and save the plot as an image, without opening a window.  The plot
+    looks like the one of the plotting window: 400 to 840 nm, relative reflectance
+    from 0 to 1 (or less when the spectra allow it) and a legend on the right.
+
+    :param files: the files to plot (files that are not REF files are ignored)
+    :param out_file: the image file
+    :param title: the title of the plot
+    :param legend: show the legend
+    :param image_format: the image format (png, pdf, svg, ...), taken from the name of out_file if None
+    :return: the number of spectra plotted
+    """
+    fig = Figure(figsize=(10, 4), dpi=100)
+    fig.text(.14, 0.75, '(VIO region\nsmoothed)', fontsize=10)
+    axes = fig.add_subplot(GridSpec(1, 2, width_ratios=[3.5, 1])[0, 0])
+    axes.set_ylabel('Relative Reflectance')
+    axes.set_xlabel('Wavelength (nm)')
+
+    plotted = 0
+    vis_smoothed = False
+    for file in files:
+        if "ref" not in file and "REF" not in file:
+            continue
+        try:
+            (x, y, smoothed) = PlotPanel.read_file(file)
+        except (OSError, ValueError) as e:
+            print(file + ': could not be read. ' + str(e))
+            continue
+        filename = os.path.basename(file)
+        short_name = "{}_{}".format(filename[0:13], filename[29:34])
+        axes.plot(*decimate(x, y, axes.bbox.width), label=short_name)
+        vis_smoothed = vis_smoothed or smoothed
+        plotted += 1
+
+    (bottom, top) = axes.get_ylim()
+    axes.set_ylim(max(bottom, 0), min(top, 1))
+    axes.set_xlim(400, 840)
+    axes.set_title(title)
+    if vis_smoothed:
+        fig.text(.57, 0.15, '(VIS region\nsmoothed)', fontsize=10)
+    if legend and plotted:
+        axes.legend(bbox_to_anchor=(1.01, 1), loc='upper left', borderaxespad=0., ncol=2 if plotted > 20 else 1,
+                    fontsize=7)
+    fig.savefig(out_file, format=image_format)
+    return plotted
 
 
 class PlotPanel(tk.Frame):
@@ -25,6 +151,8 @@ class PlotPanel(tk.Frame):
 
         self.filename_dict = {}
         self.lines_dict = {}
+        self.spectra_dict = {}    # all the values of each plotted line, which are drawn decimated
+        self.decimated_xlim = None
         self.show_legend = tk.IntVar()
 
         self.file_box_frame = tk.Frame(self.window)
@@ -51,6 +179,7 @@ class PlotPanel(tk.Frame):
 
         self.add_file_button = tk.Button(self.add_remove_frame, text="Add REF Files", command=self.add_files)
         self.rm_file_button = tk.Button(self.add_remove_frame, text="  Remove Selected  ", command=self.remove_file)
+        self.add_cube_button = tk.Button(self.add_remove_frame, text="Add From Cube...", command=self.add_from_cube)
 
         self.fig = Figure(figsize=(10, 4), dpi=100)
         self.fig.text(.14, 0.75, '(VIO region\nsmoothed)', fontsize=10)
@@ -102,6 +231,7 @@ class PlotPanel(tk.Frame):
         self.directoryBtn.grid(row=1, column=2)
         self.add_file_button.grid(row=0, column=0, columnspan=3, padx=(10, 10), pady=(10, 10), sticky="ew")
         self.rm_file_button.grid(row=0, column=3, padx=(5, 10), pady=(10, 10), sticky="ew")
+        self.add_cube_button.grid(row=2, column=0, columnspan=4, padx=(10, 10), pady=(0, 10), sticky="ew")
 
         self.add_remove_frame.grid(row=3, column=0)
         self.close_button.grid(row=4, column=0, columnspan=4, padx=(0, 10), pady=(5, 10), sticky="ews")
@@ -126,10 +256,40 @@ class PlotPanel(tk.Frame):
 
     @staticmethod
     def read_file(file_name):
+        """read_file
+        the plotted values of a REF file.  The values of the most recently used files
+        are cached until the file (or its .smooth file) is modified.
+
+        :param file_name: the REF .tab or .npz file
+        :return: the x and y values to plot, and whether the VIS region was smoothed
+        """
+        path = os.path.abspath(file_name)
+        state = (os.stat(path).st_mtime_ns, get_mtime(path + ".smooth"))
+        with _plot_cache_lock:
+            cached = _plot_cache.get(path)
+            if cached is not None and cached[0] == state:
+                _plot_cache.move_to_end(path)
+                return cached[1]
+
+        (x, y, vis_smoothed) = PlotPanel.parse_file(file_name)
+        x.setflags(write=False)
+        y.setflags(write=False)
+        with _plot_cache_lock:
+            _plot_cache[path] = (state, (x, y, vis_smoothed))
+            if len(_plot_cache) > plot_cache_size:
+                _plot_cache.popitem(last=False)
+        return x, y, vis_smoothed
+
+    @staticmethod
+    def parse_file(file_name):
         # TODO check if already smoothed; add label to plot if so
-        x = []
-        y = []
-        vis_smoothed = False
+        if file_name.lower().endswith(".npz"):
+            # binary file, the smoothing options are stored in the file
+            spectrum = read_npz(file_name)
+            vio_smoothed = bool(spectrum.smooth_vio)
+            vis_smoothed = bool(spectrum.smooth_vis)
+            x, y = PlotPanel.get_plot_values(spectrum.wavelength, spectrum.values, vio_smoothed)
+            return x, y, vis_smoothed
 
         smooth_file = file_name + ".smooth"
         try:
@@ -143,28 +303,48 @@ class PlotPanel(tk.Frame):
             vis_smoothed = False
 
         with open(file_name) as f:
-            # only plot data in the following ranges: 400 to 467nm, 477 to 840 nm
-            # for 400 to 467 nm, use a 51-channel filter
-            lines = f.readlines()
-            all_data = [line for index, line in enumerate(lines) if 2428 < index < 5810]
-            smooth_data = [line for index, line in enumerate(lines) if 2428 < index < 4039]
-            other_data = [line for index, line in enumerate(lines) if 4120 < index < 5810]
-
-            # smooth the data between 400 and 467
-            if vio_smoothed:
-                # already smoothed
-                y_smoothed = utils.extract_floats(smooth_data, 1)
-            else:
-                # need to smooth
-                y_smoothed = utils.moving_median_smoothing(utils.extract_floats(smooth_data, 1), 50)
+            # only read and parse the lines that are plotted
+            lines = list(itertools.islice(f, plot_channels[1]))
+            columns = parse_columns(lines[plot_channels[0]:plot_channels[1]])
+            wavelength = np.full(plot_channels[1], np.nan)
+            values = np.full(plot_channels[1], np.nan)
+            wavelength[plot_channels[0]:] = columns[:, 0]
+            values[plot_channels[0]:] = columns[:, 1]
+            x, y = PlotPanel.get_plot_values(wavelength, values, vio_smoothed)
 
-            # get non-smoothed data and combine with smoothed data
-            y = np.concatenate((y_smoothed, np.full(shape=82, fill_value=np.nan), utils.extract_floats(other_data, 1)))
+        return x, y, vis_smoothed
 
-            # get x data from each set and combine
-            x = utils.extract_floats(all_data, 0)
+    @staticmethod
+    def get_plot_values(wavelength, values, vio_smoothed):
+        """get_plot_values
+        the part of a REF spectrum that is plotted
+
+        :param wavelength: the wavelength of each channel
+        :param values: the reflectance of each channel
+        :param vio_smoothed: the VIO region was already smoothed
+        :return: the x and y values to plot
+        """
+        # only plot data in the following ranges: 400 to 467nm, 477 to 840 nm
+        # for 400 to 467 nm, use a 51-channel filter
+        smooth_data = values[vio_channels[0]:vio_channels[1]]
+        other_data = values[vis_channels[0]:vis_channels[1]]
+
+        # smooth the data between 400 and 467
+        if vio_smoothed:
+            # already smoothed
+            y_smoothed = np.array(smooth_data)
+        else:
+            # need to smooth
+            y_smoothed = utils.moving_median_smoothing(smooth_data, 50)
 
-        return x, y, vis_smoothed
+        # get non-smoothed data and combine with smoothed data
+        gap = vis_channels[0] - vio_channels[1]
+        y = np.concatenate((y_smoothed, np.full(shape=gap, fill_value=np.nan), other_data))
+
+        # get x data from each set and combine
+        x = np.array(wavelength[plot_channels[0]:plot_channels[1]])
+
+        return x, y
 
     def add_files(self):
         # open file or directory?
@@ -179,13 +359,12 @@ class PlotPanel(tk.Frame):
         """add_file
         """
         # open file chooser, select file
-        ftypes = [('TAB files', ('*.tab', '*.TAB'))]
+        ftypes = [('TAB files', ('*.tab', '*.TAB')), ('NPZ files', ('*.npz', '*.NPZ'))]
         files = tk.filedialog.askopenfilenames(filetypes=ftypes)
 
         # add file to list
         list_of_files = self.window.tk.splitlist(files)
-        for current_file in list_of_files:
-            self.plot_file(current_file)
+        self.plot_files(list_of_files)
 
     def add_directory(self):
         """add_directory
@@ -193,32 +372,143 @@ class PlotPanel(tk.Frame):
         # open file chooser, select file
         directory = tk.filedialog.askdirectory()
         if directory:
-            for file_name in os.listdir(directory):
-                if file_name.endswith(".tab") or file_name.endswith(".TAB"):
-                    current_file = os.path.join(directory, file_name)
-                    self.plot_file(current_file)
+            self.plot_files(list_plot_files(directory))
+
+    def add_from_cube(self):
+        """add_from_cube
+        plot the REF spectra of a spectra cube (see spectraCube), chosen by sol
+        """
+        directory = tk.filedialog.askdirectory(title="Spectra cube directory")
+        if not directory:
+            return
+        from ccam_prospect.spectraCube import SpectraCube, index_name
+        if not os.path.isfile(os.path.join(directory, index_name)):
+            messagebox.showinfo('Error', 'The directory ({}) is not a spectra cube'.format(directory))
+            return
+        selection = simpledialog.askstring("Add From Cube", "Sols to plot, separated by commas (empty for every sol):",
+                                           parent=self.window)
+        if selection is None:
+            return
+        try:
+            sols = [int(sol) for sol in selection.split(",") if sol.strip()]
+        except ValueError:
+            messagebox.showinfo('Error', 'Not a list of sols: {}'.format(selection))
+            return
+        cube = SpectraCube(directory)
+        rows = [row for row in cube.rows(sol=sols or None)
+                if "ref" in cube.index[row]["source"] or "REF" in cube.index[row]["source"]]
+        if not rows:
+            messagebox.showinfo('Error', 'The cube has no REF spectra of these sols')
+            return
+        self.plot_cube(cube, rows)
+
+    def plot_files(self, files):
+        """plot_files
+        add many REF files to the plot.  The files are read on a background thread
+        while the window stays responsive, then every line is added and the plot
+        is drawn once.
+
+        :param files: the files to plot (files that are not REF files are ignored)
+        """
+        files = [file for file in files if "ref" in file or "REF" in file]
+        if not files:
+            return
+        loaded = queue.Queue()
+
+        def load():
+            try:
+                for file in files:
+                    try:
+                        loaded.put((file, self.read_file(file)))
+                    except Exception as e:
+                        loaded.put((file, e))
+            finally:
+                # always end the queue, or the add file button would stay disabled
+                loaded.put(None)
+
+        self.add_file_button.config(state="disabled")
+        threading.Thread(target=load, name="ccam-plot-loader", daemon=True).start()
+        self.window.after(poll_interval, self.add_loaded_files, loaded, [])
+
+    def add_loaded_files(self, loaded, spectra):
+        """add_loaded_files
+        collect the files read by plot_files, and plot them all once every file is read
+        """
+        while True:
+            try:
+                item = loaded.get_nowait()
+            except queue.Empty:
+                self.window.after(poll_interval, self.add_loaded_files, loaded, spectra)
+                return
+            if item is None:
+                break
+            (file, values) = item
+            if isinstance(values, Exception):
+                print(file + ': could not be read. ' + str(values))
+            else:
+                spectra.append((file, values))
 
-    def plot_file(self, file):
-        if "ref" in file or "REF" in file:
+        for (file, (x, y, smoothed)) in spectra:
             (path, filename) = os.path.split(file)
             self.filename_dict[filename] = path
-            self.file_list_box.insert(tk.END, filename)
+            self.plot_spectrum(filename, x, y, smoothed, redraw=False)
+        if spectra:
+            self.show_legend_if_selected()
+            self.update_axes_text(any(smoothed for (file, (x, y, smoothed)) in spectra))
+        self.add_file_button.config(state="normal")
 
-            cols = 1
-            if self.file_list_box.size() > 18:
-                cols = 2
+    def plot_cube(self, cube, rows):
+        """plot_cube
+        plot REF spectra from a SpectraCube, without opening their files
 
-            # add file to graph
-            # Data for plotting
-            x, y, smoothed = self.read_file(file)
-            short_name = "{}_{}".format(filename[0:13], filename[29:34])
-            this_line = self.axes.plot(x, y, label=short_name)
-            self.lines_dict[short_name] = this_line
+        :param cube: the SpectraCube
+        :param rows: the rows of the cube to plot
+        """
+        rows = list(rows)
+        spectra = cube.select(rows)
+        for (row, values) in zip(rows, spectra):
+            entry = cube.index[row]
+            (path, filename) = os.path.split(entry["source"])
+            self.filename_dict[filename] = path
+            x, y = self.get_plot_values(cube.wavelength, values, entry["smooth_vio"] == "True")
+            self.plot_spectrum(filename, x, y, entry["smooth_vis"] == "True", redraw=False)
+        if rows:
             self.show_legend_if_selected()
-            self.canvas.draw()
+            self.update_axes_text(any(cube.index[row]["smooth_vis"] == "True" for row in rows))
+
+    def plot_spectrum(self, filename, x, y, smoothed, redraw=True):
+        """plot_spectrum
+        add a spectrum to the file list and the graph
 
-            # get current axes limits and update the text box
-            self.update_axes_text(smoothed)
+        :param redraw: update the legend and axes and draw the plot (False when adding many spectra)
+        """
+        self.file_list_box.insert(tk.END, filename)
+
+        short_name = "{}_{}".format(filename[0:13], filename[29:34])
+        (draw_x, draw_y) = self.get_draw_values(x, y)
+        this_line = self.axes.plot(draw_x, draw_y, label=short_name)
+        self.lines_dict[short_name] = this_line
+        self.spectra_dict[short_name] = (x, y)
+        if not redraw:
+            return
+        self.show_legend_if_selected()
+
+        # get current axes limits and update the text box
+        self.update_axes_text(smoothed)
+
+    def get_draw_values(self, x, y):
+        """get_draw_values
+        the values of a spectrum that are drawn: the part inside the x axis limits,
+        decimated to the width of the plot
+        """
+        (left, right) = self.axes.get_xlim()
+        inside = np.flatnonzero((x >= left) & (x <= right))
+        if len(inside) == 0:
+            return x, y
+        # one more point on each side, so the line reaches the edges of the plot
+        first = max(inside[0] - 1, 0)
+        last = min(inside[-1] + 2, len(x))
+        return decimate(x[first:last], y[first:last], self.axes.bbox.width)
 
     def update_axes_text(self, smoothed):
         """
@@ -259,11 +549,12 @@ class PlotPanel(tk.Frame):
             filename = self.file_list_box.get(i)
             self.file_list_box.delete(i)
             short_name = "{}_{}".format(filename[0:13], filename[29:34])
-            line = self.lines_dict[short_name]
+            line = self.lines_dict.pop(short_name)
+            self.spectra_dict.pop(short_name, None)
             line[0].remove()
 
         self.show_legend_if_selected()
-        self.canvas.draw()
+        self.canvas.draw_idle()
 
     def save_plot(self):
         """save_plot
@@ -294,12 +585,17 @@ class PlotPanel(tk.Frame):
         # set axes limits
         self.axes.set_xlim(xmin, xmax)
         self.axes.set_ylim(ymin, ymax)
+        if self.decimated_xlim != (xmin, xmax):
+            # decimate the lines again for the new range
+            self.decimated_xlim = (xmin, xmax)
+            for (short_name, line) in self.lines_dict.items():
+                line[0].set_data(*self.get_draw_values(*self.spectra_dict[short_name]))
 
         # set title based on user input
         title = str(self.title_entry.get())
         self.axes.set_title(title)
 
-        self.canvas.draw()
+        self.canvas.draw_idle()
 
     def show_legend_if_selected(self):
         """show_legend_selected
@@ -316,7 +612,7 @@ class PlotPanel(tk.Frame):
         else:
             if self.axes.get_legend() is not None:
                 self.axes.get_legend().remove()
-        self.canvas.draw()
+        self.canvas.draw_idle()
 
     def back_button_pressed(self):
         self.window.withdraw()
@@ -1,19 +1,34 @@
-import argparse
+import copy
 import os
 import math as math
 import numpy as np
 import sys
-from datetime import datetime
 from ccam_prospect.utils.InputType import InputType
 import ccam_prospect.utils.constant as constants
-from ccam_prospect.utils.Utilities import get_integration_time, write_final, write_label, get_header_values
+from ccam_prospect.utils.Utilities import get_integration_time_from_headers, integration_time, write_final, \
+    write_npz, write_label, walk_files, npz_filename, product_filename, is_psv_file, clear_label_values
+from ccam_prospect.utils.ProcessPool import calibrate_in_pool, get_job_count
+import ccam_prospect.utils.CalibrationAssets as assets
+from ccam_prospect.utils.Fingerprint import get_fingerprint, is_current, record_fingerprint
+from ccam_prospect.utils.Metrics import Metrics, null_metrics
+from ccam_prospect.utils.Pipeline import pipelined, direct_writer
+from ccam_prospect.utils.RunLog import RunLog
+from ccam_prospect.utils.SpectrumFile import read_psv, make_rad, HEADER_LENGTH
 from ccam_prospect.utils.CustomExceptions import NonStandardHeaderException, CancelExecutionException, \
     InputFileNotFoundException
 
+# channels of each spectrometer in the combined spectrum (uv, vis, vnir)
+channel_ranges = [(0, 2048), (2048, 4096), (4096, 6144)]
+# channels of each spectrometer used to compute its offset (see remove_offsets)
+offset_ranges = [(0, 11), (0, 5), (1816, 1832)]
+# outcomes after which a REF calibration goes on from the RAD file (see RadianceCalibration.intermediate)
+intermediate_outcomes = ("calibrated.rad", "skipped.exists", "skipped.up_to_date")
+
 
 class RadianceCalibration:
 
-    def __init__(self, log_file, main_app=None):
+    def __init__(self, log_file, main_app=None, atomic_write=False, output_format="tab", incremental=None,
+                 metrics=None, pipeline=False, run_log=None):
         # variables parsed from spectra file
         self.vnir = []
         self.vis = []
@@ -23,21 +38,51 @@ class RadianceCalibration:
         self.total_files = 1
         self.current_file = 1
         self.header_string = ""
+        # calibrated values of the last file
+        self.wavelength = None
+        self.radiance = None
         self.logfile = log_file
+        self.run_log = run_log if run_log is not None else RunLog(log_file)  # log records, messages and outcomes
+        self.atomic_write = atomic_write  # write each table to a temporary file and rename it
+        self.output_format = output_format  # "tab", "npz" or "both"
+        self.incremental = incremental  # None, or "mtime"/"hash" to only recalculate products whose inputs changed
+        self.metrics = metrics if metrics is not None else null_metrics  # stage timings and counters
+        self.pipeline = pipeline  # read the next files and write the outputs on separate threads
+        self.writer = direct_writer  # writes the outputs of each file (a writer thread in the pipelined mode)
+        self.prefetched = {}  # inputs already read by the reader thread of the pipelined mode, by file name
         self.show_header_warning = True
         self.show_list_warning = True
+        self.intermediate = False  # the RAD step of a REF calibration, see count_outcome
+
+    def write_log(self, message, reason):
+        """write_log
+        add a message to the log file, tagged with a reason code (see RunLog)
+        """
+        self.run_log.record(reason, message)
+
+    def count_outcome(self, outcome):
+        """count_outcome
+        count the outcome of a file in the metrics and the summary of the run.  The RAD file of a
+        REF calibration that goes on to the REF file is counted apart (see RunLog.count_intermediate)
+        """
+        self.metrics.count(outcome)
+        if self.intermediate and outcome in intermediate_outcomes:
+            self.run_log.count_intermediate(outcome)
+        else:
+            self.run_log.count(outcome)
 
     def get_headers(self, filename):
         """get_headers
         Just grab the first 29 lines (the header) to be copied to the calibrated rad file
         """
         with open(filename, 'r') as f:
-            self.header_string = [next(f) for x in range(29)]
+            self.header_string = [next(f) for x in range(HEADER_LENGTH)]
 
     def read_spectra(self, filename):
         """read_spectra
         open the response file and read the appropriate lines into
-        each array of vnir, vis, and uv
+        each array of vnir, vis, and uv. The header is parsed in the
+        same read (see read_psv)
 
             field    line
 
@@ -45,12 +90,19 @@ class RadianceCalibration:
             vis:      2227:4275
             uv:       4375:6423
         """
-        with open(filename, 'r') as f:
-            self.vnir = np.array([float(line.rstrip('\n')) for line in f.readlines()[79:2127]])
-        with open(filename, 'r') as f:
-            self.vis = np.array([float(line.rstrip('\n')) for line in f.readlines()[2227:4275]])
-        with open(filename, 'r') as f:
-            self.uv = np.array([float(line.rstrip('\n')) for line in f.readlines()[4375:6423]])
+        self.set_psv(read_psv(filename))
+
+    def set_psv(self, psv):
+        """set_psv
+        use the header values, header lines and spectra of an already parsed PSV file
+
+        :param psv: the parsed PSVFile
+        """
+        self.headers = psv.headers
+        self.header_string = psv.header_lines
+        self.vnir = psv.vnir
+        self.vis = psv.vis
+        self.uv = psv.uv
 
     def remove_offsets(self):
         """remove_offsets
@@ -73,9 +125,9 @@ class RadianceCalibration:
         uv_mean = np.mean(uv_off)
 
         # subtract offset from each channel
-        self.vnir = np.array([v - vnir_mean for v in self.vnir])
-        self.vis = np.array([v - vis_mean for v in self.vis])
-        self.uv = np.array([v - uv_mean for v in self.uv])
+        self.vnir = self.vnir - vnir_mean
+        self.vis = self.vis - vis_mean
+        self.uv = self.uv - uv_mean
 
     def get_solid_angle(self):
         """get_solid_angle
@@ -123,32 +175,91 @@ class RadianceCalibration:
         :param sa_steradian: solid angle subtended by aperture in steradians
         :return: the calibrated radiance values
         """
-        rad = np.array([p / t_int / fov_tgt / sa_steradian for p in photons])
+        rad = np.asarray(photons) / t_int / fov_tgt / sa_steradian
 
         # divide each photon by the bin width (w = next wavelength - this wavelength)
-        w = np.zeros(len(wavelengths))
-        for iw in range(0, len(wavelengths) - 1):
-            i_next = iw + 1
-            w[iw] = wavelengths[i_next] - wavelengths[iw]
+        return np.divide(rad, RadianceCalibration.get_bin_widths(wavelengths))
+
+    @staticmethod
+    def get_radiance_final(dn, factors, t_int, fov_tgt, sa_steradian):
+        """get_radiance_final
+        Calculate the radiance of each channel in output units (W/m^2/sr/um) from the
+        DN values, using the per-channel factors from get_radiance_factors.  This
+        is the same as get_radiance followed by convert_to_output_units, combined
+        into one multiplication.
+
+        :param dn: the values for the observation, in DN with offsets removed
+        :param factors: the per-channel factors from get_radiance_factors
+        :param t_int: integration time
+        :param fov_tgt: the area of the FOV on the target
+        :param sa_steradian: solid angle subtended by aperture in steradians
+        :return: the calibrated radiance values
+        """
+        return np.multiply(dn, factors / (t_int * fov_tgt * sa_steradian))
+
+    @staticmethod
+    def get_bin_widths(wavelengths):
+        """get_bin_widths
+        the spectral bin width of each channel (w = next wavelength - this wavelength).
+        The last channel uses the width of the one before it.
+
+        :param wavelengths: the wavelength of each channel
+        :return: the bin widths
+        """
+        w = np.empty(len(wavelengths))
+        w[:-1] = np.diff(wavelengths)
         w[-1] = w[-2]
-        return np.divide(rad, w)
+        return w
+
+    @staticmethod
+    def get_radiance_factors(gain_file):
+        """get_radiance_factors
+        the part of the radiance calibration that is the same for every file:
+        the gain, bin width, and conversion to output units of each channel, so that
+            RAD = DN * factor / (t * A * SA)
+        The factors are computed once per process (see CalibrationAssets)
+
+        :param gain_file: the gain file
+        :return: wl, the wavelength for each channel
+        :return: factors, the conversion factor of each channel
+        """
+        return assets.load("radiance factors", gain_file, RadianceCalibration.compute_radiance_factors)
+
+    @staticmethod
+    def load_assets():
+        """load_assets
+        load the calibration values used by every file now, so that the worker processes
+        started afterwards (and every later input of the process) start with them
+        """
+        RadianceCalibration.get_radiance_factors(assets.gain_file)
+
+    @staticmethod
+    def compute_radiance_factors(gain_file):
+        """compute_radiance_factors
+        compute the per-channel factors returned by get_radiance_factors
+
+        :param gain_file: the gain file
+        :return: wl, the wavelength for each channel
+        :return: factors, the conversion factor of each channel
+        """
+        (wavelength, gain) = RadianceCalibration.get_wl_and_gain(gain_file)
+        # photons/DN per bin width, converted from phot/sec/cm^2/sr/nm to W/m^2/sr/um
+        factors = gain / RadianceCalibration.get_bin_widths(wavelength) * constants.hc / (wavelength * 1E-9) * 1E7
+        factors.setflags(write=False)
+        return wavelength, factors
 
     @staticmethod
     def get_wl_and_gain(gain_file):
         """get_wl_and_response
         read the gain file to get the wavelength and response function
-        (photons/DN) for each response to use to convert to units of photons
+        (photons/DN) for each response to use to convert to units of photons.
+        The file is only parsed once per process (see CalibrationAssets)
 
         :param gain_file: the gain file
         :return: wl, the wavelength for each response
         :return: gain, the gain for each response to get photons/DN
         """
-        with open(gain_file, 'r') as f:
-            wl = np.array([float(row.split()[0]) for row in f])
-        with open(gain_file, 'r') as f:
-            gain = np.array([float(row.split()[1]) for row in f])
-
-        return wl, gain
+        return assets.load_table(gain_file)
 
     @staticmethod
     def convert_to_output_units(radiance, wavelengths):
@@ -163,6 +274,39 @@ class RadianceCalibration:
         converted_rad = np.divide(rad_hc, np.multiply(wavelengths, 1E-9))
         return np.multiply(converted_rad, 1E7)
 
+    @staticmethod
+    def calibrate_block(dn, dist_to_target, ipbc, ict):
+        """calibrate_block
+        Calibrate many spectra to radiance at once.  Each row of dn is one spectrum in
+        wavelength order (uv, vis, vnir - see PSVFile.dn), with the header values of each
+        row given as arrays.  This does the same steps as calibrate_file (offset removal,
+        gain, radiance and conversion to output units) on the whole block, without
+        reading or writing any files.
+
+        :param dn: (N, 6144) array of spectra in DN
+        :param dist_to_target: distance to target of each spectrum (distToTarget)
+        :param ipbc: IPBC divisor of each spectrum (IPBCdivisor)
+        :param ict: ICT divisor of each spectrum (ICTdivisor)
+        :return: wl, the wavelength for each channel
+        :return: radiance, (N, 6144) array of radiance in W/m^2/sr/um
+        """
+        dn = np.atleast_2d(np.asarray(dn, dtype=np.float64))
+        distance = np.asarray(dist_to_target, dtype=np.float64).reshape(-1, 1)
+        t_int = integration_time(np.asarray(ipbc, dtype=np.float64), np.asarray(ict, dtype=np.float64)).reshape(-1, 1)
+
+        # remove the offset of each spectrometer (see remove_offsets)
+        dn_offset = np.empty_like(dn)
+        for (start, end), (offset_start, offset_end) in zip(channel_ranges, offset_ranges):
+            offset = np.mean(dn[:, start + offset_start:start + offset_end], axis=1, keepdims=True)
+            dn_offset[:, start:end] = dn[:, start:end] - offset
+
+        # solid angle and area on target (see get_solid_angle and get_area_on_target)
+        sa_steradian = np.pi * np.power(np.sin(np.arctan(constants.aperture / 2 / distance)), 2)
+        fov_tgt = np.pi * np.power(constants.fov * distance / 2 / 10, 2)
+
+        (wavelength, factors) = RadianceCalibration.get_radiance_factors(assets.gain_file)
+        return wavelength, dn_offset * factors / (t_int * fov_tgt * sa_steradian)
+
     @staticmethod
     def psv_to_rad(psv_file, out_dir):
         """psv_to_rad
@@ -185,6 +329,29 @@ class RadianceCalibration:
 
         return out_filename
 
+    def get_rad_spectrum(self, rad_file):
+        """get_rad_spectrum
+        the last calibrated file as a RADFile, as it would be read back from the
+        RAD file written by calibrate_file
+
+        :param rad_file: the name of the RAD file
+        :return: the RADFile
+        """
+        return make_rad(rad_file, self.header_string, self.wavelength, self.radiance)
+
+    @staticmethod
+    def is_psv_file(filename):
+        """is_psv_file
+        the file name is that of a PSV *.tab or *.txt file
+        """
+        return is_psv_file(filename)
+
+    def found_files(self, count):
+        """found_files
+        add files found while walking a directory to the total used for the progress
+        """
+        self.total_files += count
+
     def update_progress(self, value=None):
         """update_progress
         update the progress bar to this value
@@ -205,52 +372,78 @@ class RadianceCalibration:
         original_label = original_label.replace('.TXT', '.lbl')
         return original_label
 
-    def calibrate_file(self, ccam_file, out_dir, overwrite):
+    def calibrate_file(self, ccam_file, out_dir, overwrite, write_rad=True):
         """calibrate_file
-        step through each necessary step to calibrate the file
+        step through each necessary step to calibrate the file.  The calibrated
+        radiance is kept in self.wavelength and self.radiance.
 
         :param: ccam_file: file to calibrate
         :param: out_dir: output directory
         :param: overwrite: a boolean representing if files should be overwritten or not
+        :param: write_rad: write the RAD file and label (False to only calculate the radiance)
+        """
+        with self.metrics.file():
+            return self.calibrate_file_stages(ccam_file, out_dir, overwrite, write_rad)
+
+    def calibrate_file_stages(self, ccam_file, out_dir, overwrite, write_rad):
+        """calibrate_file_stages
+        the steps of calibrate_file, each timed as a stage of the metrics
         """
+        metrics = self.metrics
+        self.wavelength = None
+        self.radiance = None
         # check that file exists, is a file, and is a psv *.tab or .txt file
         if os.path.exists(ccam_file) and os.path.isfile(ccam_file):
-            if "psv" in ccam_file.lower() and \
-                    (ccam_file.lower().endswith(".tab") or ccam_file.lower().endswith(".txt")):
+            if self.is_psv_file(ccam_file):
 
                 out_filename = self.psv_to_rad(ccam_file, out_dir)
                 if not overwrite:
                     # if we don't want to overwrite existing files, we can skip this file if it already exists
-                    if os.path.exists(out_filename) and os.path.isfile(out_filename):
-                        print(out_filename + " already exists, skipping")
+                    product = product_filename(out_filename, self.output_format)
+                    if os.path.exists(product) and os.path.isfile(product):
+                        self.run_log.print(product + " already exists, skipping")
+                        self.count_outcome("skipped.exists")
+                        return True
+
+                fingerprint = None
+                if self.incremental and write_rad:
+                    product = product_filename(out_filename, self.output_format)
+                    fingerprint = get_fingerprint(ccam_file, [assets.gain_file],
+                                                  {"product": "rad", "format": self.output_format}, self.incremental)
+                    if is_current(product, fingerprint):
+                        self.run_log.print(product + " is up to date, skipping")
+                        self.count_outcome("skipped.up_to_date")
                         return True
 
                 # check for original label
                 original_label = self.get_original_label(ccam_file)
 
-                self.headers = get_header_values(ccam_file)
-                self.get_headers(ccam_file)
-
                 try:
-                    self.read_spectra(ccam_file)
+                    # read the header and spectra in a single pass
+                    with metrics.stage("parse"):
+                        psv = self.prefetched.pop(ccam_file, None)
+                        self.set_psv(psv if psv is not None else read_psv(ccam_file))
                 except ValueError:
-                    with open(self.logfile, 'a+') as log:
-                        print(ccam_file + ': not formatted correctly. skipping')
-                        log.write(ccam_file + ': radiance calibration - file not formatted correctly \n')
+                    self.run_log.print(ccam_file + ': not formatted correctly. skipping')
+                    self.write_log(ccam_file + ': radiance calibration - file not formatted correctly \n',
+                                   "failed.not_formatted")
+                    self.count_outcome("failed.not_formatted")
                     return False
+                if metrics.enabled:
+                    metrics.count("bytes_read", os.path.getsize(ccam_file))
 
-                self.remove_offsets()
+                with metrics.stage("offsets"):
+                    self.remove_offsets()
 
                 # calculate some needed values
                 try:
-                    t_int = get_integration_time(ccam_file)
+                    t_int = get_integration_time_from_headers(self.headers)
                     sa_steradian = self.get_solid_angle()
                     fov_tgt = self.get_area_on_target()
                 except NonStandardHeaderException:
                     warning = 'not a valid PSV file header. Skipping this file.'
                     # write to log file
-                    with open(self.logfile, 'a+') as log:
-                        log.write(ccam_file + ': radiance calibration - ' + warning + '\n')
+                    self.write_log(ccam_file + ': radiance calibration - ' + warning + '\n', "failed.header")
                     if self.show_header_warning:
                         # show warning
                         if self.main_app is not None:
@@ -259,183 +452,276 @@ class RadianceCalibration:
                         # cancel
                         raise CancelExecutionException
                     # exit because file was invalid
+                    self.count_outcome("failed.header")
                     return False
 
                 if self.total_files == 1:
                     self.update_progress(25)
 
-                # combine arrays into one ordered by wavelength
-                all_spectra_dn = np.concatenate([self.uv, self.vis, self.vnir])
-
-                # get the wavelengths and gains from gain_mars.edit
-                my_path = os.path.abspath(os.path.dirname(__file__))
-                gain_file = os.path.join(my_path, "constants/gain_mars.edit")
-                (wavelength, gain) = self.get_wl_and_gain(gain_file)
+                with metrics.stage("radiance"):
+                    # combine arrays into one ordered by wavelength
+                    all_spectra_dn = np.concatenate([self.uv, self.vis, self.vnir])
 
-                # multiply by the gain to get in photons
-                all_spectra_photons = np.multiply(all_spectra_dn, gain)
+                    # get the wavelengths and the per-channel factors (gain, bin width and output
+                    # units, from gain_mars.edit) that are the same for every file
+                    (wavelength, factors) = self.get_radiance_factors(assets.gain_file)
 
-                # calculate the radiance values
-                radiance = self.get_radiance(all_spectra_photons, wavelength, t_int, fov_tgt, sa_steradian)
+                    # calculate the radiance values in units of W/m^2/sr/um
+                    radiance_final = self.get_radiance_final(all_spectra_dn, factors, t_int, fov_tgt, sa_steradian)
                 if self.total_files == 1:
                     self.update_progress(50)
-
-                # convert to units of W/m^2/sr/um from phot/sec/cm^2/sr/nm
-                radiance_final = self.convert_to_output_units(radiance, wavelength)
+                self.wavelength = wavelength
+                self.radiance = radiance_final
+                if not write_rad:
+                    return True
 
                 # rename the PSV file to RAD
-                write_final(out_filename, wavelength, radiance_final, header=self.header_string)
-
-                if os.path.exists(original_label):
-                    # write new label based on original, if it exists
-                    (path, filename) = os.path.split(original_label)
-                    new_label_filename = filename.replace('PSV', 'RAD')
-                    new_label_filename = new_label_filename.replace('psv', 'rad')
-                    new_label_filename = new_label_filename.replace('lbl', 'xml')
-                    (out_path, filename) = os.path.split(out_filename)
-                    new_label = os.path.join(out_path, new_label_filename)
-                    write_label(new_label, original_label, True)
-                print(ccam_file + ' calibrated and written to ' + out_filename)
+                self.writer.submit(self.write_rad, ccam_file, out_filename, wavelength, radiance_final,
+                                   self.header_string, original_label, fingerprint)
                 if self.total_files == 1:
                     self.update_progress(100)
                 return True
             else:
+                self.count_outcome("skipped.not_psv")
                 return False
         else:
+            self.count_outcome("failed.missing")
             if self.main_app is not None:
                 raise InputFileNotFoundException(ccam_file)
             if "psv" in ccam_file or "rad" in ccam_file or "ref" in ccam_file:
                 # only log if a PDS file
-                print(ccam_file + " does not exist.")
-                with open(self.logfile, 'a+') as log:
-                    log.write(ccam_file + ': radiance input - file does not exist \n')
+                self.run_log.print(ccam_file + " does not exist.")
+                self.write_log(ccam_file + ': radiance input - file does not exist \n', "failed.missing")
+
+    def write_rad(self, ccam_file, out_filename, wavelength, radiance, header, original_label, fingerprint):
+        """write_rad
+        write the RAD file, its label and fingerprint.  Called through self.writer,
+        on the writer thread in the pipelined mode.
+
+        :param: ccam_file the calibrated PSV file
+        :param: out_filename the RAD .tab file
+        :param: wavelength the wavelength of each channel
+        :param: radiance the radiance of each channel
+        :param: header the header lines copied from the PSV file
+        :param: original_label the label of the PSV file
+        :param: fingerprint the fingerprint to record, or None
+        """
+        metrics = self.metrics
+        with metrics.stage("write"):
+            if self.output_format != "npz":
+                write_final(out_filename, wavelength, radiance, header=header, atomic=self.atomic_write)
+            if self.output_format != "tab":
+                write_npz(npz_filename(out_filename), wavelength, radiance, header=header, atomic=self.atomic_write)
+        if metrics.enabled:
+            for written in [out_filename, npz_filename(out_filename)]:
+                if os.path.exists(written):
+                    metrics.count("bytes_written", os.path.getsize(written))
+
+        if os.path.exists(original_label):
+            # write new label based on original, if it exists
+            (path, filename) = os.path.split(original_label)
+            new_label_filename = filename.replace('PSV', 'RAD')
+            new_label_filename = new_label_filename.replace('psv', 'rad')
+            new_label_filename = new_label_filename.replace('lbl', 'xml')
+            (out_path, filename) = os.path.split(out_filename)
+            new_label = os.path.join(out_path, new_label_filename)
+            with metrics.stage("label"):
+                write_label(new_label, original_label, True)
+        if fingerprint is not None:
+            record_fingerprint(product_filename(out_filename, self.output_format), fingerprint)
+        self.run_log.print(ccam_file + ' calibrated and written to ' +
+                           product_filename(out_filename, self.output_format))
+        self.count_outcome("calibrated.rad")
+        self.run_log.product("rad", product_filename(out_filename, self.output_format))
+
+    def read_input(self, ccam_file):
+        """read_input
+        read a PSV file ahead of its calibration, on the reader thread of the pipelined mode
+
+        :param: ccam_file the file that will be calibrated
+        :return: the inputs read, by file name (nothing if the file is not a readable PSV file)
+        """
+        if not self.is_psv_file(ccam_file) or not os.path.isfile(ccam_file):
+            return {}
+        try:
+            return {ccam_file: read_psv(ccam_file)}
+        except (ValueError, OSError):
+            # reported when the file is calibrated
+            return {}
 
-    def calibrate_directory(self, directory, out_dir, overwrite):
+    def calibrate_in_parallel(self, files, out_dir, overwrite, jobs):
+        """calibrate_in_parallel
+        calibrate each file using a pool of worker processes. Progress and the
+        log file are updated from this process, in the same order as a serial run.
+
+        :param: files the files to calibrate (a list, or a generator read as the workers need files)
+        :param: out_dir the destination directory for output
+        :param: overwrite a boolean representing if files should be overwritten or not
+        :param: jobs the number of worker processes
+        """
+        worker = copy.copy(self)
+        worker.main_app = None
+        # each worker collects its own log and metrics, merged here after each file
+        worker.run_log = self.run_log.worker_log()
+        worker.metrics = Metrics() if self.metrics.enabled else null_metrics
+        for result, file_log, file_metrics in calibrate_in_pool(worker, files, (out_dir, overwrite), jobs):
+            self.run_log.merge(file_log)
+            self.metrics.merge(file_metrics)
+            self.current_file += 1
+            self.run_log.file_done()
+            self.update_progress()
+        self.update_progress(100)
+
+    def calibrate_directory(self, directory, out_dir, overwrite, jobs=1):
         """calibrate_directory
         calibrate everything in this directory, recursively.
 
         :param: directory the directory in which to look for PSV files
         :param: out_dir the destination directory for output
         :param: overwrite a boolean representing if files should be overwritten or not
+        :param: jobs the number of worker processes to use (0 for one per CPU)
        """
-        # total number of files to potentially calibrate
-        self.total_files = sum([len(files) for r, d, files in os.walk(directory)])
+        # the directory is walked once, the total grows as PSV files are found
+        self.total_files = 0
         self.current_file = 1
+        jobs = get_job_count(jobs)
         try:
-            for file in os.listdir(directory):
-                full_path = os.path.join(directory, file)
-                if os.path.isdir(full_path) and full_path is not out_dir:
-                    # recursive call for each subdirectory
-                    self.calibrate_directory(os.path.join(directory, file), out_dir, overwrite)
-                else:
-                    self.calibrate_file(full_path, out_dir, overwrite)
+            files = walk_files(directory, out_dir, self.is_psv_file, self.found_files)
+            if jobs > 1:
+                self.calibrate_in_parallel(files, out_dir, overwrite, jobs)
+                return True
+            with pipelined(self, files) as files:
+                for file in files:
+                    self.calibrate_file(file, out_dir, overwrite)
                     self.current_file += 1
+                    self.run_log.file_done()
                     self.update_progress()
             self.update_progress(100)
             return True
         except FileNotFoundError:
-            print(directory + " does not exist.")
-            with open(self.logfile, 'a+') as log:
-                log.write(directory + ': radiance input - directory does not exist \n')
+            self.run_log.print(directory + " does not exist.")
+            self.run_log.input_failed("failed.missing_input",
+                                      directory + ': radiance input - directory does not exist \n')
             if self.main_app is not None:
                 raise InputFileNotFoundException(directory)
             return False
 
-    def calibrate_list(self, list_file, out_dir, overwrite):
+    def calibrate_list(self, list_file, out_dir, overwrite, jobs=1):
         """calibrate_list
         calibrate everything in this list
 
         :param: list the list of psv files to calibrate
         :param: out_dir the destination directory for output
         :param: overwrite a boolean representing if files should be overwritten or not
+        :param: jobs the number of worker processes to use (0 for one per CPU)
         """
         try:
             # read each line into a list of files
             files = open(list_file).read().splitlines()
         except FileNotFoundError:
-            print(list_file + " radiance input: file does not exist")
-            with open(self.logfile, 'a+') as log:
-                log.write(list_file + ':   radiance input: file does not exist \n')
+            self.run_log.print(list_file + " radiance input: file does not exist")
+            self.run_log.input_failed("failed.missing_input", list_file + ':   radiance input: file does not exist \n')
             if self.main_app is not None:
                 raise InputFileNotFoundException(list_file)
             return False
+        return self.calibrate_files(files, out_dir, overwrite, jobs)
+
+    def calibrate_catalog(self, catalog_file, where, out_dir, overwrite, jobs=1):
+        """calibrate_catalog
+        calibrate the files of a header catalog matching a condition (see HeaderCatalog.query)
+
+        :param: catalog_file the header catalog, written by headerCatalog
+        :param: where the condition on the columns of the catalog, or None for every file
+        :param: out_dir the destination directory for output
+        :param: overwrite a boolean representing if files should be overwritten or not
+        :param: jobs the number of worker processes to use (0 for one per CPU)
+        """
+        if not os.path.isfile(catalog_file):
+            self.run_log.print(catalog_file + " radiance input: catalog does not exist")
+            self.run_log.input_failed("failed.missing_input",
+                                      catalog_file + ':   radiance input: catalog does not exist \n')
+            return False
+        # only runs that select files from a catalog import sqlite3
+        import sqlite3
+        from ccam_prospect.headerCatalog import HeaderCatalog
+        try:
+            with HeaderCatalog(catalog_file) as catalog:
+                files = catalog.query(where)
+        except sqlite3.Error as e:
+            self.run_log.print(catalog_file + ": catalog query failed: " + str(e))
+            self.run_log.input_failed("failed.catalog_query",
+                                      catalog_file + ':   radiance input: catalog query failed - ' + str(e) + '\n')
+            return False
+        return self.calibrate_files(files, out_dir, overwrite, jobs)
+
+    def calibrate_files(self, files, out_dir, overwrite, jobs=1):
+        """calibrate_files
+        calibrate each file of a list
+
+        :param: files the psv files to calibrate
+        :param: out_dir the destination directory for output
+        :param: overwrite a boolean representing if files should be overwritten or not
+        :param: jobs the number of worker processes to use (0 for one per CPU)
+        """
         self.total_files = len(files)
         self.current_file = 1
-        for file in files:
-            # calibrate each file in the list
-            try:
-                self.calibrate_file(file, out_dir, overwrite)
-                self.current_file += 1
-                self.update_progress()
-            except InputFileNotFoundException:
-                warning = file + ": file not found. Skipping this file."
-                if self.show_list_warning:
-                    print(warning)
-                    with open(self.logfile, 'a+') as log:
-                        log.write(file + ': radiance calibration - file does not exist \n')
-                    if self.main_app is not None:
-                        self.show_list_warning = self.main_app.show_warning_dialog(warning)
-                if self.show_list_warning is None:
-                    # cancel
-                    raise CancelExecutionException
+        jobs = get_job_count(jobs)
+        if jobs > 1:
+            self.calibrate_in_parallel(files, out_dir, overwrite, jobs)
+            return True
+        with pipelined(self, files) as files:
+            for file in files:
+                # calibrate each file in the list
+                try:
+                    self.calibrate_file(file, out_dir, overwrite)
+                    self.current_file += 1
+                    self.run_log.file_done()
+                    self.update_progress()
+                except InputFileNotFoundException:
+                    # the file counts as done for the progress, or it would never reach the total
+                    self.current_file += 1
+                    self.run_log.file_done()
+                    warning = file + ": file not found. Skipping this file."
+                    if self.show_list_warning:
+                        self.run_log.print(warning)
+                        self.write_log(file + ': radiance calibration - file does not exist \n', "failed.missing")
+                        if self.main_app is not None:
+                            self.show_list_warning = self.main_app.show_warning_dialog(warning)
+                    if self.show_list_warning is None:
+                        # cancel
+                        raise CancelExecutionException
         self.update_progress(100)
         return True
 
-    def calibrate_to_radiance(self, file_type, file_name, out_dir, overwrite):
+    def calibrate_to_radiance(self, file_type, file_name, out_dir, overwrite, jobs=1, where=None):
         """calibrate_to_radiance
-        entry point to calibrate a file, list of files, or directory
+        entry point to calibrate a file, list of files, directory or header catalog
 
-        :param: file_type either file, list of files, or directory
-        :param: file_name the name of the file / directory
+        :param: file_type either file, list of files, directory or catalog
+        :param: file_name the name of the file / directory / catalog
         :param: out_dir the destination directory for output
         :param: overwrite a boolean representing if files should be overwritten or not
+        :param: jobs the number of worker processes for a list or directory (0 for one per CPU)
+        :param: where the condition selecting the files of a catalog
         """
-        if file_type.value is InputType.FILE.value:
-            return self.calibrate_file(file_name, out_dir, overwrite)
-        elif file_type.value is InputType.FILE_LIST.value:
-            return self.calibrate_list(file_name, out_dir, overwrite)
-        else:
-            return self.calibrate_directory(file_name, out_dir, overwrite)
+        try:
+            if file_type.value is InputType.FILE.value:
+                result = self.calibrate_file(file_name, out_dir, overwrite)
+                self.run_log.file_done()
+                return result
+            elif file_type.value is InputType.FILE_LIST.value:
+                return self.calibrate_list(file_name, out_dir, overwrite, jobs)
+            elif file_type.value is InputType.CATALOG.value:
+                return self.calibrate_catalog(file_name, where, out_dir, overwrite, jobs)
+            else:
+                return self.calibrate_directory(file_name, out_dir, overwrite, jobs)
+        finally:
+            # write the log records and print the summary, also when the calibration was cancelled
+            self.run_log.finish()
+            # the labels are read again by the next run, which may be much later in the GUI
+            clear_label_values()
 
 
 if __name__ == "__main__":
-    # create an argument parser
-    parser = argparse.ArgumentParser(description='Calibrate CCAM to Radiance')
-    parser.add_argument('-f', action="store", dest='ccamFile', help="CCAM psv *.tab file")
-    parser.add_argument('-d', action="store", dest='directory', help="Directory containing .tab files")
-    parser.add_argument('-l', action="store", dest='list', help="File with a list of .tab files")
-    parser.add_argument('-o', action="store", dest='out_dir', help="directory to store the output files")
-    parser.add_argument('--no-overwrite-rad', action="store_false", dest='overwrite',
-                        help="do not overwrite existing files")
-    parser.set_defaults(overwrite=True)
-
-    args = parser.parse_args()
-    if len(sys.argv) == 1:
-        parser.print_help(sys.stderr)
-        sys.exit(1)
-    if args.ccamFile is not None:
-        in_file_type = InputType.FILE
-        in_file = args.ccamFile
-    elif args.directory is not None:
-        in_file_type = InputType.DIRECTORY
-        in_file = args.directory
-    else:
-        in_file_type = InputType.FILE_LIST
-        in_file = args.list
-
-    start_calibration = True
-
-    out_directory = args.out_dir
-    if out_directory is not None:
-        if not out_directory.endswith('/'):
-            out_directory = out_directory + '/'
-            if not os.path.isdir(out_directory):
-                print('output directory: ' + out_directory + ' does not exist. Please enter an existing directory.')
-                start_calibration = False
-
-    if start_calibration:
-        now = datetime.now()
-        logfile = "badInput_{}.log".format(now.strftime("%Y%m%d.%H%M%S"))
-
-        radianceCal = RadianceCalibration(logfile)
-        radianceCal.calibrate_to_radiance(in_file_type, in_file, out_directory, args.overwrite)
+    from ccam_prospect.cli import main
+    main(["rad"] + sys.argv[1:])
@@ -1,28 +1,64 @@
+import copy
 import numpy as np
 import os
-import argparse
 import sys
-from datetime import datetime
 from ccam_prospect.utils.InputType import InputType
 from ccam_prospect.utils.CustomExceptions import InputFileNotFoundException, NonStandardHeaderException, \
-    CancelExecutionException
-from ccam_prospect.utils.Utilities import get_integration_time, write_final, write_label, moving_median_smoothing
+    CancelExecutionException, NonStandardExposureTimeException, MismatchedExposureTimeException
+from ccam_prospect.utils.Utilities import get_integration_time_from_headers, integration_time, write_final, \
+    write_npz, write_label, moving_median_smoothing, walk_files, npz_filename, product_filename, \
+    clear_label_values
+from ccam_prospect.utils.ProcessPool import calibrate_in_pool, get_job_count
+import ccam_prospect.utils.CalibrationAssets as assets
+from ccam_prospect.utils.Fingerprint import get_fingerprint, is_current, record_fingerprint
+from ccam_prospect.utils.Metrics import Metrics, null_metrics
+from ccam_prospect.utils.Pipeline import pipelined, direct_writer
+from ccam_prospect.utils.RunLog import RunLog
+from ccam_prospect.utils.SpectrumFile import read_psv, read_spectrum, read_headers
 from ccam_prospect.radianceCalibration import RadianceCalibration
 
+# files of the same exposure time whose reflectance is calculated as one block (see calibrate_grouped)
+exposure_block_size = 256
+
 
 class RelativeReflectanceCalibration:
-    def __init__(self, log_file, main_app=None):
+    def __init__(self, log_file, main_app=None, emit_rad=True, atomic_write=False, output_format="tab",
+                 incremental=None, metrics=None, pipeline=False, run_log=None, group_exposure=False):
         self.rad_file = ''
+        self.rad = None
+        self.emit_rad = emit_rad              # write the RAD file when calibrating a PSV file
+        self.atomic_write = atomic_write      # write each table to a temporary file and rename it
+        self.output_format = output_format    # "tab", "npz" or "both"
+        self.incremental = incremental        # None, or "mtime"/"hash" to only recalculate changed products
+        self.metrics = metrics if metrics is not None else null_metrics  # stage timings and counters
+        self.pipeline = pipeline              # read the next files and write the outputs on separate threads
+        self.group_exposure = group_exposure  # calibrate lists and directories one exposure time at a time
+        self.writer = direct_writer           # writes the outputs of each file (a thread in the pipelined mode)
+        self.prefetched = {}                  # inputs already read by the reader thread, by file name
         self.wavelength = []
         self.main_app = main_app
         self.total_files = 1
         self.current_file = 1
         self.logfile = log_file
+        self.run_log = run_log if run_log is not None else RunLog(log_file)  # log records, messages and outcomes
         self.show_mismatched_warning = True   # show dialog for mismatched exposure time
         self.show_exposure_warning = True     # show dialog for nonstandard exposure time
         self.show_header_warning = True       # show dialog for nonstandard header
         self.show_list_warning = True         # show dialog for file in list doesn't exist
 
+    def write_log(self, message, reason):
+        """write_log
+        add a message to the log file, tagged with a reason code (see RunLog)
+        """
+        self.run_log.record(reason, message)
+
+    def count_outcome(self, outcome):
+        """count_outcome
+        count the outcome of a file in the metrics and the summary of the run
+        """
+        self.metrics.count(outcome)
+        self.run_log.count(outcome)
+
     def do_division(self, values):
         """
         Divide each value in the file by the calibration values
@@ -30,9 +66,17 @@ class RelativeReflectanceCalibration:
         :param values:
         :return: the divided values
         """
-        with open(self.rad_file) as f:
-            values_orig = [float(x.split()[1].strip()) for index, x in enumerate(f) if index > 28]
+        return self.divide_by_reference(self.get_rad_spectrum().values, values)
 
+    @staticmethod
+    def divide_by_reference(values_orig, values):
+        """
+        Divide radiance values (one spectrum or one per row) by the calibration values
+
+        :param values_orig: the radiance values
+        :param values: the calibration values
+        :return: the divided values
+        """
         # divide original values by the appropriate calibration values
         # to get relative reflectance.  If divide by 0, just = 0
         with np.errstate(divide='ignore', invalid='ignore'):
@@ -42,6 +86,112 @@ class RelativeReflectanceCalibration:
 
         return c
 
+    @staticmethod
+    def finish_reflectance(new_values, smooth_vio, smooth_vis):
+        """
+        Multiply the divided values (one spectrum or one per row) by the lab bidirectional
+        spectrum, zero out saturated channels and smooth the VIO and VIS regions as desired
+
+        :param new_values: the values divided by the calibration values
+        :param smooth_vio: use 51-channel filter to smooth VIO region
+        :param smooth_vis: use 51-channel filter to smooth VIS region
+        :return: the final relative reflectance values
+        """
+        # convolve
+        final_values = RelativeReflectanceCalibration.do_multiplication(new_values)
+        # replace saturated channels that are too large for PDS fixed-width with 0s
+        final_values = np.where(abs(final_values) > 10E20, 0, final_values)
+
+        # vio data: 241 to 466 nm, index 0 to 4095
+        vio_data = final_values[..., 0:4096]
+        # vis data: 473-905 nm, 4096 < index < 6144
+        vis_data = final_values[..., 4096:6144]
+
+        # smooth values as desired
+        if smooth_vio:
+            smoothed_vio = moving_median_smoothing(vio_data, 50)
+            final_values[..., 0:4096] = smoothed_vio
+        if smooth_vis:
+            smoothed_vis = moving_median_smoothing(vis_data, 50)
+            final_values[..., 4096:6144] = smoothed_vis
+
+        return final_values
+
+    @staticmethod
+    def get_reference(exposure, custom_target_file=None):
+        """get_reference
+        the calibration values to divide by for spectra with this exposure time
+
+        :param exposure: the exposure time, rounded to ms
+        :param custom_target_file: a custom file to use for calibration (default=None)
+        :return: wl, the wavelength for each channel
+        :return: values, the calibration values for each channel
+        :raises NonStandardExposureTimeException: exposure is not one of 7, 34, 404, or 5004
+        :raises MismatchedExposureTimeException: the custom file has a different exposure time
+        """
+        if exposure not in assets.reference_files:
+            raise NonStandardExposureTimeException(exposure)
+        if not custom_target_file:
+            return assets.load_table(assets.reference_files[exposure])
+
+        t_int_custom = round(get_integration_time_from_headers(assets.load_header_values(custom_target_file)) * 1000)
+        if t_int_custom != exposure:
+            raise MismatchedExposureTimeException(exposure, t_int_custom)
+        return assets.load_table(custom_target_file)
+
+    @staticmethod
+    def load_assets():
+        """load_assets
+        load the sol 76 calibration values of every exposure time now, so that the worker
+        processes started afterwards (and every later input of the process) start with them
+        """
+        RadianceCalibration.load_assets()
+        assets.load_table(assets.target_file)
+        for exposure in sorted(assets.reference_files):
+            assets.load_table(assets.reference_files[exposure])
+
+    @staticmethod
+    def calibrate_block(radiance, exposure, custom_target_file=None, smooth_vio=False, smooth_vis=False):
+        """calibrate_block
+        Calibrate many radiance spectra to relative reflectance at once.  Spectra are
+        divided by the calibration values of their exposure time, one group of rows per
+        exposure time, then go through the same steps as calibrate_file.
+
+        :param radiance: (N, 6144) array of radiance spectra
+        :param exposure: exposure time of each spectrum, rounded to ms
+        :param custom_target_file: a custom file to use for calibration (default=None)
+        :param smooth_vio: use 51-channel filter to smooth VIO region
+        :param smooth_vis: use 51-channel filter to smooth VIS region
+        :return: wl, the wavelength for each channel
+        :return: reflectance, (N, 6144) array of relative reflectance
+        :raises NonStandardExposureTimeException: an exposure is not one of 7, 34, 404, or 5004
+        :raises MismatchedExposureTimeException: the custom file has a different exposure time
+        """
+        radiance = np.atleast_2d(np.asarray(radiance, dtype=np.float64))
+        exposure = np.broadcast_to(np.asarray(exposure), radiance.shape[0:1])
+
+        wavelength = None
+        new_values = np.empty_like(radiance)
+        for group_exposure in np.unique(exposure):
+            rows = exposure == group_exposure
+            (wavelength, values) = RelativeReflectanceCalibration.get_reference(int(group_exposure),
+                                                                                custom_target_file)
+            new_values[rows] = RelativeReflectanceCalibration.divide_by_reference(radiance[rows], values)
+
+        return wavelength, RelativeReflectanceCalibration.finish_reflectance(new_values, smooth_vio, smooth_vis)
+
+    def get_rad_spectrum(self):
+        """get_rad_spectrum
+        the parsed rad file being calibrated (the .tab file, or the .npz file written
+        instead of it). The file is read once and shared by every step of the calibration.
+
+        :return: the parsed RADFile
+        """
+        if self.rad is None or self.rad.filename not in (self.rad_file, npz_filename(self.rad_file)):
+            rad = self.prefetched.pop(self.rad_file, None)
+            self.rad = rad if rad is not None else read_spectrum(self.rad_file)
+        return self.rad
+
     @staticmethod
     def do_multiplication(values):
         """
@@ -50,10 +200,7 @@ class RelativeReflectanceCalibration:
         :param values:
         :return: multiplied values
         """
-        my_path = os.path.abspath(os.path.dirname(__file__))
-        sol76dir = os.path.join(my_path, "sol76")
-        convolve = os.path.join(sol76dir, 'Target11_60_95.txt.conv')
-        values_conv = [float(x.split()[1].strip()) for x in open(convolve).readlines()]
+        (wavelength, values_conv) = assets.load_table(assets.target_file)
 
         # multiply original values by the appropriate calibration values
         # to get relative reflectance.
@@ -79,6 +226,21 @@ class RelativeReflectanceCalibration:
 
         return rad_file
 
+    @staticmethod
+    def is_input_file(filename):
+        """is_input_file
+        the file name is that of a PSV file, or of a RAD *.tab or *.npz file
+        """
+        rad_file = RelativeReflectanceCalibration.get_rad_filename(filename).lower()
+        return RadianceCalibration.is_psv_file(filename) or \
+            ("rad" in rad_file and (rad_file.endswith(".tab") or rad_file.endswith(".npz")))
+
+    def found_files(self, count):
+        """found_files
+        add files found while walking a directory to the total used for the progress
+        """
+        self.total_files += count
+
     def get_rad_file(self, input_file, out_dir, overwrite_rad):
         """
         Get the rad file that we want to calibrate. This could be the input file,
@@ -88,14 +250,21 @@ class RelativeReflectanceCalibration:
         :param out_dir: the chosen output directory
         :param overwrite_rad: boolean to overwrite existing rad file
         :return boolean: there is a valid RAD file and/or we created one. We can proceed with calibration.
+            When the RAD file is not emitted, the radiance is kept in memory in self.rad instead.
         """
         # name of the rad file - replace psv with rad (or PSV with RAD)
         self.rad_file = self.get_rad_filename(input_file)
 
+        if "rad" in self.rad_file.lower() and self.rad_file.lower().endswith(".npz"):
+            # binary rad file. the calibration uses the name of the .tab file it was written alongside or instead of
+            self.rad_file = os.path.splitext(self.rad_file)[0] + ".tab"
+            # if the .tab file is there too, it is calibrated instead
+            return not os.path.exists(self.rad_file)
+
         if "rad" in self.rad_file.lower() and self.rad_file.lower().endswith(".tab"):
             if self.rad_file == input_file:
                 return True
-            if os.path.isfile(self.rad_file) and not overwrite_rad:
+            if (os.path.isfile(self.rad_file) or os.path.isfile(npz_filename(self.rad_file))) and not overwrite_rad:
                 # valid rad file already exists, just return
                 return True
 
@@ -106,8 +275,16 @@ class RelativeReflectanceCalibration:
             self.rad_file = os.path.join(out_dir, filename)
         else:
             (out_dir, filename) = os.path.split(input_file)
-        radiance_cal = RadianceCalibration(self.logfile, self.main_app)
-        return radiance_cal.calibrate_to_radiance(InputType.FILE, input_file, out_dir, overwrite_rad)
+        radiance_cal = RadianceCalibration(self.logfile, self.main_app, self.atomic_write, self.output_format,
+                                           self.incremental, self.metrics, run_log=self.run_log)
+        radiance_cal.writer = self.writer
+        radiance_cal.prefetched = self.prefetched
+        radiance_cal.intermediate = True
+        valid = radiance_cal.calibrate_file(input_file, out_dir, overwrite_rad, self.emit_rad)
+        if valid and radiance_cal.radiance is not None:
+            # use the radiance just calculated instead of reading the RAD file back
+            self.rad = radiance_cal.get_rad_spectrum(self.rad_file)
+        return valid
 
     def choose_values(self, custom_target_file=None):
         """ choose_values
@@ -120,12 +297,10 @@ class RelativeReflectanceCalibration:
         """
         if not custom_target_file:
             # built-in target files
-            my_path = os.path.abspath(os.path.dirname(__file__))
-            sol76dir = os.path.join(my_path, "sol76")
-            ms7 = os.path.join(sol76dir, 'CL0_404238481PSV_F0050104CCAM02076P1.TXT.RAD.cor.7ms.txt.cos')
-            ms34 = os.path.join(sol76dir, 'CL0_404238492PSV_F0050104CCAM02076P1.TXT.RAD.cor.34ms.txt.cos')
-            ms404 = os.path.join(sol76dir, 'CL9_404238503PSV_F0050104CCAM02076P1.TXT.RAD.cor.404ms.txt.cos')
-            ms5004 = os.path.join(sol76dir, 'CL9_404238538PSV_F0050104CCAM02076P1.TXT.RAD.cor.5004ms.txt.cos')
+            ms7 = assets.reference_files[7]
+            ms34 = assets.reference_files[34]
+            ms404 = assets.reference_files[404]
+            ms5004 = assets.reference_files[5004]
         else:
             # using a custom target file, set it to each integration time
             #    - will be checked for matching time later
@@ -137,14 +312,13 @@ class RelativeReflectanceCalibration:
         # now get the cosine-corrected values from the correct file
         # calculate integration time for the file that is being calibrated
         try:
-            t_int = get_integration_time(self.rad_file)
+            t_int = get_integration_time_from_headers(self.get_rad_spectrum().headers)
         except NonStandardHeaderException:
             warning = self.rad_file + ': not a valid RAD file header. Skipping this file.'
             # write to log file
-            with open(self.logfile, 'a+') as log:
-                log.write(self.rad_file + ': relative reflectance calibration - ' + warning + '\n')
+            self.write_log(self.rad_file + ': relative reflectance calibration - ' + warning + '\n', "failed.header")
             if self.show_header_warning:
-                print('error - ' + warning + ' File tracked in log')
+                self.run_log.print('error - ' + warning + ' File tracked in log')
                 # show warning
                 if self.main_app is not None:
                     self.show_header_warning = self.main_app.show_warning_dialog(warning)
@@ -152,6 +326,7 @@ class RelativeReflectanceCalibration:
                 # cancel
                 raise CancelExecutionException
             # exit because file was invalid
+            self.count_outcome("failed.header")
             return None
 
         if t_int is not None:
@@ -167,10 +342,9 @@ class RelativeReflectanceCalibration:
             fn = ms5004
         else:
             warning = self.rad_file + ': Exposure time is not one of 7, 34, 404, or 5004. Skipping this file.'
-            print('Warning: ' + warning + ' File tracked in log')
+            self.run_log.print('Warning: ' + warning + ' File tracked in log')
             # track in log file
-            with open(self.logfile, 'a+') as log:
-                log.write(self.rad_file + ': relative reflectance calibration - ' + warning + ' \n')
+            self.write_log(self.rad_file + ': relative reflectance calibration - ' + warning + ' \n', "failed.exposure")
             if self.show_exposure_warning:
                 # show warning
                 if self.main_app is not None:
@@ -179,24 +353,24 @@ class RelativeReflectanceCalibration:
                 # cancel
                 raise CancelExecutionException
             # return from this function
+            self.count_outcome("failed.exposure")
             return None
 
         if fn is not None:
             # if using a custom file, check that the custom exposure time and input exposure times match.
             # If they don't - throw an error, log in file, and
             if custom_target_file:
-                t_int_custom = get_integration_time(custom_target_file)
+                t_int_custom = get_integration_time_from_headers(assets.load_header_values(custom_target_file))
                 t_int_custom = round(t_int_custom * 1000)
                 if t_int_custom != t_int:
                     warning = 'integration times between input file ' + self.rad_file + ' (' + str(t_int) + ')'\
                         ' and custom target file ' + str(custom_target_file) + ' (' + str(t_int_custom) + ') ' \
                         ' do not match. Skipping this file.'
                     # write to log file
-                    with open(self.logfile, 'a+') as log:
-                        log.write(self.rad_file + ': relative reflectance calibration - custom target file'
-                                                  ' integration time does not match.\n')
-                    print('****************************\n '
-                          'WARNING: ' + warning + ' \n****************************\n ')
+                    self.write_log(self.rad_file + ': relative reflectance calibration - custom target file'
+                                                   ' integration time does not match.\n', "failed.mismatched_exposure")
+                    self.run_log.print('****************************\n '
+                                       'WARNING: ' + warning + ' \n****************************\n ')
                     if self.show_mismatched_warning:
                         # show warning dialog
                         if self.main_app is not None:
@@ -205,13 +379,12 @@ class RelativeReflectanceCalibration:
                         # cancel
                         raise CancelExecutionException
                     # return from this function
+                    self.count_outcome("failed.mismatched_exposure")
                     return None
 
             # valid file with correct integration time. -
-            # get the values, but skip the header
-            values = [float(x.split()[1].strip()) for x in open(fn).readlines() if '"' not in x]
-            # get the wavelengths
-            self.wavelength = [float(x.split()[0].strip()) for x in open(fn).readlines() if '"' not in x]
+            # get the wavelengths and values (skipping the header), loaded once per process
+            (self.wavelength, values) = assets.load_table(fn)
 
         return values
 
@@ -230,7 +403,14 @@ class RelativeReflectanceCalibration:
         """rad_to_ref
         rename rad file to ref.
         """
-        out_filename = self.rad_file.replace('RAD', 'REF')
+        return self.get_ref_filename(self.rad_file, out_dir)
+
+    @staticmethod
+    def get_ref_filename(rad_file, out_dir):
+        """get_ref_filename
+        the name of the ref file calibrated from this rad file
+        """
+        out_filename = rad_file.replace('RAD', 'REF')
         out_filename = out_filename.replace('rad', 'ref')
         if out_dir is not None:
             # then save calibrated file to out dir also
@@ -263,75 +443,212 @@ class RelativeReflectanceCalibration:
         :param smooth_vio: use 51-channel filter to smooth VIO region
         :param smooth_vis: use 51-channel filter to smooth VIS region
         """
+        with self.metrics.file():
+            self.calibrate_file_stages(filename, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                       smooth_vis)
+
+    def calibrate_file_stages(self, filename, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                              smooth_vis):
+        """calibrate_file_stages
+        the steps of calibrate_file, each timed as a stage of the metrics
+        """
+        metrics = self.metrics
+        prepared = self.prepare_file(filename, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                     smooth_vis)
+        if prepared is None:
+            return
+        (out_filename, rad, fingerprint) = prepared
+
+        # now choose values based on exp time
+        with metrics.stage("reflectance"):
+            values = self.choose_values(custom_file)
+        if values is None:
+            return
+        if self.total_files == 1:
+            self.update_progress(25)
+        # then calibrate by dividing by values
+        with metrics.stage("reflectance"):
+            new_values = self.do_division(values)
+        if self.total_files == 1:
+            self.update_progress(75)
+        # convolve and smooth
+        with metrics.stage("smoothing"):
+            final_values = self.finish_reflectance(new_values, smooth_vio, smooth_vis)
+
+        # rename rad to ref to get outfile name and then write to file
+        self.writer.submit(self.write_ref, filename, out_filename, self.wavelength, final_values,
+                           rad.header_lines, smooth_vio, smooth_vis, fingerprint)
+
+        if self.total_files == 1:
+            self.update_progress(100)
+
+    def prepare_file(self, filename, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis):
+        """prepare_file
+        the steps of calibrate_file before the reflectance: skip the file if its REF file is
+        up to date or exists, calibrate it to radiance if needed and read the radiance
+
+        :return: the REF file, the parsed RADFile and the fingerprint to record (or None),
+            or None if the file is not calibrated
+        """
+        metrics = self.metrics
+        fingerprint = None
+        if self.incremental and os.path.isfile(filename):
+            # skip the file if the ref file was calculated from the same inputs
+            rad_file = self.get_rad_filename(filename)
+            if rad_file.lower().endswith(".npz"):
+                rad_file = os.path.splitext(rad_file)[0] + ".tab"
+            product = product_filename(self.get_ref_filename(rad_file, out_dir), self.output_format)
+            fingerprint = self.get_fingerprint(filename, custom_file, smooth_vio, smooth_vis)
+            if is_current(product, fingerprint):
+                self.run_log.print(product + " is up to date, skipping")
+                self.count_outcome("skipped.up_to_date")
+                return None
+
         # check for valid rad file
+        self.rad = None
         valid = self.get_rad_file(filename, out_dir, overwrite_rad)
 
         if valid:
             # valid rad file
-            print('calibrating' + filename)
+            self.run_log.print('calibrating' + filename)
 
             out_filename = self.rad_to_ref(out_dir)
-            out_filename_smoothing = out_filename + ".smooth"
 
             if not overwrite_ref:
                 # if we don't want to overwrite existing files, we can skip this file if it already exists
-                if os.path.exists(out_filename) and os.path.isfile(out_filename):
-                    print(out_filename + " already exists, skipping")
-                    return
+                product = product_filename(out_filename, self.output_format)
+                if os.path.exists(product) and os.path.isfile(product):
+                    self.run_log.print(product + " already exists, skipping")
+                    self.count_outcome("skipped.exists")
+                    return None
 
-            # now choose values based on exp time
-            values = self.choose_values(custom_file)
-            if values is None:
-                return
-            if self.total_files == 1:
-                self.update_progress(25)
-            # then calibrate by dividing by values
-            new_values = self.do_division(values)
-            if self.total_files == 1:
-                self.update_progress(75)
-            # convolve
-            final_values = self.do_multiplication(new_values)
-            # replace saturated channels that are too large for PDS fixed-width with 0s
-            final_values = np.where(abs(final_values) > 10E20, 0, final_values)
-
-            # vio data: 241 to 466 nm, index 0 to 4095
-            vio_data = final_values[0:4096]
-            # vis data: 473-905 nm, 4096 < index < 6144
-            vis_data = final_values[4096:6144]
-
-            # smooth values as desired
-            if smooth_vio:
-                smoothed_vio = moving_median_smoothing(vio_data, 50)
-                final_values[0:4096] = smoothed_vio
-            if smooth_vis:
-                smoothed_vis = moving_median_smoothing(vis_data, 50)
-                final_values[4096:6144] = smoothed_vis
-
-            # rename rad to ref to get outfile name and then write to file
-            write_final(out_filename, self.wavelength, final_values)
-            with open(out_filename_smoothing, 'w') as sf:
-                sf.write("VIO: " + str(smooth_vio))
-                sf.write('\n')
-                sf.write("VIS: " + str(smooth_vis))
-
-            # check for original label
-            original_label = self.get_original_label(filename)
-            if os.path.exists(original_label):
-                # write new label based on original
-                (path, label_name) = os.path.split(original_label)
-                new_label_filename = label_name.replace('PSV', 'REF')
-                new_label_filename = new_label_filename.replace('psv', 'ref')
-                new_label_filename = new_label_filename.replace('lbl', 'xml')
-                (out_path, filename) = os.path.split(out_filename)
-                new_label = os.path.join(out_path, new_label_filename)
+            in_memory = self.rad is not None
+            with metrics.stage("parse"):
+                rad = self.get_rad_spectrum()
+            if metrics.enabled and not in_memory:
+                metrics.count("bytes_read", os.path.getsize(rad.filename))
+            return out_filename, rad, fingerprint
+        return None
+
+    def write_ref(self, filename, out_filename, wavelength, values, header, smooth_vio, smooth_vis, fingerprint):
+        """write_ref
+        write the REF file, its .smooth file, label and fingerprint.  Called through
+        self.writer, on the writer thread in the pipelined mode.
+
+        :param filename: the calibrated file
+        :param out_filename: the REF .tab file
+        :param wavelength: the wavelength of each channel
+        :param values: the relative reflectance of each channel
+        :param header: the header lines of the RAD file (stored in .npz files)
+        :param smooth_vio: the VIO region was smoothed
+        :param smooth_vis: the VIS region was smoothed
+        :param fingerprint: the fingerprint to record, or None
+        """
+        metrics = self.metrics
+        out_filename_smoothing = out_filename + ".smooth"
+        with metrics.stage("write"):
+            if self.output_format != "npz":
+                write_final(out_filename, wavelength, values, atomic=self.atomic_write)
+                with open(out_filename_smoothing, 'w') as sf:
+                    sf.write("VIO: " + str(smooth_vio))
+                    sf.write('\n')
+                    sf.write("VIS: " + str(smooth_vis))
+            if self.output_format != "tab":
+                # the smoothing options are stored in the .npz file itself
+                write_npz(npz_filename(out_filename), wavelength, values, header=header, smooth_vio=smooth_vio,
+                          smooth_vis=smooth_vis, atomic=self.atomic_write)
+        if metrics.enabled:
+            for written in [out_filename, npz_filename(out_filename)]:
+                if os.path.exists(written):
+                    metrics.count("bytes_written", os.path.getsize(written))
+
+        # check for original label
+        original_label = self.get_original_label(filename)
+        if os.path.exists(original_label):
+            # write new label based on original
+            (path, label_name) = os.path.split(original_label)
+            new_label_filename = label_name.replace('PSV', 'REF')
+            new_label_filename = new_label_filename.replace('psv', 'ref')
+            new_label_filename = new_label_filename.replace('lbl', 'xml')
+            (out_path, out_name) = os.path.split(out_filename)
+            new_label = os.path.join(out_path, new_label_filename)
+            with metrics.stage("label"):
                 write_label(new_label, original_label, False)
 
-            if self.total_files == 1:
-                self.update_progress(100)
+        if fingerprint is not None:
+            record_fingerprint(product_filename(out_filename, self.output_format), fingerprint)
+        self.count_outcome("calibrated.ref")
+
+        self.run_log.print(filename + ' calibrated and written to ' +
+                           product_filename(out_filename, self.output_format))
+        self.run_log.product("ref", product_filename(out_filename, self.output_format))
 
-            print(filename + ' calibrated and written to ' + out_filename)
+    def read_input(self, filename):
+        """read_input
+        read a PSV or RAD file ahead of its calibration, on the reader thread of the pipelined mode
+
+        :param filename: the file that will be calibrated
+        :return: the inputs read, by file name (nothing if the file can not be read)
+        """
+        if not os.path.isfile(filename):
+            return {}
+        try:
+            if RadianceCalibration.is_psv_file(filename):
+                return {filename: read_psv(filename)}
+            rad_file = self.get_rad_filename(filename)
+            if rad_file != filename or not self.is_input_file(filename):
+                return {}
+            if rad_file.lower().endswith(".npz"):
+                # calibrated under the name of the .tab file, only if there is none (see get_rad_file)
+                rad_file = os.path.splitext(rad_file)[0] + ".tab"
+                if os.path.exists(rad_file):
+                    return {}
+            return {rad_file: read_spectrum(rad_file)}
+        except (ValueError, OSError):
+            # reported when the file is calibrated
+            return {}
+
+    def get_fingerprint(self, filename, custom_file, smooth_vio, smooth_vis):
+        """get_fingerprint
+        the fingerprint of the inputs and options the ref file of this file is calculated from
+        """
+        asset_files = [assets.gain_file, assets.target_file, custom_file] + \
+            [assets.reference_files[exposure] for exposure in sorted(assets.reference_files)]
+        options = {"product": "ref", "format": self.output_format, "smooth_vio": smooth_vio, "smooth_vis": smooth_vis,
+                   "custom_file": os.path.abspath(custom_file) if custom_file else None}
+        return get_fingerprint(filename, asset_files, options, self.incremental)
+
+    def calibrate_in_parallel(self, files, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis,
+                              jobs):
+        """calibrate_in_parallel
+        calibrate each file using a pool of worker processes. Progress and the
+        log file are updated from this process, in the same order as a serial run.
+
+        :param files: the files to calibrate (a list, or a generator read as the workers need files)
+        :param custom_file: custom calibration file
+        :param out_dir: the destination directory for output
+        :param overwrite_rad: boolean to overwrite radiance files
+        :param overwrite_ref: boolean to overwrite relative reflectance files
+        :param smooth_vio: use 51-channel filter to smooth VIO region
+        :param smooth_vis: use 51-channel filter to smooth VIS region
+        :param jobs: the number of worker processes
+        """
+        worker = copy.copy(self)
+        worker.main_app = None
+        # each worker collects its own log and metrics, merged here after each file
+        worker.run_log = self.run_log.worker_log()
+        worker.metrics = Metrics() if self.metrics.enabled else null_metrics
+        arguments = (custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis)
+        for result, file_log, file_metrics in calibrate_in_pool(worker, files, arguments, jobs):
+            self.run_log.merge(file_log)
+            self.metrics.merge(file_metrics)
+            self.current_file += 1
+            self.run_log.file_done()
+            self.update_progress()
+        self.update_progress(100)
 
-    def calibrate_directory(self, directory, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis):
+    def calibrate_directory(self, directory, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis,
+                            jobs=1):
         """calibrate_directory
         calibrate everything in this directory, recursively.
 
@@ -342,31 +659,40 @@ class RelativeReflectanceCalibration:
         :param overwrite_ref: boolean to overwrite relative reflectance files
         :param smooth_vio: use 51-channel filter to smooth VIO region
         :param smooth_vis: use 51-channel filter to smooth VIS region
+        :param jobs: the number of worker processes to use (0 for one per CPU)
         """
-        self.total_files = sum([len(files) for r, d, files in os.walk(directory)])
+        # the directory is walked once, the total grows as PSV and RAD files are found
+        self.total_files = 0
         self.current_file = 1
+        jobs = get_job_count(jobs)
         try:
-            for file_name in os.listdir(directory):
-                # check each file in directory (file or subdirectory?)
-                full_path = os.path.join(directory, file_name)
-                if os.path.isdir(full_path) and full_path is not out_dir:
-                    # recursive call for each subdirectory
-                    self.calibrate_directory(os.path.join(directory, file_name), custom_file, out_dir,
-                                             overwrite_rad, overwrite_ref, smooth_vio, smooth_vis)
-                else:
+            files = walk_files(directory, out_dir, self.is_input_file, self.found_files)
+            if self.group_exposure:
+                self.calibrate_grouped(list(files), custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                       smooth_vis, jobs)
+                return
+            if jobs > 1:
+                self.calibrate_in_parallel(files, custom_file, out_dir, overwrite_rad, overwrite_ref,
+                                           smooth_vio, smooth_vis, jobs)
+                return
+            with pipelined(self, files) as files:
+                for file in files:
                     # calibrate each file individually
-                    self.calibrate_file(full_path, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis)
+                    self.calibrate_file(file, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                        smooth_vis)
                     self.current_file += 1
+                    self.run_log.file_done()
                     self.update_progress()
         except FileNotFoundError:
-            print(directory + ": directory does not exist.")
-            with open(self.logfile, 'a+') as log:
-                log.write(directory + ': relative reflectance input - directory does not exist \n')
+            self.run_log.print(directory + ": directory does not exist.")
+            self.run_log.input_failed("failed.missing_input",
+                                      directory + ': relative reflectance input - directory does not exist \n')
             if self.main_app is not None:
                 raise InputFileNotFoundException(directory)
         self.update_progress(100)
 
-    def calibrate_list(self, list_file, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis):
+    def calibrate_list(self, list_file, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis,
+                       jobs=1):
         """calibrate_list
         calibrate everything in this list
 
@@ -377,40 +703,252 @@ class RelativeReflectanceCalibration:
         :param overwrite_ref: boolean to overwrite relative reflectance files
         :param smooth_vio: use 51-channel filter to smooth VIO region
         :param smooth_vis: use 51-channel filter to smooth VIS region
+        :param jobs: the number of worker processes to use (0 for one per CPU)
         """
         try:
             # read each line into a list of files
             files = open(list_file).read().splitlines()
         except FileNotFoundError:
-            with open(self.logfile, 'a+') as log:
-                log.write(list_file + ':   relative reflectance input: file does not exist \n')
+            self.run_log.print(list_file + " relative reflectance input: file does not exist")
+            self.run_log.input_failed("failed.missing_input",
+                                      list_file + ':   relative reflectance input: file does not exist \n')
             if self.main_app is not None:
                 raise InputFileNotFoundException(list_file)
             return
+        self.calibrate_files(files, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis, jobs)
+
+    def calibrate_catalog(self, catalog_file, where, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                          smooth_vis, jobs=1):
+        """calibrate_catalog
+        calibrate the files of a header catalog matching a condition (see HeaderCatalog.query)
+
+        :param catalog_file: the header catalog, written by headerCatalog
+        :param where: the condition on the columns of the catalog, or None for every file
+        :param custom_file: custom calibration file
+        :param out_dir: the destination directory for output
+        :param overwrite_rad: boolean to overwrite radiance files
+        :param overwrite_ref: boolean to overwrite relative reflectance files
+        :param smooth_vio: use 51-channel filter to smooth VIO region
+        :param smooth_vis: use 51-channel filter to smooth VIS region
+        :param jobs: the number of worker processes to use (0 for one per CPU)
+        """
+        if not os.path.isfile(catalog_file):
+            self.run_log.print(catalog_file + " relative reflectance input: catalog does not exist")
+            self.run_log.input_failed("failed.missing_input",
+                                      catalog_file + ':   relative reflectance input: catalog does not exist \n')
+            return
+        # only runs that select files from a catalog import sqlite3
+        import sqlite3
+        from ccam_prospect.headerCatalog import HeaderCatalog
+        try:
+            with HeaderCatalog(catalog_file) as catalog:
+                files = catalog.query(where)
+        except sqlite3.Error as e:
+            self.run_log.print(catalog_file + ": catalog query failed: " + str(e))
+            self.run_log.input_failed("failed.catalog_query", catalog_file +
+                                      ':   relative reflectance input: catalog query failed - ' + str(e) + '\n')
+            return
+        self.calibrate_files(files, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis, jobs)
+
+    def calibrate_files(self, files, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis,
+                        jobs=1):
+        """calibrate_files
+        calibrate each file of a list
+
+        :param files: the psv or rad files to calibrate
+        :param custom_file: custom calibration file
+        :param out_dir: the destination directory for output
+        :param overwrite_rad: boolean to overwrite radiance files
+        :param overwrite_ref: boolean to overwrite relative reflectance files
+        :param smooth_vio: use 51-channel filter to smooth VIO region
+        :param smooth_vis: use 51-channel filter to smooth VIS region
+        :param jobs: the number of worker processes to use (0 for one per CPU)
+        """
         self.total_files = len(files)
         self.current_file = 1
-        for file_name in files:
+        jobs = get_job_count(jobs)
+        if self.group_exposure:
+            self.calibrate_grouped(files, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis,
+                                   jobs)
+            return
+        if jobs > 1:
+            self.calibrate_in_parallel(files, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                       smooth_vis, jobs)
+            return
+        with pipelined(self, files) as files:
+            for file_name in files:
+                try:
+                    # calibrate each file in the list
+                    self.calibrate_file(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                        smooth_vis)
+                    self.current_file += 1
+                    self.run_log.file_done()
+                    self.update_progress()
+                except InputFileNotFoundException:
+                    self.skip_missing_file(file_name)
+        self.update_progress(100)
+
+    def skip_missing_file(self, file_name):
+        """skip_missing_file
+        warn that a file of the list does not exist, unless the user chose to stop showing the warning
+        """
+        # the file counts as done for the progress, or it would never reach the total
+        self.current_file += 1
+        self.run_log.file_done()
+        warning = file_name + ": file not found. Skipping this file."
+        if self.show_list_warning:
+            if self.main_app is not None:
+                self.show_list_warning = self.main_app.show_warning_dialog(warning)
+        if self.show_list_warning is None:
+            # cancel
+            raise CancelExecutionException
+
+    def schedule_by_exposure(self, files, custom_file=None):
+        """schedule_by_exposure
+        sort the files by exposure time, reading only their headers, and load the
+        calibration values of each exposure time once.  Files with an invalid header,
+        an exposure time other than 7, 34, 404 or 5004 ms, or one that does not match
+        the custom file are rejected.
+
+        :param files: the files to calibrate
+        :param custom_file: custom calibration file
+        :return: exposures, the exposure time of each file to calibrate (None when its
+            header could not be read, e.g. a missing file, left to calibrate_file)
+        :return: references, the wavelength and calibration values of each exposure time
+        :return: rejected, (file, reason code, warning) of each rejected file
+        """
+        exposures = {}
+        references = {}
+        rejected = []
+        failures = {}   # exposure time -> (reason code, warning) of exposure times without values
+        for file in files:
             try:
-                # calibrate each file in the list
-                self.calibrate_file(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis)
-                self.current_file += 1
-                self.update_progress()
-            except InputFileNotFoundException:
-                warning = file_name + ": file not found. Skipping this file."
-                if self.show_list_warning:
-                    if self.main_app is not None:
-                        self.show_list_warning = self.main_app.show_warning_dialog(warning)
-                if self.show_list_warning is None:
-                    # cancel
-                    raise CancelExecutionException
+                exposure = round(get_integration_time_from_headers(read_headers(file)) * 1000)
+            except OSError:
+                exposures[file] = None
+                continue
+            except (NonStandardHeaderException, ValueError, UnicodeDecodeError):
+                rejected.append((file, "failed.header", 'not a valid file header.'))
+                continue
+            if exposure not in references and exposure not in failures:
+                try:
+                    references[exposure] = self.get_reference(exposure, custom_file)
+                except NonStandardExposureTimeException:
+                    failures[exposure] = ("failed.exposure", 'Exposure time is not one of 7, 34, 404, or 5004.')
+                except MismatchedExposureTimeException as e:
+                    failures[exposure] = ("failed.mismatched_exposure", 'custom target file integration time ('
+                                          + str(e.args[1]) + ') does not match (' + str(exposure) + ').')
+            if exposure in failures:
+                (reason, warning) = failures[exposure]
+                rejected.append((file, reason, warning))
+            else:
+                exposures[file] = exposure
+        return exposures, references, rejected
+
+    def reject_files(self, rejected):
+        """reject_files
+        log the files rejected by schedule_by_exposure, and warn about all of them at once
+
+        :param rejected: (file, reason code, warning) of each rejected file
+        """
+        if not rejected:
+            return
+        for (file, reason, warning) in rejected:
+            self.run_log.print('Warning: ' + file + ': ' + warning + ' Skipping this file. File tracked in log')
+            self.write_log(file + ': relative reflectance calibration - ' + warning + ' Skipping this file. \n',
+                           reason)
+            self.count_outcome(reason)
+            self.run_log.file_done()
+        self.current_file += len(rejected)
+        reasons = {}
+        for (file, reason, warning) in rejected:
+            reasons[reason] = reasons.get(reason, 0) + 1
+        warning = '{} files will not be calibrated ({}). Files tracked in log.'.format(
+            len(rejected), ", ".join("{} {}".format(amount, reason) for (reason, amount) in sorted(reasons.items())))
+        self.run_log.print('Warning: ' + warning)
+        if self.main_app is not None and self.show_exposure_warning:
+            self.show_exposure_warning = self.main_app.show_warning_dialog(warning)
+        if self.show_exposure_warning is None:
+            # cancel
+            raise CancelExecutionException
+
+    def calibrate_grouped(self, files, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis,
+                          jobs=1):
+        """calibrate_grouped
+        calibrate the files one exposure time at a time: the headers of every file are read
+        first, files that can not be calibrated are rejected together before any is
+        calibrated, and the reflectance of up to exposure_block_size files of the same
+        exposure time is calculated as one block (see calibrate_block).
+
+        :param files: the psv or rad files to calibrate
+        :param custom_file: custom calibration file
+        :param out_dir: the destination directory for output
+        :param overwrite_rad: boolean to overwrite radiance files
+        :param overwrite_ref: boolean to overwrite relative reflectance files
+        :param smooth_vio: use 51-channel filter to smooth VIO region
+        :param smooth_vis: use 51-channel filter to smooth VIS region
+        :param jobs: the number of worker processes (each calibrates its files one at a time)
+        """
+        (exposures, references, rejected) = self.schedule_by_exposure(files, custom_file)
+        self.reject_files(rejected)
+        # the files of each exposure time together, in the order they were given. Files
+        # whose header could not be read go last
+        files = sorted(exposures, key=lambda file: (exposures[file] is None, exposures[file] or 0))
+        if jobs > 1:
+            self.calibrate_in_parallel(files, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                       smooth_vis, jobs)
+            return
+
+        block = []
+        with pipelined(self, files) as files:
+            for file_name in files:
+                exposure = exposures[file_name]
+                if block and (exposure != exposures[block[0][0]] or len(block) >= exposure_block_size):
+                    self.calibrate_block_files(block, references[exposures[block[0][0]]], smooth_vio, smooth_vis)
+                    block = []
+                try:
+                    if exposure is None:
+                        self.calibrate_file(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref,
+                                            smooth_vio, smooth_vis)
+                    else:
+                        with self.metrics.file():
+                            prepared = self.prepare_file(file_name, custom_file, out_dir, overwrite_rad,
+                                                         overwrite_ref, smooth_vio, smooth_vis)
+                        if prepared is not None:
+                            block.append((file_name,) + prepared)
+                    self.current_file += 1
+                    self.run_log.file_done()
+                    self.update_progress()
+                except InputFileNotFoundException:
+                    self.skip_missing_file(file_name)
+            if block:
+                self.calibrate_block_files(block, references[exposures[block[0][0]]], smooth_vio, smooth_vis)
         self.update_progress(100)
 
+    def calibrate_block_files(self, block, reference, smooth_vio, smooth_vis):
+        """calibrate_block_files
+        calculate the reflectance of files with the same exposure time as one block, and write their REF files
+
+        :param block: (file, REF file, RADFile, fingerprint) of each file, as returned by prepare_file
+        :param reference: the wavelength and calibration values of the exposure time of the files
+        :param smooth_vio: use 51-channel filter to smooth VIO region
+        :param smooth_vis: use 51-channel filter to smooth VIS region
+        """
+        (wavelength, values) = reference
+        with self.metrics.stage("reflectance"):
+            new_values = self.divide_by_reference(np.array([rad.values for (file, out, rad, fp) in block]), values)
+        with self.metrics.stage("smoothing"):
+            final_values = self.finish_reflectance(new_values, smooth_vio, smooth_vis)
+        for ((file, out_filename, rad, fingerprint), file_values) in zip(block, final_values):
+            self.writer.submit(self.write_ref, file, out_filename, wavelength, file_values, rad.header_lines,
+                               smooth_vio, smooth_vis, fingerprint)
+
     def calibrate_relative_reflectance(self, file_type, file_name, custom_file, out_dir, overwrite_rad, overwrite_ref,
-                                       smooth_vio, smooth_vis):
+                                       smooth_vio, smooth_vis, jobs=1, where=None):
         """calibrate_relative_reflectance
-        start the calibration for file, list of files, or directory.
+        start the calibration for file, list of files, directory or header catalog.
 
-        :param file_type: the type of input: list, file, or directory.
+        :param file_type: the type of input: list, file, directory or catalog.
         :param file_name: the input file
         :param custom_file: if there is a custom file relative reflectance
         :param out_dir: the output directory
@@ -418,68 +956,54 @@ class RelativeReflectanceCalibration:
         :param overwrite_ref: boolean to overwrite relative reflectance files
         :param smooth_vio: use 51-channel filter to smooth VIO region
         :param smooth_vis: use 51-channel filter to smooth VIS region
+        :param jobs: the number of worker processes for a list or directory (0 for one per CPU)
+        :param where: the condition selecting the files of a catalog
         :return:
         """
-        if file_type.value is InputType.FILE.value:
-            self.calibrate_file(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis)
-        elif file_type.value is InputType.FILE_LIST.value:
-            self.calibrate_list(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis)
-        else:
-            self.calibrate_directory(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio, smooth_vis)
+        try:
+            if file_type.value is InputType.FILE.value:
+                self.calibrate_file(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                    smooth_vis)
+                self.run_log.file_done()
+            elif file_type.value is InputType.FILE_LIST.value:
+                self.calibrate_list(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                    smooth_vis, jobs)
+            elif file_type.value is InputType.CATALOG.value:
+                self.calibrate_catalog(file_name, where, custom_file, out_dir, overwrite_rad, overwrite_ref,
+                                       smooth_vio, smooth_vis, jobs)
+            else:
+                self.calibrate_directory(file_name, custom_file, out_dir, overwrite_rad, overwrite_ref, smooth_vio,
+                                         smooth_vis, jobs)
+        finally:
+            # write the log records and print the summary, also when the calibration was cancelled
+            self.run_log.finish()
+            # the labels are read again by the next run, which may be much later in the GUI
+            clear_label_values()
+
+
+def calibrate_block(dn, dist_to_target, ipbc, ict, custom_target_file=None, smooth_vio=False, smooth_vis=False):
+    """calibrate_block
+    Calibrate many PSV spectra to radiance and relative reflectance in one vectorized pass
+    (see RadianceCalibration.calibrate_block and RelativeReflectanceCalibration.calibrate_block)
+
+    :param dn: (N, 6144) array of spectra in DN, in wavelength order (uv, vis, vnir)
+    :param dist_to_target: distance to target of each spectrum (distToTarget)
+    :param ipbc: IPBC divisor of each spectrum (IPBCdivisor)
+    :param ict: ICT divisor of each spectrum (ICTdivisor)
+    :param custom_target_file: a custom file to use for calibration (default=None)
+    :param smooth_vio: use 51-channel filter to smooth VIO region
+    :param smooth_vis: use 51-channel filter to smooth VIS region
+    :return: wl, the wavelength for each channel
+    :return: radiance, (N, 6144) array of radiance in W/m^2/sr/um
+    :return: reflectance, (N, 6144) array of relative reflectance
+    """
+    (wavelength, radiance) = RadianceCalibration.calibrate_block(dn, dist_to_target, ipbc, ict)
+    exposure = np.round(integration_time(np.asarray(ipbc, dtype=np.float64), np.asarray(ict, dtype=np.float64)) * 1000)
+    (wavelength, reflectance) = RelativeReflectanceCalibration.calibrate_block(radiance, exposure, custom_target_file,
+                                                                               smooth_vio, smooth_vis)
+    return wavelength, radiance, reflectance
 
 
 if __name__ == "__main__":
-    # create a command line parser
-    parser = argparse.ArgumentParser(description='Relative Reflectance Calibration')
-    parser.add_argument('-f', action="store", dest='ccamFile', help="CCAM psv or rad *.tab file")
-    parser.add_argument('-d', action="store", dest='directory', help="Directory containing .tab files to calibrate")
-    parser.add_argument('-l', action="store", dest='list', help="File with a list of .tab files to calibrate")
-    parser.add_argument('-c', action="store", dest='customFile', help="custom calibration file")
-    parser.add_argument('-o', action="store", dest='out_dir', help="directory to store the output files")
-    parser.add_argument('--no-overwrite-rad', action="store_false", dest='overwrite_rad',
-                        help="do not overwrite existing RAD files")
-    parser.add_argument('--no-overwrite-ref', action="store_false", dest='overwrite_ref',
-                        help="do not overwrite existing REF files")
-    parser.add_argument('--smooth-vio', action="store_true", dest='smooth_vio',
-                        help="apply 51-channel filter to smooth VIO region")
-    parser.add_argument('--smooth-vis', action="store_true", dest='smooth_vis',
-                        help="apply 51-channel filter to smooth VIS region")
-    parser.set_defaults(overwrite_rad=True, overwrite_ref=True, smooth_vis=False, smooth_vio=False)
-
-    args = parser.parse_args()
-    if len(sys.argv) == 1:
-        parser.print_help(sys.stderr)
-        sys.exit(1)
-    if args.ccamFile is not None:
-        in_file_type = InputType.FILE
-        file = args.ccamFile
-    elif args.directory is not None:
-        in_file_type = InputType.DIRECTORY
-        file = args.directory
-    else:
-        in_file_type = InputType.FILE_LIST
-        file = args.list
-
-    start_calibration = True
-
-    out_directory = args.out_dir
-    if out_directory is not None:
-        if not out_directory.endswith('/'):
-            out_directory = out_directory + '/'
-            if not os.path.isdir(out_directory):
-                print('output directory: ' + out_directory + ' does not exist. Please enter an existing directory.')
-                start_calibration = False
-
-    if start_calibration:
-        ow_rad = args.overwrite_rad
-        ow_ref = args.overwrite_ref
-
-        smooth_vio = args.smooth_vio
-        smooth_vis = args.smooth_vis
-
-        now = datetime.now()
-        logfile = "badInput_{}.log".format(now.strftime("%Y%m%d.%H%M%S"))
-
-        calibrate_ref = RelativeReflectanceCalibration(logfile)
-        calibrate_ref.calibrate_relative_reflectance(in_file_type, file, args.customFile, out_directory, ow_rad, ow_ref,
-                                                     smooth_vio, smooth_vis)
+    from ccam_prospect.cli import main
+    main(["ref"] + sys.argv[1:])
@@ -0,0 +1,368 @@
+import argparse
+import csv
+import os
+import re
+import sys
+import numpy as np
+from ccam_prospect.utils.CustomExceptions import NonStandardHeaderException
+from ccam_prospect.utils.Utilities import get_integration_time_from_headers, walk_files
+from ccam_prospect.utils.SpectrumFile import read_spectrum, read_ref
+
+# files of a cube directory
+wavelength_name = "wavelength.npy"
+spectra_name = "spectra.f64"
+index_name = "index.csv"
+
+# columns of the index, one line per row of the cube
+index_columns = ["row", "obs_id", "sclk", "sol", "exposure", "smooth_vio", "smooth_vis", "source", "mtime"]
+
+# largest difference between the wavelengths of a spectrum and the cube (the .tab files keep 3 decimals)
+wavelength_tolerance = 5e-4
+
+
+class SpectraCube:
+    """SpectraCube
+    calibrated spectra of many observations packed into a single (N, channels) float64
+    array stored in one file, read through a memory map.  Every spectrum shares the wavelength
+    axis of the cube.  A csv index holds the observation id, sclk, sol and exposure
+    time (ms) of each row, and the modification time of the file it was read from.
+
+    There is one row per observation: adding an observation again replaces its row in
+    place.  The cube is written by a single writer at a time.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.wavelength_file = os.path.join(directory, wavelength_name)
+        self.spectra_file = os.path.join(directory, spectra_name)
+        self.index_file = os.path.join(directory, index_name)
+        self.wavelength = None
+        self.index = []
+        self._index_changed = False   # rows were replaced since the index was written
+        self._old_columns = False     # the index file was written with other columns
+        if os.path.exists(self.wavelength_file):
+            self.wavelength = np.load(self.wavelength_file)
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r', newline='') as f:
+                reader = csv.DictReader(f)
+                self.index = list(reader)
+                self._old_columns = reader.fieldnames != index_columns
+        for entry in self.index:
+            # cubes written before a column was added
+            for column in index_columns:
+                if entry.get(column) is None:
+                    entry[column] = ""
+        # rows written to the spectra file without an index line (an interrupted append) are ignored
+        self.index = self.index[0:self.stored_rows()]
+        self._rows = {entry["obs_id"]: row for (row, entry) in enumerate(self.index)}
+
+    def __len__(self):
+        return len(self.index)
+
+    def stored_rows(self):
+        """stored_rows
+        the number of complete rows in the spectra file
+        """
+        if self.wavelength is None or not os.path.exists(self.spectra_file):
+            return 0
+        return os.path.getsize(self.spectra_file) // (self.wavelength.size * 8)
+
+    def spectra(self):
+        """spectra
+        every spectrum of the cube, as a read-only memory map. Slicing it only
+        reads the rows that are used.
+
+        :return: an (N, channels) array
+        """
+        if len(self) == 0:
+            return np.empty((0, 0 if self.wavelength is None else self.wavelength.size))
+        return np.memmap(self.spectra_file, dtype=np.float64, mode='r', shape=(len(self), self.wavelength.size))
+
+    def rows(self, obs_id=None, sclk=None, sol=None, exposure=None):
+        """rows
+        the rows matching every given value (None matches anything)
+
+        :param obs_id: an observation id, or a list of them
+        :param sclk: a spacecraft clock value, or a list of them
+        :param sol: a sol, or a list of them
+        :param exposure: an exposure time in ms, or a list of them
+        :return: an array of row numbers
+        """
+        criteria = [(name, [str(v) for v in np.atleast_1d(value)])
+                    for (name, value) in [("obs_id", obs_id), ("sclk", sclk), ("sol", sol), ("exposure", exposure)]
+                    if value is not None]
+        return np.array([ii for (ii, entry) in enumerate(self.index)
+                         if all(entry[name] in values for (name, values) in criteria)], dtype=np.int64)
+
+    def select(self, rows):
+        """select
+        copy the spectra of the given rows out of the cube
+
+        :param rows: the row numbers, as returned by rows()
+        :return: an (len(rows), channels) array
+        """
+        return np.array(self.spectra()[np.asarray(rows, dtype=np.int64)])
+
+    def contains(self, obs_id):
+        return obs_id in self._rows
+
+    def is_current(self, obs_id, mtime):
+        """is_current
+        the observation is in the cube, read from a file at least as recent as mtime
+
+        :param obs_id: the observation id
+        :param mtime: the modification time of the file, in ns
+        """
+        row = self._rows.get(obs_id)
+        if row is None or not self.index[row]["mtime"]:
+            return False
+        return int(self.index[row]["mtime"]) >= mtime
+
+    def add_file(self, filename):
+        """add_file
+        add a RAD or REF product file, replacing the row of the same observation if there is one
+
+        :param filename: the .tab or .npz file
+        :return: the row of the spectrum
+        :raises ValueError: if the file is not formatted correctly or its wavelengths do not match the cube
+        """
+        mtime = os.stat(filename).st_mtime_ns
+        if filename.lower().endswith(".tab") and is_product(filename, "ref"):
+            # read_spectrum would take the first lines of the table for a header
+            spectrum = read_ref(filename)
+        else:
+            spectrum = read_spectrum(filename)
+        if spectrum.smooth_vio is None and filename.lower().endswith(".tab"):
+            (spectrum.smooth_vio, spectrum.smooth_vis) = read_smoothing(filename)
+        if not spectrum.headers:
+            # REF .tab files have no header, use the one of the RAD file
+            spectrum.headers = get_rad_headers(filename)
+        return self.add(spectrum, filename, get_sol(filename), mtime)
+
+    def add(self, spectrum, source=None, sol="", mtime=""):
+        """add
+        add a calibrated spectrum, replacing the row of the same observation if there is one.
+        The index is only written again by save_index once rows were replaced.
+
+        :param spectrum: the RADFile of a RAD or REF product
+        :param source: the file the spectrum was read from
+        :param sol: the sol of the observation, if known
+        :param mtime: the modification time of the source file, in ns
+        :return: the row of the spectrum
+        :raises ValueError: if the wavelengths of the spectrum do not match the cube
+        """
+        if source is None:
+            source = spectrum.filename
+        row = self._rows.get(get_obs_id(source))
+        if row is None:
+            return self.append(spectrum, source, sol, mtime)
+
+        self.check_wavelength(spectrum, source)
+        with open(self.spectra_file, 'r+b') as f:
+            f.seek(row * self.wavelength.size * 8)
+            f.write(np.ascontiguousarray(spectrum.values, dtype=np.float64).tobytes())
+        self.index[row] = self.make_entry(row, spectrum, source, sol, mtime)
+        self._index_changed = True
+        return row
+
+    def append(self, spectrum, source=None, sol="", mtime=""):
+        """append
+        add a calibrated spectrum to the end of the cube.  The first spectrum
+        sets the wavelength axis of the cube.
+
+        :param spectrum: the RADFile of a RAD or REF product
+        :param source: the file the spectrum was read from
+        :param sol: the sol of the observation, if known
+        :param mtime: the modification time of the source file, in ns
+        :return: the row of the spectrum
+        :raises ValueError: if the wavelengths of the spectrum do not match the cube
+        """
+        if source is None:
+            source = spectrum.filename
+        if self.wavelength is None:
+            wavelength = np.asarray(spectrum.wavelength, dtype=np.float64)
+            os.makedirs(self.directory, exist_ok=True)
+            np.save(self.wavelength_file, wavelength)
+            self.wavelength = wavelength
+        self.check_wavelength(spectrum, source)
+
+        row = len(self)
+        entry = self.make_entry(row, spectrum, source, sol, mtime)
+
+        # the spectra file first, so the index never points past its end
+        with open(self.spectra_file, 'ab') as f:
+            f.truncate(row * self.wavelength.size * 8)
+            f.write(np.ascontiguousarray(spectrum.values, dtype=np.float64).tobytes())
+        self.index.append(entry)
+        self._rows[entry["obs_id"]] = row
+        if row == 0 or self._old_columns:
+            # a new index, or one with other columns: written again in full
+            self._index_changed = True
+            self.save_index()
+        else:
+            with open(self.index_file, 'a', newline='') as f:
+                csv.DictWriter(f, fieldnames=index_columns).writerow(entry)
+        return row
+
+    def check_wavelength(self, spectrum, source):
+        """check_wavelength
+        :raises ValueError: if the wavelengths of the spectrum do not match the cube
+        """
+        wavelength = np.asarray(spectrum.wavelength, dtype=np.float64)
+        if wavelength.shape != self.wavelength.shape or \
+                not np.allclose(wavelength, self.wavelength, rtol=0, atol=wavelength_tolerance):
+            raise ValueError(source + ': wavelengths do not match the cube')
+
+    @staticmethod
+    def make_entry(row, spectrum, source, sol, mtime):
+        """make_entry
+        the index line of a spectrum
+        """
+        return {
+            "row": str(row),
+            "obs_id": get_obs_id(source),
+            "sclk": get_sclk(source),
+            "sol": str(sol),
+            "exposure": get_exposure(spectrum.headers),
+            "smooth_vio": "" if spectrum.smooth_vio is None else str(spectrum.smooth_vio),
+            "smooth_vis": "" if spectrum.smooth_vis is None else str(spectrum.smooth_vis),
+            "source": source,
+            "mtime": str(mtime)
+        }
+
+    def save_index(self):
+        """save_index
+        write the whole index again, after rows were replaced.  The new index is renamed
+        over the old one once complete, so an interrupted write keeps the old index (whose
+        replaced rows are then seen as out of date and replaced again).
+        """
+        if not self._index_changed and not self._old_columns:
+            return
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=index_columns)
+            writer.writeheader()
+            writer.writerows(self.index)
+        os.replace(temp_file, self.index_file)
+        self._index_changed = False
+        self._old_columns = False
+
+
+def get_obs_id(filename):
+    """get_obs_id
+    the observation id of a product: its file name without the product type and
+    extension, the same for the PSV, RAD and REF files of an observation
+    """
+    name = os.path.basename(filename).split('.')[0]
+    return re.sub(r'(PSV|RAD|REF|psv|rad|ref)', '', name, count=1)
+
+
+def get_sclk(filename):
+    """get_sclk
+    the spacecraft clock of a product, from its file name (CL5_404230000REF_...)
+    """
+    match = re.match(r'^[A-Za-z]{2}\w_(\d+)', os.path.basename(filename))
+    return match.group(1) if match else ""
+
+
+def get_sol(filename):
+    """get_sol
+    the sol of a product, from a sol directory (sol00076/) in its path
+    """
+    for part in reversed(os.path.normpath(filename).split(os.sep)[:-1]):
+        match = re.fullmatch(r'sol0*(\d+)', part, re.IGNORECASE)
+        if match:
+            return match.group(1)
+    return ""
+
+
+def get_exposure(headers):
+    """get_exposure
+    the exposure time of a spectrum in ms, from its header values
+    """
+    try:
+        return str(round(get_integration_time_from_headers(headers) * 1000))
+    except (NonStandardHeaderException, ValueError):
+        return ""
+
+
+def read_smoothing(tab_file):
+    """read_smoothing
+    the smoothing options of a REF .tab file, from its .smooth file
+
+    :return: smooth_vio, smooth_vis (None when there is no .smooth file)
+    """
+    try:
+        with open(tab_file + ".smooth", 'r') as sf:
+            smooth_vio = sf.readline().split(':')[1].strip() == 'True'
+            smooth_vis = sf.readline().split(':')[1].strip() == 'True'
+            return smooth_vio, smooth_vis
+    except (FileNotFoundError, IndexError):
+        return None, None
+
+
+def is_product(filename, product):
+    """is_product
+    the file is a .tab or .npz file of the given product type ("rad" or "ref").
+    A .npz file written alongside a .tab file is not counted twice.
+    """
+    name = os.path.basename(filename).lower()
+    if product not in name:
+        return False
+    if name.endswith(".tab"):
+        return True
+    return name.endswith(".npz") and not os.path.exists(os.path.splitext(filename)[0] + ".tab")
+
+
+def get_rad_headers(ref_file):
+    """get_rad_headers
+    the header values of the RAD product next to a REF file, if there is one
+    """
+    (path, filename) = os.path.split(ref_file)
+    rad_file = os.path.join(path, filename.replace('REF', 'RAD').replace('ref', 'rad'))
+    for file in [rad_file, os.path.splitext(rad_file)[0] + ".npz"]:
+        if file != ref_file and os.path.exists(file):
+            return read_spectrum(file).headers
+    return {}
+
+
+def consolidate(directory, cube_dir, product="ref"):
+    """consolidate
+    add every RAD or REF product in the directory (and its subdirectories) that is
+    not in the cube yet, or whose file is newer than its row in the cube
+
+    :param directory: the directory of calibrated files
+    :param cube_dir: the cube directory, created if it does not exist
+    :param product: "ref" or "rad"
+    :return: the number of spectra added or replaced
+    """
+    cube = SpectraCube(cube_dir)
+    added = 0
+    try:
+        for file in walk_files(directory, cube_dir, lambda path: is_product(path, product)):
+            if cube.is_current(get_obs_id(file), os.stat(file).st_mtime_ns):
+                continue
+            try:
+                cube.add_file(file)
+                added += 1
+            except ValueError as e:
+                print(str(e) + '. skipping')
+    finally:
+        cube.save_index()
+    print('{} spectra added or replaced, {} in {}'.format(added, len(cube), cube_dir))
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack calibrated spectra into a memory-mapped cube')
+    parser.add_argument('-d', action="store", dest='directory', help="Directory containing calibrated files")
+    parser.add_argument('-o', action="store", dest='cube_dir', help="cube directory (created if needed)")
+    parser.add_argument('--product', action="store", dest='product', choices=["ref", "rad"],
+                        help="type of calibrated files to pack (default ref)")
+    parser.set_defaults(product="ref")
+
+    args = parser.parse_args()
+    if args.directory is None or args.cube_dir is None:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+    consolidate(args.directory, args.cube_dir, args.product)
@@ -0,0 +1,108 @@
+import queue
+import threading
+import time
+from ccam_prospect.utils.CustomExceptions import CancelExecutionException
+
+
+class BackgroundTask:
+    """BackgroundTask
+    runs a calibration on a worker thread so the GUI stays responsive.  The task takes
+    the place of the main application for the calibration (its main_app): progress and
+    warnings are sent as messages, which the GUI reads with messages() from its own
+    thread (polled with after()), and the answers to warnings are sent back with answer().
+
+    messages are tuples:
+        ("progress", percent, files done, files found, seconds since the start)
+        ("warning", text)   the worker waits for answer() with the reply of show_warning_dialog
+        ("done", error)     error is the exception that ended the calibration, or None
+    """
+
+    def __init__(self, calibration, function, *args):
+        """
+        :param calibration: the RadianceCalibration or RelativeReflectanceCalibration that is run
+        :param function: the method of calibration to call on the worker thread
+        :param args: the arguments of function
+        """
+        self.calibration = calibration
+        self.function = function
+        self.args = args
+        self.queue = queue.Queue()
+        self.replies = queue.Queue(maxsize=1)
+        self.cancelled = threading.Event()
+        self.start_time = None
+        self.thread = threading.Thread(target=self._run, name="ccam-calibration", daemon=True)
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.thread.start()
+
+    def _run(self):
+        error = None
+        try:
+            self.function(*self.args)
+        except Exception as e:
+            error = e
+        self.queue.put(("done", error))
+
+    def cancel(self):
+        """cancel
+        stop the calibration after the file being calibrated
+        """
+        self.cancelled.set()
+
+    def messages(self):
+        """messages
+        every message sent since the last call (called from the GUI thread)
+        """
+        pending = []
+        while True:
+            try:
+                pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                return pending
+
+    def answer(self, reply):
+        """answer
+        the reply of the user to the last warning (called from the GUI thread)
+        """
+        self.replies.put(reply)
+
+    def update_progress(self, value):
+        """update_progress
+        called by the calibration on the worker thread after each file
+        """
+        if self.cancelled.is_set():
+            raise CancelExecutionException
+        total_files = self.calibration.total_files
+        if total_files > 1:
+            # the progress of the files found so far
+            files_done = self.calibration.current_file - 1
+            value = 100 * files_done / total_files
+        else:
+            files_done = int(value >= 100)
+        self.queue.put(("progress", min(value, 100), files_done, total_files, time.monotonic() - self.start_time))
+
+    def show_warning_dialog(self, warning):
+        """show_warning_dialog
+        called by the calibration on the worker thread: wait for the GUI to show the warning
+
+        :return: True to keep showing warnings, False to stop showing them, None to cancel
+        """
+        self.queue.put(("warning", warning))
+        return self.replies.get()
+
+
+def progress_text(files_done, total_files, seconds):
+    """progress_text
+    the number of files calibrated, the throughput and the estimated time left
+
+    :param files_done: the number of files calibrated
+    :param total_files: the number of files found so far
+    :param seconds: the time since the start of the calibration
+    """
+    text = "{} of {} files".format(files_done, total_files)
+    if files_done == 0 or seconds <= 0:
+        return text
+    rate = files_done / seconds
+    remaining = int(max(total_files - files_done, 0) / rate)
+    return text + ", {:.1f} files/s, {:d}:{:02d} left".format(rate, remaining // 60, remaining % 60)
@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from ccam_prospect.utils.Utilities import get_header_values
+
+# location of the calibration files bundled with the package
+package_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+gain_file = os.path.join(package_dir, "constants", "gain_mars.edit")
+sol76_dir = os.path.join(package_dir, "sol76")
+target_file = os.path.join(sol76_dir, "Target11_60_95.txt.conv")
+
+# sol 76 calibration target radiance for each supported exposure time (ms)
+reference_files = {
+    7: os.path.join(sol76_dir, "CL0_404238481PSV_F0050104CCAM02076P1.TXT.RAD.cor.7ms.txt.cos"),
+    34: os.path.join(sol76_dir, "CL0_404238492PSV_F0050104CCAM02076P1.TXT.RAD.cor.34ms.txt.cos"),
+    404: os.path.join(sol76_dir, "CL9_404238503PSV_F0050104CCAM02076P1.TXT.RAD.cor.404ms.txt.cos"),
+    5004: os.path.join(sol76_dir, "CL9_404238538PSV_F0050104CCAM02076P1.TXT.RAD.cor.5004ms.txt.cos"),
+}
+
+# everything loaded so far in this process, keyed by (kind, absolute path).
+# each entry holds the modification time of the file when it was loaded, so edited files are reloaded.
+_registry = {}
+
+
+def load(kind, path, loader):
+    """load
+    return the cached result of loader(path), loading it again if the file
+    changed since it was cached.  kind separates different results derived
+    from the same file.
+    """
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _registry.get((kind, path))
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, loader(path))
+        _registry[(kind, path)] = cached
+    return cached[1]
+
+
+def _read_table(path):
+    """_read_table
+    read the first two columns of a table into a read-only (n, 2) array.
+    Header lines (those with quotes) are skipped.
+    """
+    with open(path, "r") as f:
+        rows = [line.split()[0:2] for line in f if '"' not in line and line.strip()]
+    table = np.array(rows, dtype=np.float64)
+    table.setflags(write=False)
+    return table
+
+
+def load_table(path):
+    """load_table
+    the wavelength and value columns of a calibration table, loaded once per process
+
+    :param path: the table to load
+    :return: read-only arrays of the wavelengths and the values
+    """
+    table = load("table", path, _read_table)
+    return table[:, 0], table[:, 1]
+
+
+def load_header_values(path):
+    """load_header_values
+    the header values of a calibration file (for example a custom target file),
+    loaded once per process. The returned dictionary must not be modified.
+
+    :param path: the file to read
+    :return: the header values
+    """
+    return load("headers", path, get_header_values)
+
+
+def clear():
+    """clear
+    forget everything loaded so far
+    """
+    _registry.clear()
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import os
+import ccam_prospect.utils.CalibrationAssets as assets
+
+# change when a code change makes existing products stale
+FINGERPRINT_VERSION = 1
+
+# fingerprint sidecar written next to each product
+FINGERPRINT_EXTENSION = ".fingerprint"
+
+
+def hash_file(path):
+    """hash_file
+    the sha1 hash of the contents of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def asset_version(path):
+    """asset_version
+    the version of a calibration file, the hash of its contents.  Each file is
+    only hashed once per process, until it is modified.
+    """
+    return assets.load("version", path, hash_file)
+
+
+def input_state(path, mode):
+    """input_state
+    what identifies the current contents of an input file
+
+    :param path: the input file
+    :param mode: "mtime" (size and modification time) or "hash" (hash of the contents)
+    """
+    if mode == "hash":
+        return hash_file(path)
+    stat = os.stat(path)
+    return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+def get_fingerprint(input_file, asset_files, options, mode="mtime"):
+    """get_fingerprint
+    a fingerprint of everything a product is calculated from
+
+    :param input_file: the PSV or RAD file the product is calibrated from
+    :param asset_files: the calibration files used (missing or None entries are ignored)
+    :param options: a dictionary of the options that change the product
+    :param mode: "mtime" or "hash", how changes to the input file are detected
+    :return: the fingerprint, as a string
+    """
+    state = {
+        "version": FINGERPRINT_VERSION,
+        "input": input_state(input_file, mode),
+        "assets": [[os.path.abspath(f), asset_version(f)] for f in asset_files if f and os.path.isfile(f)],
+        "options": options
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def fingerprint_file(product_file):
+    return product_file + FINGERPRINT_EXTENSION
+
+
+def is_current(product_file, fingerprint):
+    """is_current
+    the product exists and was calculated from the same inputs as the fingerprint
+    """
+    if not os.path.isfile(product_file):
+        return False
+    try:
+        with open(fingerprint_file(product_file), 'r') as f:
+            return f.read().strip() == fingerprint
+    except FileNotFoundError:
+        return False
+
+
+def record_fingerprint(product_file, fingerprint):
+    """record_fingerprint
+    write the fingerprint of a product that was just written
+    """
+    with open(fingerprint_file(product_file), 'w') as f:
+        f.write(fingerprint + '\n')
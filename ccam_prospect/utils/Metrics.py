@@ -0,0 +1,191 @@
+import json
+import threading
+import time
+import numpy as np
+
+# stages timed inside calibrate_file
+STAGES = ["parse", "offsets", "radiance", "reflectance", "smoothing", "write", "label"]
+
+
+class Metrics:
+    """Metrics
+    wall time and call count of each calibration stage, counters (bytes read and
+    written, files calibrated, skipped or failed by reason) and the latency of each file.
+
+    Hooks added with add_hook are called as hook(kind, name, value) for every
+    stage timing ("stage", seconds), counter ("count", amount) and file ("file", seconds).
+    Values can be added from several threads (the writer thread of the pipelined mode).
+    """
+    enabled = True
+
+    def __init__(self):
+        self.stages = {}      # stage -> [seconds, calls]
+        self.counters = {}    # counter -> amount
+        self.latencies = []   # seconds of each calibrated file
+        self.hooks = []
+        self._depth = 0       # files being timed; only the outermost calibrate_file is a file
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def stage(self, name):
+        """stage
+        a context manager adding the time spent in it to the stage
+        """
+        return _StageTimer(self, name)
+
+    def file(self):
+        """file
+        a context manager timing the calibration of one file
+        """
+        return _FileTimer(self)
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += calls
+        for hook in self.hooks:
+            hook("stage", name, seconds)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        for hook in self.hooks:
+            hook("count", name, amount)
+
+    def add_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+        for hook in self.hooks:
+            hook("file", "latency", seconds)
+
+    def take(self):
+        """take
+        the raw values collected since the last take, for merge in another process
+        """
+        with self._lock:
+            raw = {"stages": self.stages, "counters": self.counters, "latencies": self.latencies}
+            self.stages = {}
+            self.counters = {}
+            self.latencies = []
+        return raw
+
+    def merge(self, raw):
+        """merge
+        add the raw values taken from the metrics of another process (a worker)
+        """
+        if raw is None:
+            return
+        for (name, (seconds, calls)) in raw["stages"].items():
+            self.add_time(name, seconds, calls)
+        for (name, amount) in raw["counters"].items():
+            self.count(name, amount)
+        for seconds in raw["latencies"]:
+            self.add_latency(seconds)
+
+    def to_dict(self):
+        """to_dict
+        the metrics as a dictionary, as written to the JSON file
+        """
+        latency = {"count": len(self.latencies)}
+        if self.latencies:
+            (p50, p90, p99) = np.percentile(self.latencies, [50, 90, 99])
+            latency.update({"mean": float(np.mean(self.latencies)), "p50": float(p50), "p90": float(p90),
+                            "p99": float(p99), "max": float(max(self.latencies))})
+        return {
+            "stages": {name: {"seconds": seconds, "calls": calls} for (name, (seconds, calls)) in self.stages.items()},
+            "counters": dict(self.counters),
+            "file_latency": latency
+        }
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def __getstate__(self):
+        # hooks stay in the process they were added in
+        state = dict(self.__dict__)
+        state["hooks"] = []
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class _StageTimer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _FileTimer:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = 0.0
+
+    def __enter__(self):
+        self.metrics._depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics._depth -= 1
+        if self.metrics._depth == 0:
+            self.metrics.add_latency(time.perf_counter() - self.start)
+        return False
+
+
+class NullMetrics:
+    """NullMetrics
+    the metrics used when none are collected: every call does nothing
+    """
+    enabled = False
+
+    def add_hook(self, hook):
+        pass
+
+    def stage(self, name):
+        return _null_timer
+
+    def file(self):
+        return _null_timer
+
+    def add_time(self, name, seconds, calls=1):
+        pass
+
+    def count(self, name, amount=1):
+        pass
+
+    def add_latency(self, seconds):
+        pass
+
+    def take(self):
+        return None
+
+    def merge(self, raw):
+        pass
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_timer = _NullTimer()
+null_metrics = NullMetrics()
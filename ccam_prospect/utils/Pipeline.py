@@ -0,0 +1,163 @@
+import contextlib
+import queue
+import threading
+
+# files read ahead of the calibration, and outputs waiting to be written, at most
+pipeline_depth = 4
+
+# marks the end of a queue
+_done = object()
+
+
+class OutputWriter:
+    """OutputWriter
+    writes the outputs of each calibrated file (tables, labels, .smooth and
+    fingerprint files) on a writer thread, in the order they were submitted.
+    At most depth outputs wait in the queue: submit blocks until there is room,
+    so a slow file system slows down the calibration instead of filling the memory.
+
+    An error raised while writing is raised again by the next submit, or by close.
+    """
+
+    def __init__(self, depth=pipeline_depth):
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="ccam-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _done:
+                return
+            if self.error is None:
+                (function, args) = item
+                try:
+                    function(*args)
+                except BaseException as e:
+                    # later outputs are dropped, the calibration stops at the next submit
+                    self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def submit(self, function, *args):
+        """submit
+        call function(*args) on the writer thread
+        """
+        self._raise_error()
+        self.queue.put((function, args))
+
+    def close(self):
+        """close
+        wait for every submitted output to be written
+        """
+        self.queue.put(_done)
+        self.thread.join()
+        self._raise_error()
+
+
+class DirectWriter:
+    """DirectWriter
+    the writer used outside of the pipelined mode: outputs are written immediately
+    """
+
+    def submit(self, function, *args):
+        function(*args)
+
+    def close(self):
+        pass
+
+
+def read_ahead(files, read, depth=pipeline_depth):
+    """read_ahead
+    call read(file) for each file on a reader thread, at most depth files ahead
+    of the files that were used
+
+    :param files: the files to read (a list or a generator)
+    :param read: a function of the file, returning what was read
+    :param depth: the number of files read ahead
+    :return: a generator of (file, read(file))
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # give up when the files are no longer used
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            for file in files:
+                if not put((file, read(file))):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(_done)
+
+    thread = threading.Thread(target=reader, name="ccam-reader", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _done:
+                return
+            if isinstance(item, BaseException):
+                # raised while listing the files (e.g. a missing directory)
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+@contextlib.contextmanager
+def pipelined(calibration, files, depth=pipeline_depth):
+    """pipelined
+    a context manager giving the files to calibrate.  When calibration.pipeline is set,
+    the inputs of the next files are read on a reader thread (calibration.read_input)
+    and the outputs are written on a writer thread (calibration.writer) while a file
+    is calibrated.  Every output is written when the context exits.
+
+        with pipelined(calibration, files) as files:
+            for file in files:
+                calibration.calibrate_file(file, ...)
+
+    :param calibration: the RadianceCalibration or RelativeReflectanceCalibration
+    :param files: the files to calibrate
+    :param depth: the size of the queues between the threads
+    """
+    if not calibration.pipeline:
+        yield files
+        return
+
+    writer = OutputWriter(depth)
+    calibration.writer = writer
+    inputs = read_ahead(files, calibration.read_input, depth)
+
+    def prefetched_files():
+        for (file, prefetched) in inputs:
+            # the inputs read ahead for this file, used instead of reading them again
+            calibration.prefetched = prefetched
+            yield file
+
+    try:
+        yield prefetched_files()
+    finally:
+        inputs.close()
+        calibration.prefetched = {}
+        calibration.writer = direct_writer
+        writer.close()
+
+
+direct_writer = DirectWriter()
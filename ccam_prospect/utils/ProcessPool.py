@@ -0,0 +1,105 @@
+import itertools
+import os
+import sys
+from collections import deque
+from ccam_prospect.utils.Metrics import Metrics
+from ccam_prospect.utils.Pipeline import pipelined
+
+# the calibration object and calibrate_file arguments used by this worker process
+_calibration = None
+_arguments = ()
+
+# files sent to a worker at a time when the number of files is not known in advance
+default_chunk_size = 4
+
+# chunks waiting for (or being calibrated by) each worker
+chunks_per_worker = 2
+
+
+def _init_worker(calibration, arguments):
+    """_init_worker
+    set up a worker process with its own copy of the calibration object
+    """
+    global _calibration, _arguments
+    _calibration = calibration
+    _arguments = arguments
+
+
+def _calibrate(file):
+    """_calibrate
+    calibrate one file in a worker process. Log records and metrics are collected and
+    returned so that only the parent process writes the log file and the metrics.
+
+    :return: the result of calibrate_file, what it added to the run log and its metrics (or None)
+    """
+    result = _calibration.calibrate_file(file, *_arguments)
+    return result, _calibration.run_log.take(), _calibration.metrics.take()
+
+
+def _calibrate_chunk(files):
+    """_calibrate_chunk
+    calibrate the files of a chunk, pipelined within the worker when the pipelined mode is used
+    """
+    with pipelined(_calibration, files) as files:
+        results = [_calibrate(file) for file in files]
+    # log and metrics of the outputs written after the last file was calibrated
+    late_log = _calibration.run_log.take()
+    late_metrics = _calibration.metrics.take()
+    if results:
+        (result, file_log, file_metrics) = results[-1]
+        file_log = (file_log[0] + late_log[0], file_log[1], file_log[2] + late_log[2])
+        for (outcome, amount) in late_log[1].items():
+            file_log[1][outcome] = file_log[1].get(outcome, 0) + amount
+        if late_metrics is not None:
+            combined = Metrics()
+            combined.merge(file_metrics)
+            combined.merge(late_metrics)
+            file_metrics = combined.take()
+        results[-1] = (result, file_log, file_metrics)
+    return results
+
+
+def get_job_count(jobs):
+    """get_job_count
+    the number of worker processes to use. 0 (or None) means one per CPU.
+    """
+    if not jobs:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def calibrate_in_pool(calibration, files, arguments, jobs):
+    """calibrate_in_pool
+    call calibration.calibrate_file(file, *arguments) for each file using a pool
+    of worker processes.  Results are returned in the same order as files.
+
+    files may be a generator (such as walk_files): it is read as the workers need
+    more files, with only a few chunks per worker waiting at any time.
+
+    :param calibration: the RadianceCalibration or RelativeReflectanceCalibration to copy into each worker
+    :param files: the files to calibrate
+    :param arguments: the remaining arguments of calibrate_file
+    :param jobs: the number of worker processes
+    :return: a generator of (result, log records, outcomes and products, metrics) for each file
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    # anything still buffered would be printed again by each forked worker
+    sys.stdout.flush()
+    if hasattr(files, "__len__"):
+        chunk_size = max(1, len(files) // (jobs * 8))
+    else:
+        chunk_size = default_chunk_size
+    files = iter(files)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(calibration, arguments)) as executor:
+        pending = deque()
+        while True:
+            while len(pending) < jobs * chunks_per_worker:
+                chunk = list(itertools.islice(files, chunk_size))
+                if not chunk:
+                    break
+                pending.append(executor.submit(_calibrate_chunk, chunk))
+            if not pending:
+                return
+            for result in pending.popleft().result():
+                yield result
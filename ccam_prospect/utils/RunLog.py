@@ -0,0 +1,218 @@
+import sys
+import threading
+import time
+
+# records kept in memory before they are written to the log file
+flush_records = 256
+
+# seconds between the throughput lines printed in quiet mode
+report_interval = 10.0
+
+# counts of the RAD files written on the way to REF files, kept apart from the outcome of each file
+intermediate_prefix = "intermediate:"
+
+
+class RunLog:
+    """RunLog
+    the log of a calibration run: the bad input records written to the log file, the
+    messages printed for each file and the number of files by outcome (calibrated.rad,
+    skipped.exists, failed.header, ...), printed as a summary at the end of the run.
+
+    Each log record is tagged with a reason code, the outcome of the file it is about.
+    Records are buffered and written to the log file together, by the process that
+    owns the run.  Worker processes use their own RunLog without a file, whose records
+    and counts are taken after each file and merged into the log of the run.
+
+    A REF run also writes the RAD file of each PSV file. The outcome of the input is
+    that of its REF file, so the RAD files are counted apart (count_intermediate) and
+    listed after the outcomes of the files in the summary.
+
+    In quiet mode, the messages of each file are not printed; a line with the number
+    of files done and the throughput is printed every report_interval seconds instead.
+
+    With a cube, the products written during the run (of the kind the cube holds) are
+    added to the cube as they are written, by the process that owns the run, the same
+    way as the log records.
+    """
+
+    def __init__(self, filename=None, quiet=False, report=True, cube=None, cube_product=None):
+        """
+        :param filename: the log file, or None to keep the records for take()
+        :param quiet: print a periodic throughput line instead of the messages of each file
+        :param report: print the throughput lines and summary (False in worker processes)
+        :param cube: the SpectraCube the written products are added to, or None
+        :param cube_product: the kind of product added to the cube, "rad" or "ref" (None for none)
+        """
+        self.filename = filename
+        self.quiet = quiet
+        self.report = report
+        self.cube = cube
+        self.cube_product = cube_product
+        self.records = []   # (reason, message) not written yet
+        self.counts = {}    # outcome -> number of files
+        self.products = []  # products to add to the cube, kept for take() by worker processes
+        self.files = 0      # files done
+        self.failed_inputs = 0  # inputs of the run (directories, lists, catalogs) that could not be read at all
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+        self._lock = threading.Lock()  # records and counts are also added by the writer thread of the pipeline
+        self._cube_lock = threading.Lock()
+
+    def worker_log(self):
+        """worker_log
+        the log used by a worker process of this run
+        """
+        return RunLog(None, self.quiet, report=False, cube_product=self.cube_product)
+
+    def record(self, reason, message):
+        """record
+        add a record to the log file
+
+        :param reason: the reason code, such as failed.header
+        :param message: the text of the record, ending with a new line
+        """
+        with self._lock:
+            self.records.append((reason, message))
+        if self.filename is not None and len(self.records) >= flush_records:
+            self.flush()
+
+    def input_failed(self, reason, message):
+        """input_failed
+        add the record of an input of the run that could not be read at all, such as a missing
+        directory or an invalid catalog query.  The command line exits with an error after the run.
+
+        :param reason: the reason code, such as failed.missing_input
+        :param message: the text of the record, ending with a new line
+        """
+        self.failed_inputs += 1
+        self.record(reason, message)
+
+    def print(self, message):
+        """print
+        print a message about a single file, unless in quiet mode
+        """
+        if not self.quiet:
+            print(message)
+
+    def count(self, outcome, amount=1):
+        """count
+        count the outcome of a file
+        """
+        with self._lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + amount
+
+    def count_intermediate(self, outcome):
+        """count_intermediate
+        count the outcome of a RAD file written on the way to a REF file
+        """
+        self.count(intermediate_prefix + outcome)
+
+    def product(self, kind, filename):
+        """product
+        a product was written: add it to the cube if it is of the kind the cube holds
+
+        :param kind: "rad" or "ref"
+        :param filename: the .tab or .npz file written
+        """
+        if kind != self.cube_product:
+            return
+        if self.cube is None:
+            with self._lock:
+                self.products.append(filename)
+            return
+        try:
+            with self._cube_lock:
+                self.cube.add_file(filename)
+        except (OSError, ValueError) as e:
+            self.record("failed.cube", filename + ': not added to the cube - ' + str(e) + '\n')
+
+    def file_done(self):
+        """file_done
+        count a file of the run as done, whatever its outcome
+        """
+        self.files += 1
+        if self.quiet and self.report and time.monotonic() - self.last_report >= report_interval:
+            self.print_throughput()
+
+    def take(self):
+        """take
+        the records, counts and products since the last take, for merge in another process
+        """
+        with self._lock:
+            taken = (self.records, self.counts, self.products)
+            self.records = []
+            self.counts = {}
+            self.products = []
+        return taken
+
+    def merge(self, taken):
+        """merge
+        add the records, counts and products taken from the log of a worker process
+        """
+        (records, counts, products) = taken
+        for (reason, message) in records:
+            self.record(reason, message)
+        for (outcome, amount) in counts.items():
+            self.count(outcome, amount)
+        for filename in products:
+            self.product(self.cube_product, filename)
+
+    def flush(self):
+        """flush
+        write the buffered records to the log file
+        """
+        if self.filename is None:
+            return
+        with self._lock:
+            (records, self.records) = (self.records, [])
+        if not records:
+            return
+        with open(self.filename, 'a+') as log:
+            log.write("".join("[{}] {}".format(reason, message) for (reason, message) in records))
+
+    def print_throughput(self):
+        self.last_report = time.monotonic()
+        seconds = self.last_report - self.start_time
+        print("{} files done, {:.1f} files/s".format(self.files, self.files / seconds if seconds > 0 else 0.0))
+        sys.stdout.flush()
+
+    def summary(self):
+        """summary
+        the number of files by outcome, one line per outcome, then the RAD files written on the way
+        """
+        outcomes = sorted(item for item in self.counts.items() if not item[0].startswith(intermediate_prefix))
+        intermediate = sorted(item for item in self.counts.items() if item[0].startswith(intermediate_prefix))
+        lines = ["{:<28}{:>8}".format(outcome, amount) for (outcome, amount) in outcomes]
+        if intermediate:
+            lines.append("RAD files of the REF files:")
+            lines.extend("  {:<26}{:>8}".format(outcome[len(intermediate_prefix):], amount)
+                         for (outcome, amount) in intermediate)
+        return "\n".join(lines)
+
+    def finish(self):
+        """finish
+        write the remaining records and the cube index, print the summary of the run and start counting again
+        """
+        self.flush()
+        if self.cube is not None:
+            with self._cube_lock:
+                self.cube.save_index()
+        if self.report and (self.files or self.counts):
+            seconds = time.monotonic() - self.start_time
+            print("******** {} files in {:.1f} s ********".format(self.files, seconds))
+            print(self.summary())
+        self.counts = {}
+        self.files = 0
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["_lock"]
+        del state["_cube_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._cube_lock = threading.Lock()
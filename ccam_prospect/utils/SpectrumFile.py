@@ -0,0 +1,208 @@
+import numpy as np
+from itertools import islice
+import os
+from ccam_prospect.utils.Utilities import parse_header_lines, round_to_table_precision, npz_filename
+
+# number of header lines copied from the PSV file to the calibrated files
+HEADER_LENGTH = 29
+
+# line ranges of each spectrometer in the PSV file
+VNIR_LINES = (79, 2127)
+VIS_LINES = (2227, 4275)
+UV_LINES = (4375, 6423)
+
+
+class PSVFile:
+    """PSVFile
+    a PSV file parsed in a single read: the header values, the raw header
+    lines that are copied to the calibrated files, and the DN values of
+    each spectrometer
+    """
+
+    def __init__(self, filename, headers, header_lines, vnir, vis, uv):
+        self.filename = filename
+        self.headers = headers
+        self.header_lines = header_lines
+        self.vnir = vnir
+        self.vis = vis
+        self.uv = uv
+
+    @property
+    def dn(self):
+        """the spectra of the three spectrometers combined in wavelength order (uv, vis, vnir)"""
+        return np.concatenate([self.uv, self.vis, self.vnir])
+
+
+class RADFile:
+    """RADFile
+    a calibrated RAD (or REF) table parsed in a single read. The data columns are
+    only converted the first time they are used, so files that are skipped
+    because of their header are never parsed any further.
+
+    smooth_vio and smooth_vis are only known for REF files read with read_npz (None otherwise).
+    """
+
+    def __init__(self, filename, headers, header_lines, data_lines, columns=None, smooth_vio=None, smooth_vis=None):
+        self.filename = filename
+        self.headers = headers
+        self.header_lines = header_lines
+        self._data_lines = data_lines
+        self._columns = columns
+        self.smooth_vio = smooth_vio
+        self.smooth_vis = smooth_vis
+
+    def _get_columns(self):
+        if self._columns is None:
+            self._columns = parse_columns(self._data_lines)
+            self._data_lines = None
+        return self._columns
+
+    @property
+    def wavelength(self):
+        return self._get_columns()[:, 0]
+
+    @property
+    def values(self):
+        return self._get_columns()[:, 1]
+
+
+def parse_values(lines):
+    """parse_values
+    convert lines holding a single value each to an array of floats
+
+    :param lines: the lines to convert
+    :return: the values as an array
+    """
+    return np.array(lines, dtype=np.float64)
+
+
+def parse_columns(lines):
+    """parse_columns
+    convert lines of a whitespace separated 2-column table to an (n, 2) array.
+    Only the first two columns of each line are used.
+
+    :param lines: the lines to convert
+    :return: the table as an array
+    """
+    tokens = "".join(lines).split()
+    if len(tokens) == 2 * len(lines):
+        return np.array(tokens, dtype=np.float64).reshape(-1, 2)
+    # extra (or missing) columns on some lines, fall back to splitting each line
+    return np.array([line.split()[0:2] for line in lines], dtype=np.float64)
+
+
+def read_psv(filename):
+    """read_psv
+    read the PSV file once and parse the header and the spectra of each
+    spectrometer
+
+        field    line
+
+        vnir:     79:2127
+        vis:      2227:4275
+        uv:       4375:6423
+
+    :param filename: the PSV file to read
+    :return: the parsed PSVFile
+    :raises ValueError: if the file is not formatted correctly
+    """
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+
+    if len(lines) < UV_LINES[1]:
+        raise ValueError(filename + ': too short to be a PSV file')
+
+    return PSVFile(filename,
+                   parse_header_lines(lines),
+                   lines[0:HEADER_LENGTH],
+                   parse_values(lines[VNIR_LINES[0]:VNIR_LINES[1]]),
+                   parse_values(lines[VIS_LINES[0]:VIS_LINES[1]]),
+                   parse_values(lines[UV_LINES[0]:UV_LINES[1]]))
+
+
+def read_rad(filename):
+    """read_rad
+    read a calibrated RAD table once, parsing the header values.  The data
+    (every line after the 29 line header) is parsed on first use.
+
+    :param filename: the RAD file to read
+    :return: the parsed RADFile
+    """
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+
+    header_lines = lines[0:HEADER_LENGTH]
+    return RADFile(filename, parse_header_lines(header_lines), header_lines, lines[HEADER_LENGTH:])
+
+
+def read_ref(filename):
+    """read_ref
+    read a REF table once.  REF tables have no header: every line is data.
+
+    :param filename: the REF .tab file to read
+    :return: the parsed RADFile, without header values
+    """
+    with open(filename, 'r') as f:
+        lines = f.readlines()
+    return RADFile(filename, {}, [], lines)
+
+
+def make_rad(filename, header_lines, wavelength, values):
+    """make_rad
+    a RADFile for values calculated in memory, identical to what read_rad
+    returns after the values are written with write_final
+
+    :param filename: the name of the RAD file
+    :param header_lines: the header lines of the RAD file
+    :param wavelength: the wavelength of each channel
+    :param values: the radiance of each channel
+    :return: the RADFile
+    """
+    header_lines = list(header_lines[0:HEADER_LENGTH])
+    columns = np.column_stack([round_to_table_precision(wavelength, 3), round_to_table_precision(values, 6)])
+    return RADFile(filename, parse_header_lines(header_lines), header_lines, None, columns)
+
+
+def read_npz(filename):
+    """read_npz
+    read a calibrated RAD or REF file written by write_npz
+
+    :param filename: the .npz file to read
+    :return: the parsed RADFile
+    """
+    with np.load(filename) as data:
+        columns = np.column_stack([data["wavelength"], data["values"]])
+        header_lines = [str(line) for line in data["header"]] if "header" in data else []
+        smooth_vio = bool(data["smooth_vio"]) if "smooth_vio" in data else None
+        smooth_vis = bool(data["smooth_vis"]) if "smooth_vis" in data else None
+    return RADFile(filename, parse_header_lines(header_lines), header_lines, None, columns, smooth_vio, smooth_vis)
+
+
+def read_spectrum(filename):
+    """read_spectrum
+    read a calibrated RAD or REF file, from the .tab file or, if there is
+    none, the .npz file written instead of it
+
+    :param filename: the .tab (or .npz) file to read
+    :return: the parsed RADFile
+    """
+    if filename.lower().endswith(".npz"):
+        return read_npz(filename)
+    if not os.path.exists(filename) and os.path.exists(npz_filename(filename)):
+        return read_npz(npz_filename(filename))
+    return read_rad(filename)
+
+
+def read_headers(filename):
+    """read_headers
+    the header values of a PSV file, or of a RAD .tab or .npz file, without
+    reading its spectrum
+
+    :param filename: the file to read
+    :return: the header values
+    """
+    if filename.lower().endswith(".npz"):
+        return read_npz(filename).headers
+    with open(filename, 'r') as f:
+        # PSV headers end at the ">>>>Begin" marker, RAD headers after HEADER_LENGTH lines
+        return parse_header_lines(islice(f, HEADER_LENGTH + 1))
@@ -1,9 +1,17 @@
-from jinja2 import Environment, FileSystemLoader
 import os
 from datetime import date
 from ccam_prospect.utils.CustomExceptions import NonStandardHeaderException
-from pds4_tools import pds4_read
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# number of spectra smoothed at once, to bound the memory used by the median windows
+_MEDIAN_BLOCK_ROWS = 64
+
+# jinja2 environment for the label templates, created on first use
+_template_env = None
+
+# values read from each psv label in this run, keyed by label path
+_label_values = {}
 
 
 def extract_floats(data, index):
@@ -17,27 +25,87 @@ def moving_median_smoothing(data, kernel_size):
     """
     smooth the data using a median filter with the given kernel size. if kernel size is 50,
     we will use the 25 values on either side.
-    :param data:
+
+    The window shrinks at the start of the data (channel t uses channels 1 to 2t - 1), and
+    the last channels before the final one use the median of every channel but the first.
+    The first and last values are copied.  A 2-D block of spectra (one per row) is smoothed
+    along each row in one call.
+    :param data: a spectrum, or a 2-D array with one spectrum per row
     :param kernel_size:
-    :return:
+    :return: the smoothed data, with the same shape as data
     """
-    length = len(data)
+    data = np.asarray(data, dtype=np.float64)
+    if data.size == 0:
+        return np.array(data)
+    length = data.shape[-1]
+    rows = data.reshape(-1, length)
+    smoothed = np.array(rows)
     half_kernel = int(kernel_size / 2)
-    smoothed = np.zeros(length)
-    for t in range(length):
-        if t <= half_kernel:
-            half_kernel_old = half_kernel
-            half_kernel = t - 1
-        elif t > length - half_kernel:
-            half_kernel_old = half_kernel
-            half_kernel = t - 1
-        if t == 0 or t == length - 1:
-            # for first value and last value, just copy the data
-            smoothed[t] = data[t]
-        else:
-            smoothed[t] = np.median(data[t - half_kernel:t + half_kernel + 1])
-        half_kernel = half_kernel_old
-    return np.array(smoothed)
+    # first and last channel (always copied) are never changed below
+    last = length - 2
+
+    # start of the data: the window grows by one channel on each side
+    for t in range(1, min(half_kernel, last) + 1):
+        smoothed[:, t] = np.median(rows[:, 1:2 * t], axis=1)
+
+    # middle of the data: full windows of half_kernel channels on either side
+    first_full = half_kernel + 1
+    last_full = min(length - half_kernel - 1, last)
+    if last_full >= first_full:
+        for start in range(0, rows.shape[0], _MEDIAN_BLOCK_ROWS):
+            block = rows[start:start + _MEDIAN_BLOCK_ROWS, first_full - half_kernel:last_full + half_kernel + 1]
+            windows = sliding_window_view(block, 2 * half_kernel + 1, axis=1)
+            smoothed[start:start + _MEDIAN_BLOCK_ROWS, first_full:last_full + 1] = np.median(windows, axis=2)
+
+    # the first channel of the end region has a window that is cut off by the end of the data
+    t = length - half_kernel
+    if half_kernel < t <= last:
+        smoothed[:, t] = np.median(rows[:, t - half_kernel:], axis=1)
+
+    # end of the data: every channel uses the median of all but the first channel
+    first_end = max(half_kernel, length - half_kernel) + 1
+    if first_end <= last:
+        smoothed[:, first_end:last + 1] = np.median(rows[:, 1:], axis=1)[:, np.newaxis]
+
+    return smoothed.reshape(data.shape)
+
+
+def walk_files(directory, exclude=None, accept=None, found=None):
+    """walk_files
+    every file in this directory and its subdirectories, in a single pass and in
+    the order they are listed.  Files are produced as the tree is read, so work on
+    the first files can start before the whole tree has been listed.
+
+    :param: directory the directory to walk
+    :param: exclude a directory that is not walked (for example the output directory)
+    :param: accept a function of the file path, only files for which it is True are produced
+    :param: found a function called with the number of accepted files in each directory, as it is listed
+    :return: a generator of file paths
+    """
+    excluded = None if exclude is None else os.path.normcase(os.path.abspath(exclude))
+    with os.scandir(directory) as listing:
+        entries = list(listing)
+    files = [entry for entry in entries
+             if not entry.is_dir() and (accept is None or accept(entry.path))]
+    if found is not None and files:
+        found(len(files))
+    files = set(entry.path for entry in files)
+    for entry in entries:
+        if entry.path in files:
+            yield entry.path
+        elif entry.is_dir():
+            # is_dir uses the type returned with the listing, without another stat
+            if excluded is not None and os.path.normcase(os.path.abspath(entry.path)) == excluded:
+                continue
+            yield from walk_files(entry.path, exclude, accept, found)
+
+
+def is_psv_file(filename):
+    """is_psv_file
+    the file name is that of a PSV *.tab or *.txt file
+    """
+    filename = filename.lower()
+    return "psv" in filename and (filename.endswith(".tab") or filename.endswith(".txt"))
 
 
 def get_integration_time(filename):
@@ -47,30 +115,150 @@ def get_integration_time(filename):
     :param: filename the name of the file to read
     :return: integration time
     """
-    headers = get_header_values(filename)
+    return get_integration_time_from_headers(get_header_values(filename))
+
 
+def get_integration_time_from_headers(headers):
+    """get_integration_time_from_headers
+    Calculate the integration time based on already parsed header values
+
+    :param: headers the header values of the file
+    :return: integration time
+    """
     try:
         ipbc = float(headers['IPBCdivisor'])
         ict = float(headers['ICTdivisor'])
-        return ((ipbc * ict) / 33000000) + 0.00356
+        return integration_time(ipbc, ict)
     except KeyError:
         raise NonStandardHeaderException
-        return None
 
 
-def write_final(file_to_write, wavelengths, values, header=None):
+def integration_time(ipbc, ict):
+    """integration_time
+    Calculate the integration time from the IPBC and ICT divisors
+
+    :param: ipbc the IPBC divisor (a number or an array)
+    :param: ict the ICT divisor (a number or an array)
+    :return: integration time, in seconds
+    """
+    return ((ipbc * ict) / 33000000) + 0.00356
+
+
+def write_final(file_to_write, wavelengths, values, header=None, atomic=False):
     """write_final
-    given the file to write to, the wavelengths, and the values, write them to file in a 2-column table
+    given the file to write to, the wavelengths, and the values, write them to file in a 2-column table.
+    The whole table is formatted at once and written with a single write.
+
+    :param: file_to_write the path to the final file
+    :param: wavelenghts the values of the wavelengths, the first column
+    :param: values the calibrated values, the second column
+    :param: header lines to write before the table
+    :param: atomic write to a temporary file first and rename it, so the final file is never partially written
+    """
+    text = format_table(wavelengths, values)
+    if header is not None:
+        text = "".join(header).replace("\n", "\r\n") + text
+    write_output(file_to_write, lambda f: f.write(text), 'w', atomic)
+
+
+def write_npz(file_to_write, wavelengths, values, header=None, smooth_vio=None, smooth_vis=None,
+              dtype=np.float64, atomic=False):
+    """write_npz
+    write the same table as write_final to a binary numpy .npz file, read back with SpectrumFile.read_npz
+
+    :param: file_to_write the path to the final file
+    :param: wavelenghts the values of the wavelengths
+    :param: values the calibrated values
+    :param: header the header lines of the file
+    :param: smooth_vio whether the VIO region was smoothed (reflectance only)
+    :param: smooth_vis whether the VIS region was smoothed (reflectance only)
+    :param: dtype the type to store the values as, numpy.float64 or numpy.float32
+    :param: atomic write to a temporary file first and rename it, so the final file is never partially written
+    """
+    n = len(wavelengths)
+    arrays = {"wavelength": np.asarray(wavelengths, dtype=np.float64),
+              "values": np.asarray(values[0:n], dtype=dtype)}
+    if header is not None:
+        arrays["header"] = np.array(list(header), dtype=str)
+    if smooth_vio is not None:
+        arrays["smooth_vio"] = np.bool_(smooth_vio)
+    if smooth_vis is not None:
+        arrays["smooth_vis"] = np.bool_(smooth_vis)
+    write_output(file_to_write, lambda f: np.savez(f, **arrays), 'wb', atomic)
+
+
+def write_output(file_to_write, write, mode, atomic):
+    """write_output
+    open the file and call write(f)
 
     :param: file_to_write the path to the final file
+    :param: write function writing the contents to the open file
+    :param: mode 'w' for text or 'wb' for binary files
+    :param: atomic write to a temporary file first and rename it, so the final file is never partially written
+    """
+    if not atomic:
+        with open(file_to_write, mode) as f:
+            write(f)
+        return
+
+    temp_file = "{}.{}.tmp".format(file_to_write, os.getpid())
+    try:
+        with open(temp_file, mode) as f:
+            write(f)
+        os.replace(temp_file, file_to_write)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def npz_filename(tab_file):
+    """npz_filename
+    the name of the .npz file written alongside (or instead of) a .tab file
+    """
+    return os.path.splitext(tab_file)[0] + ".npz"
+
+
+def product_filename(tab_file, output_format):
+    """product_filename
+    the file that shows a calibrated product already exists: the .npz file when only
+    npz output is written, otherwise the .tab file
+
+    :param: tab_file the name of the .tab file
+    :param: output_format "tab", "npz" or "both"
+    """
+    if output_format == "npz":
+        return npz_filename(tab_file)
+    return tab_file
+
+
+def format_table(wavelengths, values):
+    """format_table
+    format the rows of a 2-column table as they are written by write_final
+
     :param: wavelenghts the values of the wavelengths, the first column
     :param: values the calibrated values, the second column
+    :return: the table as a string
     """
-    with open(file_to_write, 'w') as f:
-        if header is not None:
-            [f.write(header[ii].replace("\n", "\r\n")) for ii in range(0, len(header))]
-        n = len(wavelengths)
-        [f.write("{:10.3f}{:20f}            \r\n".format(wavelengths[ii], values[ii])) for ii in range(0, n)]
+    n = len(wavelengths)
+    columns = np.empty((n, 2), dtype=np.float64)
+    columns[:, 0] = wavelengths
+    columns[:, 1] = values[0:n]
+    return ("%10.3f%20f            \r\n" * n) % tuple(columns.ravel().tolist())
+
+
+def round_to_table_precision(values, decimals):
+    """round_to_table_precision
+    round the values exactly as they are when written with write_final and read back.
+    Uses the same formatting as write_final, since np.round can differ in the last digit.
+
+    :param: values the values to round
+    :param: decimals the number of decimals written to the table
+    :return: the rounded values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    formatted = ("%.{}f ".format(decimals) * values.size) % tuple(values.ravel().tolist())
+    return np.array(formatted.split(), dtype=np.float64).reshape(values.shape)
 
 
 def get_context(label_path, psv_label):
@@ -90,13 +278,54 @@ def get_context(label_path, psv_label):
     today = date.today()
     creation_date = today.strftime("%Y-%m-%d")
 
+    (psv_filename, start_time) = get_label_values(psv_label)
+
+    context = {
+        "filename": filename_no_ext,
+        "psv_filename": psv_filename,
+        "creation_date": creation_date,
+        "observation_start": start_time
+    }
+    return context
+
+
+def get_label_values(psv_label):
+    """get_label_values
+    the psv data file name and the observation start time of a psv label.
+    Each label is only read once per run (until it is modified).
+
+    :param: psv_label the path to the label for the PSV file
+    :return: the psv data file name and the start time ("UNK" when not found)
+    """
+    mtime = os.stat(psv_label).st_mtime_ns
+    cached = _label_values.get(psv_label)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, read_label_values(psv_label))
+        _label_values[psv_label] = cached
+    return cached[1]
+
+
+def clear_label_values():
+    """clear_label_values
+    forget the label values read so far (called at the end of each calibration run)
+    """
+    _label_values.clear()
+
+
+def read_label_values(psv_label):
+    """read_label_values
+    read the psv data file name and the observation start time from a PDS3 (.lbl) or PDS4 (.xml) label
+
+    :param: psv_label the path to the label for the PSV file
+    :return: the psv data file name and the start time ("UNK" when not found)
+    """
     # get observation start time
     start_time = "UNK" # just in case
 
     # psv data file name = psv label name but with .tab
     path, psv_label_name = os.path.split(psv_label)
     psv_label_type = os.path.splitext(psv_label_name)[1]
-    if psv_label_type.lower() == "lbl":
+    if psv_label_type.lower() == ".lbl":
         psv_filename = psv_label_name.replace("LBL", "TAB")
         psv_filename = psv_filename.replace("lbl", "tab")
 
@@ -108,67 +337,133 @@ def get_context(label_path, psv_label):
                 if i > 56:
                     break
 
-    elif psv_label_type.lower() == "xml":
+    elif psv_label_type.lower() == ".xml":
         psv_filename = psv_label_name.replace("XML", "TAB")
         psv_filename = psv_filename.replace("xml", "tab")
 
-        structures = pds4_read(psv_label)
-        label = structures.label
-        obs_area = label.find("Observation_Area")
-        time = obs_area.find('Time_Coordinates')
-        start_time = time.findtext('start_date_time')
+        start_time = find_start_date_time(psv_label)
+        if start_time is None:
+            # not where we expect it, let pds4_tools read the whole label
+            from pds4_tools import pds4_read
+            structures = pds4_read(psv_label)
+            label = structures.label
+            obs_area = label.find("Observation_Area")
+            time = obs_area.find('Time_Coordinates')
+            start_time = time.findtext('start_date_time')
     else:
         psv_filename = "UNK" # TODO this should never happen?
 
-    context = {
-        "filename": filename_no_ext,
-        "psv_filename": psv_filename,
-        "creation_date": creation_date,
-        "observation_start": start_time
-    }
-    return context
+    return psv_filename, start_time
 
 
-def write_label(label_path, psv_label, is_rad):
-    """write_label
-    given the path to the new label and some information from the psv label,
-    write a PDS4 label from the provided template
+def find_start_date_time(xml_label):
+    """find_start_date_time
+    stream through a PDS4 label until Observation_Area/Time_Coordinates/start_date_time,
+    without reading the rest of the label
+
+    :param: xml_label the path to the PDS4 label
+    :return: the start time, or None if it was not found or the label could not be parsed
     """
-    # get context to fill in template
-    context = get_context(label_path, psv_label)
+    from xml.etree import ElementTree
+    path = []
+    try:
+        for event, element in ElementTree.iterparse(xml_label, events=("start", "end")):
+            # compare names without their namespace
+            name = element.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                path.append(name)
+                continue
+            if path[1:] == ["Observation_Area", "Time_Coordinates", "start_date_time"]:
+                return element.text or ""
+            if path[1:] == ["Observation_Area", "Time_Coordinates"]:
+                return None
+            path.pop()
+    except ElementTree.ParseError:
+        return None
+    return None
 
-    # set up template environment and choose the appropriate template
-    my_path = os.path.abspath(os.path.dirname(__file__))
-    templates = os.path.join(my_path, "../templates")
-    template_loader = FileSystemLoader(searchpath=templates)
-    template_env = Environment(loader=template_loader)
+
+def get_label_template(is_rad):
+    """get_label_template
+    the compiled PDS4 label template, loaded and compiled once per process
+
+    :param: is_rad True for the RAD label template, False for the REF label template
+    :return: the jinja2 template
+    """
+    global _template_env
+    if _template_env is None:
+        # jinja2 is only imported by runs that write labels
+        from jinja2 import Environment, FileSystemLoader
+        # set up template environment
+        my_path = os.path.abspath(os.path.dirname(__file__))
+        templates = os.path.join(my_path, "../templates")
+        _template_env = Environment(loader=FileSystemLoader(searchpath=templates))
     if is_rad:
         template_file = "rad_template.xml"
     else:
         template_file = "ref_template.xml"
-    template = template_env.get_template(template_file)
+    # the environment keeps compiled templates, and only recompiles if the file changes
+    return _template_env.get_template(template_file)
 
-    # write the label
-    with open(label_path, 'w') as label:
-        label.write(template.render(context))
+
+def render_labels(contexts, is_rad):
+    """render_labels
+    render a PDS4 label for each context with the same template
+
+    :param: contexts the contexts to fill in the template, as returned by get_context
+    :param: is_rad True for RAD labels, False for REF labels
+    :return: the text of each label
+    """
+    template = get_label_template(is_rad)
+    return [template.render(context) for context in contexts]
+
+
+def write_labels(labels, is_rad):
+    """write_labels
+    write many PDS4 labels at once
+
+    :param: labels (path to the new label, path to the psv label) for each label to write
+    :param: is_rad True for RAD labels, False for REF labels
+    """
+    labels = list(labels)
+    texts = render_labels([get_context(label_path, psv_label) for (label_path, psv_label) in labels], is_rad)
+    for (label_path, psv_label), text in zip(labels, texts):
+        with open(label_path, 'w') as label:
+            label.write(text)
+
+
+def write_label(label_path, psv_label, is_rad):
+    """write_label
+    given the path to the new label and some information from the psv label,
+    write a PDS4 label from the provided template
+    """
+    write_labels([(label_path, psv_label)], is_rad)
 
 
 def get_header_values(filename):
     """get_header_values
     open the response file and read the header values into a dictionary
     """
+    with open(filename, "r") as infile:
+        return parse_header_lines(infile)
+
+
+def parse_header_lines(lines):
+    """parse_header_lines
+    read the header values from the given lines into a dictionary, stopping
+    at the ">>>>Begin" marker
+    """
     headers = {}
 
-    with open(filename, "r") as infile:
-        for line in infile:
-            if ">>>>Begin" in line:
-                return headers
-            else:
-                parts = line.rsplit(':')
-                if len(parts) > 1:
-                    key = parts[0].lstrip('"')
-                    value = parts[1].rstrip('"\n')
-                    headers[key] = value
+    for line in lines:
+        if ">>>>Begin" in line:
+            return headers
+        else:
+            parts = line.rsplit(':')
+            if len(parts) > 1:
+                key = parts[0].lstrip('"')
+                value = parts[1].rstrip('"\n')
+                headers[key] = value
 
     return headers
 
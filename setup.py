@@ -17,4 +17,5 @@ setup(
    package_data={'ccam_prospect': ['constants/*', 'sol76/*', 'templates/*']
    },
    install_requires=['numpy', 'jinja2', 'matplotlib', 'pds4_tools'],
+   entry_points={'console_scripts': ['ccam-prospect=ccam_prospect.cli:main']},
 )
@@ -0,0 +1,34 @@
+import os
+from ccam_prospect.benchmark import make_psv
+from ccam_prospect.relativeReflectanceCalibration import RelativeReflectanceCalibration
+from ccam_prospect.utils.BackgroundTask import BackgroundTask
+from ccam_prospect.utils.RunLog import RunLog
+
+
+def test_list_with_missing_file_ends_at_100(tmp_path):
+    files = [str(tmp_path / "CL5_404238503PSV_F0050104CCAM02076P1.TXT"),
+             str(tmp_path / "CL5_404238504PSV_F0050104CCAM02076P1.TXT"),
+             str(tmp_path / "CL5_404238505PSV_F0050104CCAM02076P1.TXT")]
+    make_psv(files[0], seed=0)
+    make_psv(files[2], seed=1)
+    list_file = str(tmp_path / "files.txt")
+    with open(list_file, 'w') as f:
+        f.write("\n".join(files) + "\n")
+    out_dir = str(tmp_path / "out")
+    os.makedirs(out_dir)
+
+    logfile = str(tmp_path / "badInput.log")
+    calibration = RelativeReflectanceCalibration(logfile, run_log=RunLog(logfile, quiet=True))
+    task = BackgroundTask(calibration, calibration.calibrate_list, list_file, None, out_dir, True, True, False, False)
+    calibration.main_app = task
+    # keep showing the warnings about missing files
+    task.answer(True)
+    task.start()
+    task.thread.join()
+
+    messages = task.messages()
+    assert messages[-1] == ("done", None)
+    assert ("warning", files[1] + ": file not found. Skipping this file.") in messages
+    progress = [message for message in messages if message[0] == "progress"]
+    (kind, value, files_done, total_files, seconds) = progress[-1]
+    assert (value, files_done, total_files) == (100, 3, 3)
@@ -0,0 +1,45 @@
+import json
+import os
+
+from ccam_prospect.benchmark import compare
+
+baseline_file = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "baseline.json")
+
+
+def stages(**medians):
+    return {"stages": {stage: {"median": median} for (stage, median) in medians.items()}}
+
+
+def test_compare_flags_slower_stages():
+    baseline = stages(header_parse=0.010, write_final=0.020)
+    results = stages(header_parse=0.011, write_final=0.030)
+    assert compare(results, baseline, 0.25) == [
+        ("header_parse", 0.010, 0.011, 0.011 / 0.010, False),
+        ("write_final", 0.020, 0.030, 0.030 / 0.020, True),
+    ]
+
+
+def test_compare_skips_stages_missing_from_the_baseline():
+    baseline = stages(header_parse=0.010)
+    results = stages(header_parse=0.010, cli_startup=0.050)
+    assert [row[0] for row in compare(results, baseline)] == ["header_parse"]
+
+
+def test_compare_uses_the_thresholds_of_the_baseline():
+    baseline = stages(rad_startup=0.100, write_final=0.020)
+    baseline["thresholds"] = {"rad_startup": 0.5}
+    results = stages(rad_startup=0.140, write_final=0.026)
+    assert [row[4] for row in compare(results, baseline, 0.25)] == [False, True]
+
+
+def test_compare_zero_baseline():
+    (row,) = compare(stages(write_label=0.001), stages(write_label=0.0))
+    assert row[3] == float('inf') and row[4]
+
+
+def test_committed_baseline_compares_with_itself():
+    with open(baseline_file, 'r') as bf:
+        baseline = json.load(bf)
+    comparison = compare(baseline, baseline)
+    assert len(comparison) == len(baseline["stages"])
+    assert not any(row[4] for row in comparison)
@@ -0,0 +1,25 @@
+import pytest
+from ccam_prospect.benchmark import make_psv
+from ccam_prospect.cli import main
+from ccam_prospect.headerCatalog import HeaderCatalog
+
+
+def test_invalid_where_exits_with_error(tmp_path, monkeypatch):
+    make_psv(str(tmp_path / "CL5_404238503PSV_F0050104CCAM02076P1.TXT"))
+    catalog_file = str(tmp_path / "archive.db")
+    with HeaderCatalog(catalog_file) as catalog:
+        catalog.index(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit) as exit_info:
+        main(["ref", "--catalog", catalog_file, "--where", "no_such_column = 1", "-o", str(tmp_path)])
+    assert exit_info.value.code == 1
+    (log_file,) = tmp_path.glob("badInput_*.log")
+    assert log_file.read_text().startswith("[failed.catalog_query] " + catalog_file)
+
+
+@pytest.mark.parametrize("command", ["rad", "ref"])
+def test_where_without_catalog_is_rejected(tmp_path, capsys, command):
+    with pytest.raises(SystemExit) as exit_info:
+        main([command, "-d", str(tmp_path), "--where", "exposure = 404"])
+    assert exit_info.value.code == 2
+    assert "--catalog" in capsys.readouterr().err
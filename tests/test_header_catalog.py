@@ -0,0 +1,27 @@
+import ccam_prospect.headerCatalog as headerCatalog
+from ccam_prospect.benchmark import make_psv
+from ccam_prospect.headerCatalog import HeaderCatalog
+
+
+def test_index_records_unreadable_files_as_invalid(tmp_path, monkeypatch):
+    valid = str(tmp_path / "CL5_404238503PSV_F0050104CCAM02076P1.TXT")
+    make_psv(valid)
+    unreadable = str(tmp_path / "CL5_404238504PSV_F0050104CCAM02076P1.TXT")
+    make_psv(unreadable, seed=1)
+
+    read_headers = headerCatalog.get_header_values
+
+    def get_header_values(filename):
+        if filename == unreadable:
+            raise PermissionError(13, "Permission denied", filename)
+        return read_headers(filename)
+
+    monkeypatch.setattr(headerCatalog, "get_header_values", get_header_values)
+    with HeaderCatalog(str(tmp_path / "archive.db")) as catalog:
+        assert catalog.index(str(tmp_path)) == (2, 0)
+        assert catalog.query("valid = 1") == [valid]
+        assert catalog.query("valid = 0") == [unreadable]
+        # read again by the next index, once it can be read
+        monkeypatch.setattr(headerCatalog, "get_header_values", read_headers)
+        assert catalog.index(str(tmp_path)) == (1, 0)
+        assert catalog.query("valid = 1") == [valid, unreadable]
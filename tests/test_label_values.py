@@ -0,0 +1,48 @@
+import ccam_prospect.utils.Utilities as utils
+from ccam_prospect.benchmark import make_psv
+from ccam_prospect.radianceCalibration import RadianceCalibration
+from ccam_prospect.utils.InputType import InputType
+from ccam_prospect.utils.RunLog import RunLog
+from ccam_prospect.utils.Utilities import read_label_values
+
+pds4_label = """<?xml version="1.0" encoding="UTF-8"?>
+<Product_Observational xmlns="http://pds.nasa.gov/pds4/pds/v1">
+  <Identification_Area>
+    <logical_identifier>urn:nasa:pds:msl_ccam:data:cl5_404238503psv</logical_identifier>
+  </Identification_Area>
+  <Observation_Area>
+    <Time_Coordinates>
+      <start_date_time>2012-10-23T01:02:03.456Z</start_date_time>
+      <stop_date_time>2012-10-23T01:02:13.456Z</stop_date_time>
+    </Time_Coordinates>
+  </Observation_Area>
+</Product_Observational>
+"""
+
+
+def test_pds3_label(tmp_path):
+    label = tmp_path / "CL5_404238503PSV_F0050104CCAM02076P1.LBL"
+    label.write_text('PDS_VERSION_ID = PDS3\nSTART_TIME = 2012-10-23T01:02:03.456\nSTOP_TIME = 2012-10-23T01:02:13.456\n')
+    assert read_label_values(str(label)) == ("CL5_404238503PSV_F0050104CCAM02076P1.TAB", "2012-10-23T01:02:03.456")
+
+
+def test_pds4_label(tmp_path):
+    label = tmp_path / "cl5_404238503psv_f0050104ccam02076p1.xml"
+    label.write_text(pds4_label)
+    assert read_label_values(str(label)) == ("cl5_404238503psv_f0050104ccam02076p1.tab", "2012-10-23T01:02:03.456Z")
+
+
+def test_other_label(tmp_path):
+    label = tmp_path / "CL5_404238503PSV_F0050104CCAM02076P1.txt"
+    label.write_text('START_TIME = 2012-10-23T01:02:03.456\n')
+    assert read_label_values(str(label)) == ("UNK", "UNK")
+
+
+def test_label_values_are_forgotten_after_a_run(tmp_path):
+    psv_file = str(tmp_path / "CL5_404238503PSV_F0050104CCAM02076P1.TXT")
+    make_psv(psv_file)
+    logfile = str(tmp_path / "badInput.log")
+    calibration = RadianceCalibration(logfile, run_log=RunLog(logfile, quiet=True, report=False))
+    calibration.calibrate_to_radiance(InputType.FILE, psv_file, str(tmp_path) + "/", True)
+    assert (tmp_path / "CL5_404238503RAD_F0050104CCAM02076P1.xml").exists()
+    assert utils._label_values == {}
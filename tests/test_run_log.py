@@ -0,0 +1,44 @@
+import os
+from ccam_prospect.benchmark import make_psv
+from ccam_prospect.relativeReflectanceCalibration import RelativeReflectanceCalibration
+from ccam_prospect.utils.RunLog import RunLog
+
+
+def test_ref_run_counts_one_outcome_per_input(tmp_path):
+    files = []
+    for seed in range(3):
+        files.append(str(tmp_path / "CL5_40423850{}PSV_F0050104CCAM02076P1.TXT".format(seed)))
+        make_psv(files[-1], seed=seed)
+    out_dir = str(tmp_path / "out")
+    os.makedirs(out_dir)
+
+    logfile = str(tmp_path / "badInput.log")
+    run_log = RunLog(logfile, quiet=True, report=False)
+    calibration = RelativeReflectanceCalibration(logfile, run_log=run_log)
+    calibration.calibrate_files(files, None, out_dir, True, True, False, False)
+
+    # the RAD file of each input is counted apart from its outcome
+    assert run_log.counts == {"calibrated.ref": 3, "intermediate:calibrated.rad": 3}
+    assert run_log.summary().splitlines() == ["calibrated.ref                     3",
+                                              "RAD files of the REF files:",
+                                              "  calibrated.rad                   3"]
+
+
+def test_grouped_run_logs_each_rejected_file(tmp_path, capsys):
+    valid = str(tmp_path / "CL5_404238503PSV_F0050104CCAM02076P1.TXT")
+    make_psv(valid)
+    invalid = str(tmp_path / "CL5_404238504PSV_F0050104CCAM02076P1.TXT")
+    with open(invalid, 'w') as f:
+        f.write('"Spectrometer Serial:CCAM"\nnot a header\n')
+
+    logfile = str(tmp_path / "badInput.log")
+    run_log = RunLog(logfile, quiet=True, report=False)
+    calibration = RelativeReflectanceCalibration(logfile, run_log=run_log, group_exposure=True)
+    calibration.calibrate_files([valid, invalid], None, str(tmp_path), True, True, False, False)
+    run_log.flush()
+
+    assert run_log.counts["failed.header"] == 1
+    with open(logfile) as log:
+        assert log.read().startswith("[failed.header] " + invalid + ": relative reflectance calibration")
+    # the warnings go through the run log, so quiet mode leaves them out
+    assert "Warning" not in capsys.readouterr().out
@@ -0,0 +1,51 @@
+import os
+import numpy as np
+from ccam_prospect.spectraCube import SpectraCube, consolidate
+from ccam_prospect.utils.Utilities import write_final
+
+ref_name = "CL5_404238503REF_F0050104CCAM02076P1.tab"
+wavelength = np.linspace(400.0, 840.0, 16)
+
+
+def write_ref(directory, values, mtime):
+    filename = os.path.join(directory, ref_name)
+    write_final(filename, wavelength, np.full(wavelength.size, values))
+    os.utime(filename, ns=(mtime, mtime))
+    return filename
+
+
+def test_consolidate_adds_new_products(tmp_path):
+    write_ref(str(tmp_path), 0.25, 1000000000)
+    cube_dir = str(tmp_path / "cube")
+    assert consolidate(str(tmp_path), cube_dir) == 1
+    assert consolidate(str(tmp_path), cube_dir) == 0
+    cube = SpectraCube(cube_dir)
+    assert len(cube) == 1
+    np.testing.assert_allclose(cube.select([0])[0], 0.25)
+
+
+def test_consolidate_replaces_newer_products(tmp_path):
+    write_ref(str(tmp_path), 0.25, 1000000000)
+    cube_dir = str(tmp_path / "cube")
+    consolidate(str(tmp_path), cube_dir)
+    # recalibrated: the row of the observation is replaced, not added again
+    write_ref(str(tmp_path), 0.5, 2000000000)
+    assert consolidate(str(tmp_path), cube_dir) == 1
+    cube = SpectraCube(cube_dir)
+    assert len(cube) == 1
+    np.testing.assert_allclose(cube.select([0])[0], 0.5)
+    assert cube.index[0]["mtime"] == "2000000000"
+
+
+def test_add_file_appends_other_observations(tmp_path):
+    cube = SpectraCube(str(tmp_path / "cube"))
+    first = write_ref(str(tmp_path), 0.25, 1000000000)
+    second = os.path.join(str(tmp_path), ref_name.replace("404238503", "404238504"))
+    write_final(second, wavelength, np.full(wavelength.size, 0.75))
+    assert cube.add_file(first) == 0
+    assert cube.add_file(second) == 1
+    assert cube.add_file(first) == 0
+    cube.save_index()
+    cube = SpectraCube(str(tmp_path / "cube"))
+    assert [entry["source"] for entry in cube.index] == [first, second]
+    np.testing.assert_allclose(cube.select([0, 1])[:, 0], [0.25, 0.75])